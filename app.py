@@ -16,10 +16,34 @@ from dash.exceptions import PreventUpdate
 
 from os import path # path
 import os
-import subprocess  #to run executable
+import shutil
+import tempfile
+import time
 from datetime import date
 import datetime    #to convert date to doy or vice versa
 
+import dssat_runner
+import result_cache
+import osu_reader
+import daily_reader
+import results_store
+import results_archive
+import session_store
+import sim_stats
+import sim_figures
+import workspace
+import soil_catalog
+import weather_store
+import sim_jobs
+import snx_template
+import sweep
+import run_metrics
+import dssat_governor
+import yield_atlas
+import forecast
+import season_climate
+from snx_template import cultivar_options
+
 app = dash.Dash(
     __name__,
   #  meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}],
@@ -27,6 +51,7 @@ app = dash.Dash(
 )
 
 server = app.server
+run_metrics.instrument(app)  #/metrics (Prometheus) + timings of the callback responses
 
 DATA_PATH = pathlib.Path(__file__).parent.joinpath("data").resolve()
 
@@ -41,16 +66,55 @@ sce_col_names=["sce_name", "Crop", "Cultivar","stn_name", "Plt-date", "FirstYear
                  "1_Fert(DOY)","1_Fert(Kg/ha)","2_Fert(DOY)","2_Fert(Kg/ha)","3_Fert(DOY)","3_Fert(Kg/ha)","4_Fert(DOY)","4_Fert(Kg/ha)",
                  'CropPrice', 'NFertCost', 'SeedCost','OtherVariableCosts','FixedCosts']
 
-cultivar_options = {
-    'MZ': ["CIMT01 BH540-Kassie","CIMT02 MELKASA-Kassi","CIMT17 BH660-FAW-40%", "CIMT19 MELKASA2-FAW-40%", "CIMT21 MELKASA-LowY"],
-    'WH': ["CI2021 KT-KUB", "CI2022 RMSI", "CI2023 Meda wolabu", "CI2024 Sofumer", "CI2025 Hollandi"],
-    'SG': ["IB0020 ESH-1","IB0020 ESH-2","IB0027 Dekeba","IB0027 Melkam","IB0027 Teshale"]
-}
-Wdir_path = 'C:\\IRI\\Python_Dash\\ET_DSS_hist\\TEST\\'
-app.layout = html.Div(
+Wdir_path = os.environ.get('SIMAGRI_WDIR', 'C:\\IRI\\Python_Dash\\ET_DSS_hist\\TEST\\')
+#cache of simulated results (in-memory LRU + on-disk directory shared by all workers)
+sim_cache = result_cache.ResultCache(result_cache.CACHE_DIR or path.join(Wdir_path, "cache"))
+OSU_COLS = ['PDAT', 'ADAT', 'MDAT', 'HWAM', 'NICM']  #columns of *.OSU used in the figures and budgets
+#variables of the daily-dynamics panel => (daily output, label)
+DAILY_VARS = {'LAID': ('OPG', 'Leaf area index [-]'), 'CWAD': ('OPG', 'Above-ground biomass [kg/ha]'),
+              'GWAD': ('OPG', 'Grain weight [kg/ha]'), 'SWTD': ('OSW', 'Total soil water [mm]'),
+              'WSPD': ('OPG', 'Water stress (photosynthesis) [0-1]'), 'NSTD': ('OPG', 'Nitrogen stress [0-1]')}
+#results of each browser session (simulated tables, yield/EB tables) kept on the server => the browser keeps only the session id
+sessions = session_store.SessionStore()
+#working directory of each browser session (SNX, DSSAT outputs, simulated_yield.csv) => Wdir_path is only read
+workspaces = workspace.WorkspaceManager()
+TABLE_PAGE_SIZE = 20  #rows of the yield/EB tables sent to the browser at a time
+#station weather (WTH files) as memory-mapped arrays; report missing years of the range available in the UI
+weather = weather_store.WeatherStore(Wdir_path, path.join(Wdir_path, "cache", "weather"))
+weather.report_missing(1981, 2018)
+climate_index = season_climate.ClimateIndex(weather)  #daily arrays on a continuous calendar for the season climate panel
+#background simulation jobs (the web worker is not blocked during DSSAT runs), stopped if the browser stops polling
+sim_queue = sim_jobs.JobQueue(abandon_after=sim_jobs.ABANDON_S)
+#speculative runs of the scenarios as soon as they are added (one at a time, so that "Simulate all" is not slowed down)
+#jobs of a closed browser session (not polled by presim-interval) are stopped => their DSSAT slots are freed
+presim_queue = sim_jobs.JobQueue(n_threads=1, abandon_after=sim_jobs.ABANDON_S)
+#max. seconds "Simulate all" waits for the running pre-simulations, the unfinished ones are stopped and run with the others
+PRESIM_WAIT_S = float(os.environ.get('SIMAGRI_PRESIM_WAIT_S', '30'))
+EB_COLS = results_store.EB_COLS
+#every simulated scenario-year is appended to a Parquet archive partitioned by crop/station/soil (needs pyarrow)
+archive = results_archive.ResultsArchive(results_archive.ARCHIVE_DIR or path.join(Wdir_path, "archive"))
+if results_archive.pa is None:
+    print('WARNING: pyarrow is not installed => simulated results are not archived (pip install -r requirements.txt)')
+#precomputed yields of the standard scenarios (python yield_atlas.py build) => no DSSAT run for them
+atlas = yield_atlas.YieldAtlas(yield_atlas.ATLAS_DIR or path.join(Wdir_path, "atlas"))
+
+#hit/miss counts of the result cache and the yield atlas => /metrics
+def cache_requests():
+    cache, atlas_stats = sim_cache.stats(), atlas.stats()
+    return ([({'cache': 'result', 'outcome': outcome}, cache[k])
+             for k, outcome in (('hits_memory', 'hit_memory'), ('hits_disk', 'hit_disk'), ('misses', 'miss'))] +
+            [({'cache': 'atlas', 'outcome': outcome}, atlas_stats[k]) for k, outcome in (('hits', 'hit'), ('misses', 'miss'))])
+
+run_metrics.register('simagri_cache_requests_total', 'Lookups of simulated results by cache and outcome', 'counter',
+                     cache_requests)
+run_metrics.register('simagri_cache_items', 'Scenario results kept in memory by the result cache', 'gauge',
+                     lambda: [({'cache': 'result'}, sim_cache.stats()['items_memory'])])
+station_options = [{'label': 'Melkasa', 'value': 'MELK'},{'label': 'Awassa', 'value': 'AWAS'},{'label': 'Bako', 'value': 'BAKO'},{'label': 'Mahoni', 'value': 'MAHO'}]
+#columns of the archive that can be used to group the results => label
+ARCHIVE_GROUPS = {'Crop': 'Crop', 'stn_name': 'Station', 'soil': 'Soil', 'Cultivar': 'Cultivar', 'Plt-date': 'Planting date',
+                  'plt_density': 'Planting density', 'iNO3': 'Initial NO3', 'YEAR': 'Year'}
+main_layout = html.Div(
     [
-        dcc.Store(id='memory-yield-table'),  #to save fertilizer application table
-        dcc.Store(id='memory-EB-table'),  #to save fertilizer application table
         html.Div(
             dbc.Row([html.Img(src=app.get_asset_url("ethioagroclimate.png"))], className="app__banner")
             # [html.Img(src=app.get_asset_url("ethioagroclimate.png"))], className="app__banner"
@@ -108,7 +172,7 @@ app.layout = html.Div(
             dbc.Row([
                 dbc.Col(html.Span("2) Select a station name for analysis", className="uppercase bold"),width="auto"),
                 ]),
-            dcc.Dropdown(id='ETstation', options=[{'label': 'Melkasa', 'value': 'MELK'},{'label': 'Awassa', 'value': 'AWAS'},{'label': 'Bako', 'value': 'BAKO'},{'label': 'Mahoni', 'value': 'MAHO'}],
+            dcc.Dropdown(id='ETstation', options=station_options,
                     value='MELK')
             ],style={"width": "50%"},),
         html.Br(),
@@ -178,22 +242,7 @@ app.layout = html.Div(
                 ],align="start",
                 ),
             dbc.Row([
-                dcc.Dropdown(id='ETsoil', options=[{'label': 'ETET000010(AWAS,L)', 'value': 'ETET000010'},
-                                                    {'label': 'ETET000_10(AWAS,L, shallow)', 'value': 'ETET000_10'},
-                                                    {'label': 'ETET000011(BAKO,C)', 'value': 'ETET000011'},
-                                                    {'label': 'ETET001_11(BAKO,C,shallow)', 'value': 'ETET001_11'},
-                                                    {'label': 'ETET000018(MELK,L)', 'value': 'ETET000018'},
-                                                    {'label': 'ETET001_18(MELK,L,shallow)', 'value': 'ETET001_18'},
-                                                    {'label': 'ETET000015(KULU,C)', 'value': 'ETET000015'},
-                                                    {'label': 'ETET001_15(KULU,C,shallow)', 'value': 'ETET001_15'},
-                                                    {'label': 'ET00990066(MAHO,C)', 'value': 'ET00990066'},
-                                                    {'label': 'ET00990_66(MAHO,C,shallow)', 'value': 'ET00990_66'},
-                                                    {'label': 'ET00920067(KOBO,CL)', 'value': 'ET00920067'},
-                                                    {'label': 'ET00920_67(KOBO,CL,shallow)', 'value': 'ET00920_67'},
-                                                    {'label': 'ETET000022(MIES, C)', 'value': 'ETET000022'},
-                                                    {'label': 'ETET001_22(MIES, C, shallow', 'value': 'ETET001_22'},
-                                                    ], 
-                            value='ETET001_18'),
+                dcc.Dropdown(id='ETsoil', options=[], value='ETET001_18'),  #options: serve_layout
                 ],align="start",
                 ),
             # ],style={'columnCount': 2}),
@@ -386,6 +435,7 @@ app.layout = html.Div(
         html.Div([
             html.Button(id='write-button-state', n_clicks=0, children='Create or Add a new Scenario', 
                 style={"width": "50%",'background-color': '#4CAF50'}),  #https://www.w3schools.com/css/css3_buttons.asp
+            html.Div(id='sce-warning', style={'color': 'red'}),
         ],),
         html.Br(),   
         # Deletable summary table : EJ(5/3/2021)
@@ -401,31 +451,67 @@ app.layout = html.Div(
                 row_deletable=True) 
                 # fill_width=False, editable=True)
                 ],id='sce-table-Comp', style={"width": "100%",'display': 'block'},), # 'display': 'block', 'none'
+        html.Div(id='presim-status'),  #scenarios simulated in the background since they were added
+        dcc.Interval(id='presim-interval', interval=5000, disabled=True),  #polls the pre-simulation jobs while they run
         html.Br(),
         # end of Deletable summary table : EJ(5/3/2021)
 
+        html.Br(),
+        #seasonal forecast (optional): tercile probabilities of the season rainfall => forecast ensemble of each scenario
+        html.Div([
+            html.Div([
+                html.Span("Seasonal forecast (optional): "),
+                dcc.RadioItems(id='fcst-radio', options=[{'label': 'Off', 'value': 'off'}, {'label': 'On', 'value': 'on'}],
+                    value='off', labelStyle={'display': 'inline-block', 'margin-right': '10px'}),
+            ],),
+            html.Div([
+                html.Span("Season: "),
+                dcc.Dropdown(id='fcst-season', options=[{'label': s, 'value': s} for s in forecast.SEASONS],
+                    value='JJA', clearable=False, style={"width": "120px", 'display': 'inline-block', 'vertical-align': 'middle'}),
+                html.Span(" Below normal [%]: "),
+                dcc.Input(id='fcst-below', type='number', value=33, min=0, max=100, style={"width": "70px"}),
+                html.Span(" Near normal [%]: "),
+                dcc.Input(id='fcst-normal', type='number', value=34, min=0, max=100, style={"width": "70px"}),
+                html.Span(" Above normal [%]: "),
+                dcc.Input(id='fcst-above', type='number', value=33, min=0, max=100, style={"width": "70px"}),
+                html.Span(" Realizations: "),
+                dcc.Input(id='fcst-members', type='number', value=forecast.N_MEMBERS, min=10, max=forecast.MAX_MEMBERS,
+                    step=10, style={"width": "90px"}),
+            ],),
+        ],),
         html.Br(),
         html.Div([
             html.Button(id='simulate-button-state', children='Simulate all scenarios (Run DSSAT)',style={"width": "50%",'background-color': '#008CBA'}), #blue
         ],),
         html.Br(),
         # dbc.Progress("25%", value=25),
-        # dbc.Progress(id="progress"),
+        dcc.Store(id='sim-job-id'),  #ID of the background simulation job
+        dcc.Interval(id='sim-interval', interval=1000, disabled=True),  #to poll the status of the simulation job
+        html.Div(id='sim-status'),
+        dbc.Progress(id="sim-progress", value=0, striped=True, animated=True, style={"width": "50%"}),
        # dbc.Spinner(children=[dcc.Graph(id = 'yield_boxplot')],size='lg',color='primary',type='border'),
         #dcc.Graph(id='yield_boxplot'),
         #EJ(4/17/2021)example:https://github.com/Coding-with-Adam/Dash-by-Plotly/blob/master/DataTable/datatable_intro_and_sort.py
-        dbc.Spinner(children=[html.Div(id='yieldbox-container')], size="lg", color="primary", type="border", fullscreen=True,),
-        # html.Div(id='yieldbox-container'),  #boxplot
+        # dbc.Spinner(children=[html.Div(id='yieldbox-container')], size="lg", color="primary", type="border", fullscreen=True,),
+        html.Div(id='yieldbox-container'),  #boxplot
         html.Div(id='yieldcdf-container'),  #exceedance curve
         html.Div(id='yieldtimeseries-container'),  #time-series
         html.Br(),
         html.Button("Download CSV file for Simulated Yield", id="btn_csv"),
         # dcc.Download(id="download-dataframe-csv"),
         Download(id="download-dataframe-csv"),
-        html.Div(id='yieldtables-container', style = {'width': '50%'}),  #yield simulated output
+        html.Div([  #yield simulated output (rows sent one page at a time from the session store)
+            dash_table.DataTable(id='yield-table', page_action='custom', page_current=0, page_size=TABLE_PAGE_SIZE, page_count=0,
+                style_table={'overflowX': 'auto'},
+                style_cell={   # all three widths are needed
+                    'minWidth': '10px', 'width': '10px', 'maxWidth': '30px',
+                    'overflow': 'hidden',
+                    'textOverflow': 'ellipsis', }),
+            ],id='yieldtables-container', style = {'width': '50%'}),
         html.Br(),
         html.Div([
             html.Button(id='EB-button-state', children='Display figures for Enterprise Budgets',style={"width": "50%",'background-color': '#f44336'}), #red
+            html.Div(id='EB-status'),
         ],),
         html.Br(),
         html.Div(id='EBbox-container'), 
@@ -435,9 +521,128 @@ app.layout = html.Div(
         html.Button("Download CSV file for Enterprise Budgeting", id="btn_csv_EB"),
         # dcc.Download(id="download-dataframe-csv"),
         Download(id="download-dataframe-csv_EB"),
-        html.Div(id='EBtables-container', style = {'width': '50%'}),   #yield simulated output
+        html.Div([  #gross margin output (rows sent one page at a time from the session store)
+            dash_table.DataTable(id='EB-result-table', page_action='custom', page_current=0, page_size=TABLE_PAGE_SIZE, page_count=0,
+                style_cell={'whiteSpace': 'normal','height': 'auto',},),
+            ],id='EBtables-container', style = {'width': '50%'}),
+        html.Br(),
+        # Factorial sweep (planting date x density x N rate x cultivar) => response surfaces
+        html.Div([
+            dbc.Row([
+                html.Span("14) Factorial sweep (response surfaces)", className="uppercase bold"),
+                ],align="start",
+                ),
+            dbc.Row([
+                html.Span("*Note: crop, station, years, soil, initial conditions, target year and budget come from 1)-13). N is applied at planting (0 => no fertilizer)"),
+                ],align="start",
+                ),
+            html.Span("Planting dates from "),
+            dcc.DatePickerSingle(id='sweep-plt-first', min_date_allowed=date(2021, 1, 1), max_date_allowed=date(2021, 12, 31),
+                                 initial_visible_month=date(2021, 6, 1), date=date(2021, 6, 1)),
+            html.Span("  to "),
+            dcc.DatePickerSingle(id='sweep-plt-last', min_date_allowed=date(2021, 1, 1), max_date_allowed=date(2021, 12, 31),
+                                 initial_visible_month=date(2021, 7, 1), date=date(2021, 7, 15)),
+            html.Span("  every [days] "),
+            dcc.Input(id="sweep-plt-step", type="number", min=1, value=5),
+            html.Br(),
+            html.Span("Planting densities [plants / m2] "),
+            dcc.Input(id="sweep-density", type="text", value='4,6,8'),
+            html.Span("  N rates [N kg/ha] "),
+            dcc.Input(id="sweep-nrate", type="text", value='0,30,60,90'),
+            html.Br(),
+            html.Span("Cultivars"),
+            dcc.Dropdown(id='sweep-cultivars', options=[{'label': i, 'value': i} for i in cultivar_options['MZ']],
+                         value=[cultivar_options['MZ'][0]], multi=True),
+            html.Br(),
+            html.Button(id='sweep-button', children='Run factorial sweep (Run DSSAT)',style={"width": "50%",'background-color': '#008CBA'}),
+            dcc.Store(id='sweep-job-id'),  #ID of the background sweep job
+            dcc.Interval(id='sweep-interval', interval=1000, disabled=True),
+            dcc.Store(id='sweep-summary'),  #median yield/gross margin of each scenario of the grid
+            html.Div(id='sweep-status'),
+            dbc.Progress(id="sweep-progress", value=0, striped=True, animated=True, style={"width": "50%"}),
+            dcc.RadioItems(id='sweep-metric',
+                options=[{'label': 'Median yield [kg/ha]', 'value': 'HWAM'},
+                         {'label': 'Median gross margin [Birr/ha]', 'value': 'GMargin'},],
+                labelStyle = {'display': 'inline-block','margin-right': 10},
+                value='HWAM'),
+            dcc.Dropdown(id='sweep-cultivar-view', placeholder='Cultivar to display'),
+            html.Div(id='sweep-heatmap-container'),  #heatmaps: planting date x N rate, one per density
+            html.Div(id='sweep-curve-container'),  #response curves
+            ],style={"width": "80%"},),
+        html.Br(),
+        # Daily dynamics (LAI, biomass, soil water, stresses) of one scenario over all simulated years
+        html.Div([
+            dbc.Row([
+                html.Span("15) Daily dynamics of a scenario", className="uppercase bold"),
+                ],align="start",
+                ),
+            dcc.Dropdown(id='daily-scenario', placeholder='Scenario name'),
+            dcc.Dropdown(id='daily-var', options=[{'label': v[1], 'value': k} for k, v in DAILY_VARS.items()], value='LAID'),
+            html.Button(id='daily-button', children='Display daily dynamics',style={"width": "50%",'background-color': '#008CBA'}),
+            html.Div(id='daily-status'),
+            html.Div(id='daily-container'),
+            ],style={"width": "80%"},),
+        html.Br(),
+        # Archive of all simulated results (all sessions, sweeps and pre-simulations): filter and aggregate
+        html.Div([
+            dbc.Row([
+                html.Span("16) Archive of simulated results", className="uppercase bold"),
+                ],align="start",
+                ),
+            dbc.Row([
+                html.Span("*Note: every scenario simulated by any user is archived. Empty filters => all values"),
+                ],align="start",
+                ),
+            dcc.Dropdown(id='archive-crop', options=[{'label': k, 'value': k} for k in cultivar_options.keys()],
+                         multi=True, placeholder='Crops'),
+            dcc.Dropdown(id='archive-station', options=station_options, multi=True, placeholder='Stations'),
+            dcc.Dropdown(id='archive-soil', options=[], multi=True, placeholder='Soils'),  #options: serve_layout
+            html.Span("Years from "),
+            dcc.Input(id="archive-first-year", type="number", min=1900, max=2100, value=1981),
+            html.Span("  to "),
+            dcc.Input(id="archive-last-year", type="number", min=1900, max=2100, value=2018),
+            dcc.Dropdown(id='archive-group-by', options=[{'label': v, 'value': k} for k, v in ARCHIVE_GROUPS.items()],
+                         value=['stn_name', 'soil'], multi=True, placeholder='Group by'),
+            dcc.RadioItems(id='archive-metric',
+                options=[{'label': 'Yield [kg/ha]', 'value': 'HWAM'},
+                         {'label': 'Gross margin [Birr/ha]', 'value': 'GMargin'},],
+                labelStyle = {'display': 'inline-block','margin-right': 10},
+                value='HWAM'),
+            html.Button(id='archive-button', children='Query the archive',style={"width": "50%",'background-color': '#008CBA'}),
+            html.Div(id='archive-status'),
+            dash_table.DataTable(id='archive-table', page_size=TABLE_PAGE_SIZE, style_table={'overflowX': 'auto'}),
+            html.Div(id='archive-container'),
+            ],style={"width": "80%"},),
+        html.Br(),
+        # Season climate (planting to maturity) of each simulated year next to the yields
+        html.Div([
+            dbc.Row([
+                html.Span("17) Season climate of the simulated years", className="uppercase bold"),
+                ],align="start",
+                ),
+            dbc.Row([
+                html.Span("*Note: weather from planting to maturity of each year (Simulate all scenarios first). Table => correlation of yield with each variable"),
+                ],align="start",
+                ),
+            dcc.Dropdown(id='climate-var', options=[{'label': v, 'value': k} for k, v in season_climate.VARS.items()],
+                         value='RAIN', clearable=False),
+            html.Button(id='climate-button', children='Display season climate',style={"width": "50%",'background-color': '#008CBA'}),
+            html.Div(id='climate-status'),
+            dash_table.DataTable(id='climate-table', style_table={'overflowX': 'auto'}),
+            html.Div(id='climate-container'),
+            ],style={"width": "80%"},),
         html.Br()
     ])
+
+def serve_layout():
+    #new session id for each page load => key of the results of this browser session in the session store
+    #soil options from the catalog at each page load (reloaded when ET.SOL changes)
+    soil_options = soil_catalog.get_catalog(path.join(Wdir_path, "ET.SOL")).dropdown_options()
+    for dropdown_id in ('ETsoil', 'archive-soil'):
+        main_layout[dropdown_id].options = soil_options
+    return html.Div([dcc.Store(id='session-id', data=session_store.new_session_id()), main_layout])
+
+app.layout = serve_layout
 #==============================================================
 #Dynamic call back for different cultivars for a selected target crop
 @app.callback(
@@ -446,6 +651,14 @@ app.layout = html.Div(
 def set_cultivar_options(selected_crop):
     return [{'label': i, 'value': i} for i in cultivar_options[selected_crop]]
 
+@app.callback(
+    Output('sweep-cultivars', 'options'),
+    Output('sweep-cultivars', 'value'),
+    Input('crop-radio', 'value'))
+def set_sweep_cultivar_options(selected_crop):
+    options = [{'label': i, 'value': i} for i in cultivar_options[selected_crop]]
+    return options, [options[0]['value']]
+
 @app.callback(
     Output('cultivar-dropdown', 'value'),
     Input('cultivar-dropdown', 'options'))
@@ -456,12 +669,13 @@ def set_cultivar_value(available_options):
 @app.callback(
     Output("download-dataframe-csv", "data"),
     Input("btn_csv", "n_clicks"),
-    State('memory-yield-table', 'data'),
+    State('session-id', 'data'),
     prevent_initial_call=True,
 )
-def func(n_clicks, yield_data):
-    # print(yield_data)
-    df =pd.DataFrame(yield_data)
+def func(n_clicks, session_id):
+    df = sessions.get(session_id, 'yield_table')
+    if df is None:  #not simulated yet, or session expired
+        raise PreventUpdate
     return dcc.send_data_frame(df.to_csv, "simulated_yield.csv")
 #=================================================    
 #==============================================================
@@ -469,14 +683,38 @@ def func(n_clicks, yield_data):
 @app.callback(
     Output("download-dataframe-csv_EB", "data"),
     Input("btn_csv_EB", "n_clicks"),
-    State('memory-EB-table', 'data'),
+    State('session-id', 'data'),
     prevent_initial_call=True,
 )
-def func(n_clicks, EB_data):
-    # print(EB_data)
-    df =pd.DataFrame(EB_data)
+def func(n_clicks, session_id):
+    df = sessions.get(session_id, 'EB_table')
+    if df is None:
+        raise PreventUpdate
     return dcc.send_data_frame(df.to_csv, "simulated_yield_EB.csv")
-#=================================================   
+#=================================================
+#call backs to send one page of the yield/EB tables kept in the session store
+def table_page(session_id, name, page_current, page_size):
+    df = sessions.get(session_id, name)
+    if df is None:
+        raise PreventUpdate
+    return df.iloc[page_current*page_size:(page_current+1)*page_size].to_dict('records')
+
+@app.callback(Output('yield-table', 'data'),
+              Input('yield-table', 'page_current'),
+              Input('yield-table', 'page_size'),
+              State('session-id', 'data'))
+@run_metrics.timed_callback
+def yield_table_page(page_current, page_size, session_id):
+    return table_page(session_id, 'yield_table', page_current, page_size)
+
+@app.callback(Output('EB-result-table', 'data'),
+              Input('EB-result-table', 'page_current'),
+              Input('EB-result-table', 'page_size'),
+              State('session-id', 'data'))
+@run_metrics.timed_callback
+def EB_table_page(page_current, page_size, session_id):
+    return table_page(session_id, 'EB_table', page_current, page_size)
+#=================================================
 #call back to "show/hide" fertilizer input table
 @app.callback(Output('fert-table-Comp', component_property='style'),
               Input('fert_input', component_property='value'))
@@ -496,6 +734,7 @@ def show_hide_EBtable(visibility_state):
         return {"width": "80%",'display': 'none'} #'display': 'none'} 
 #==============================================================
 @app.callback(Output('scenario-table', 'data'),
+                Output('sce-warning', 'children'),
                 # Output('intermediate-value', 'children'),
                 Input('write-button-state', 'n_clicks'),
                 State('ETstation', 'value'),  #input 1
@@ -518,6 +757,7 @@ def show_hide_EBtable(visibility_state):
                 State('EB-table','data'), #Input 16 Enterprise budget input
                 State('scenario-table','data') ###input 17 scenario summary table
             )
+@run_metrics.timed_callback
 def make_sce_table(n_clicks, input1,input2,input3,input4,input50,input5,input6,input7,input8,input9,input10,
                   input11, fert_app, fert_in_table, EB_radio, EB_in_table, sce_in_table):
     # print(input1)  #MELK
@@ -536,6 +776,21 @@ def make_sce_table(n_clicks, input1,input2,input3,input4,input50,input5,input6,i
     # print(input14)  #fertilizler summary
     # print('input15:',EB_in_table)  #scenario summary
 
+    # 1) Check that weather data are available for the years to simulate (instead of a DSSAT crash later)
+    if n_clicks:
+        try:
+            missing_years = weather.missing_years(input1, input2, input3)
+        except (KeyError, ValueError) as e:
+            return sce_in_table, 'Scenario not added: {}'.format(e)
+        if missing_years:
+            return sce_in_table, 'Scenario not added: no weather data for {} in {}'.format(input1, ', '.join(map(str, missing_years)))
+        #scenario names give the names of the DSSAT files (ET<crop><name>.SNX) => max. 4 characters, unique by crop
+        rows = [row for row in (sce_in_table or []) if row.get('Crop') in cultivar_options] if n_clicks > 1 else []
+        try:
+            dssat_runner.check_names([row['Crop'] for row in rows] + [input50], [row['sce_name'] for row in rows] + [input10])
+        except ValueError as e:
+            return sce_in_table, 'Scenario not added: {}'.format(e)
+
     # 2) Read fertilizer application information
     if fert_app == 'Fert':
         # print('fert-table in callback make_sce_table= {}'.format(fert_in_table))
@@ -569,11 +824,6 @@ def make_sce_table(n_clicks, input1,input2,input3,input4,input50,input5,input6,i
     dff = df.copy()
 
     if n_clicks:  
-        #=====================================================================
-        #1) Write SNX file
-        writeSNX_main_hist(Wdir_path,input1,input2,input3,input4,input50, input5,input6,input7,input8,
-                           input9,input10,fert_app, df_fert)
-        #=====================================================================
         # #Make a new dataframe for fertilizer inputs
         if fert_app == 'Fert' and EB_radio == 'EB_Yes':
             #Make a new dataframe
@@ -615,7 +865,6 @@ def make_sce_table(n_clicks, input1,input2,input3,input4,input50,input5,input6,i
                         'CropPrice', 'NFertCost', 'SeedCost','OtherVariableCosts','FixedCosts'],)           
         data = df.to_dict('rows')
         # columns =  [{"name": i, "id": i,} for i in (df.columns)]
-
     if n_clicks == 1:
         dff = df.copy()
         data = dff.to_dict('rows')
@@ -626,594 +875,599 @@ def make_sce_table(n_clicks, input1,input2,input3,input4,input50,input5,input6,i
         dff = dff.append(df, ignore_index=True)
         data = dff.to_dict('rows')
     # print(data)
-    return data
+    return data, ''
     # return dash_table.DataTable(data=data, columns=columns,row_deletable=True), dff.to_json(date_format='iso', orient='split')
 
+#===============================
+#Speculative pre-simulation: each scenario in the table is queued for a background run as soon as it is added (or edited)
+#and the result is kept in sim_cache => "Simulate all scenarios" mostly collects finished results
+#a scenario deleted from the table before its run starts is cancelled
+#presim-interval keeps the jobs polled while they run (jobs of a closed browser session are abandoned)
+@app.callback(Output('presim-status', 'children'),
+              Output('presim-interval', 'disabled'),
+              Input('scenario-table', 'data'),
+              Input('presim-interval', 'n_intervals'),
+              State('session-id', 'data'))
+def presimulate_scenarios(sce_in_table, n_intervals, session_id):
+    pending = sessions.get(session_id, 'presim_jobs') or {}  #scenario key => job ID
+    if not dash.callback_context.triggered[0]['prop_id'].startswith('presim-interval'):
+        pending = submit_presimulations(sce_in_table, session_id, pending)
+    n_running = sum(1 for job_id in pending.values()
+                    if getattr(presim_queue.get(job_id), 'state', None) in ('queued', 'running'))
+    return ('Simulating {} scenario(s) in the background'.format(n_running) if n_running else ''), n_running == 0
+
+def submit_presimulations(sce_in_table, session_id, pending):
+    rows = [row for row in (sce_in_table or []) if row.get('Crop') in cultivar_options]  #not the 'N/A' placeholder row
+    keys = []
+    for row in rows:
+        try:
+            keys.append(result_cache.scenario_key(Wdir_path, row))
+        except (KeyError, ValueError, TypeError):
+            keys.append(None)
+    for key, job_id in list(pending.items()):
+        if key not in keys:  #row deleted or edited => not run, or its DSSAT run killed
+            presim_queue.stop(job_id)
+            del pending[key]
+    for row, key in zip(rows, keys):
+        if key is not None and key not in pending and stored_result(row, key) is None:
+            pending[key] = presim_queue.submit(presimulate, row, key, session_id, n_total=1)
+    sessions.put(session_id, 'presim_jobs', pending)
+    return pending
+
+def presimulate(job, row, key, session_id):
+    #run one scenario in a temporary directory of the session workspace => sim_cache
+    if stored_result(row, key) is not None:
+        return
+    workspaces.check_quota(session_id)
+    run_dir = tempfile.mkdtemp(prefix='presim_', dir=workspaces.get(session_id))
+    try:
+        with job_token(job) as token:
+            fout_names = dssat_runner.run_scenarios(Wdir_path, pd.DataFrame([row]), n_workers=1,
+                                                    snx_texts=[render_SNX(row)], out_dir=run_dir, token=token)
+        sim_result = read_OSU(fout_names[0], row)
+        sim_cache.put(key, sim_result)
+        archive_results(pd.DataFrame([row]), [sim_result], [key])
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+def stored_result(row, key):
+    #results of a scenario simulated before (cache) or precomputed (yield atlas), None => DSSAT run needed
+    sim_result = sim_cache.get(key)
+    if sim_result is None:
+        with run_metrics.timed('atlas_lookup', **scenario_labels(row)):
+            sim_result = atlas.lookup(Wdir_path, row)
+    return sim_result
+
+def job_token(job):
+    #cancellation of the DSSAT runs of a job (any process) when the job is stopped
+    token = dssat_governor.Token(job.job_id)
+    job.on_stop(token.cancel)
+    return token
+
+def job_message(job, name):
+    #status of a queued/running job: position in the job queue, or in the queue of the DSSAT runs of the host
+    if job.state == 'queued':
+        return '{} queued: position {} (job {})'.format(name, sim_queue.position(job.job_id) or 1, job.job_id[:8])
+    position = dssat_governor.queue_position(job.job_id)
+    if position is not None:
+        return '{} waiting for a free DSSAT slot: position {} in the queue, {}/{} scenarios done'.format(
+            name, position, job.n_done, job.n_total)
+    return '{} {}: {}/{} scenarios done'.format(name, job.state, job.n_done, job.n_total)
+
+def archive_results(dff, sim_results, keys):
+    #new DSSAT runs => results archive (an archive error never fails the simulation)
+    try:
+        archive.append(dff, sim_results, keys)
+    except (OSError, ValueError) as e:
+        print('WARNING: results not archived:', e)
+
+def collect_presimulated(session_id, sce_keys):
+    #background runs of these scenarios: queued ones are cancelled (they are run with the others), running ones are
+    #awaited for at most PRESIM_WAIT_S in all, then stopped (a slow or hung run does not hold up the simulation)
+    pending = sessions.get(session_id, 'presim_jobs') or {}
+    deadline = time.time() + PRESIM_WAIT_S
+    for key in sce_keys:
+        if key in pending and not presim_queue.cancel(pending[key]):
+            job = presim_queue.get(pending[key])
+            if job is not None and not job.wait(max(deadline - time.time(), 0)):
+                presim_queue.stop(pending[key])
+
 #===============================
 #2nd callback to run ALL scenarios
+# - "Simulate all scenarios" => submit a background job and start polling
+# - sim-interval => status of the job; figures when the job is done
 @app.callback(Output(component_id='yieldbox-container', component_property='children'),
                 Output(component_id='yieldcdf-container', component_property='children'),
                 Output(component_id='yieldtimeseries-container', component_property='children'),
-                Output(component_id='yieldtables-container', component_property='children'),
-                Output('memory-yield-table', 'data'),
+                Output('yield-table', 'columns'),
+                Output('yield-table', 'page_current'),
+                Output('yield-table', 'page_count'),
+                Output('sim-job-id', 'data'),
+                Output('sim-interval', 'disabled'),
+                Output('sim-status', 'children'),
+                Output('sim-progress', 'value'),
                 Input('simulate-button-state', 'n_clicks'),
+                Input('sim-interval', 'n_intervals'),
                 # State('target-year', 'value'),       #input 11
                 # State('intermediate-value', 'children') #scenario summary table
-                State('scenario-table','data') ### scenario summary table
+                State('scenario-table','data'), ### scenario summary table
+                State('sim-job-id', 'data'),
+                State('session-id', 'data'),
+                State('fcst-radio', 'value'),  #seasonal forecast (optional)
+                State('fcst-season', 'value'),
+                State('fcst-below', 'value'),
+                State('fcst-normal', 'value'),
+                State('fcst-above', 'value'),
+                State('fcst-members', 'value')
               )
 
-def run_create_figure(n_clicks, sce_in_table):
+@run_metrics.timed_callback
+def run_create_figure(n_clicks, n_intervals, sce_in_table, job_id, session_id,
+                      fcst_radio, fcst_season, fcst_below, fcst_normal, fcst_above, fcst_members):
     if n_clicks is None:
         raise PreventUpdate
         return 
-    else: 
-        # 1) Read saved scenario summaries and get a list of scenarios to run
-        # dff = pd.read_json(intermediate, orient='split')
-        dff = pd.DataFrame(sce_in_table)  #read dash_table.DataTable into pd df #J(5/3/2021)
-        print(dff)
-        sce_numbers = len(dff.sce_name.values)
-        Wdir_path = 'C:\\IRI\\Python_Dash\\ET_DSS_hist\\TEST\\'
-        TG_yield = []
-
-        #EJ(5/3/2021) run DSSAT for each scenarios with individual V47
-        for i in range(sce_numbers):
-            # 2) Write V47 file
-            if dff.Crop[i] == 'WH':
-                temp_dv7 = path.join(Wdir_path, "DSSBatch_template_WH.V47")
-            elif dff.Crop[i] == 'MZ':
-                temp_dv7 = path.join(Wdir_path, "DSSBatch_template_MZ.V47")
-            else:  # SG
-                temp_dv7 = path.join(Wdir_path, "DSSBatch_template_SG.V47")
-
-            dv7_fname = path.join(Wdir_path, "DSSBatch.V47")
-            fr = open(temp_dv7, "r")  # opens temp DV4 file to read
-            fw = open(dv7_fname, "w")
-            # read template and write lines
-            for line in range(0, 10):
-                temp_str = fr.readline()
-                fw.write(temp_str)
-
-            temp_str = fr.readline()
-            sname = dff.sce_name.values[i]
-            # SNX_fname = path.join(Wdir_path, "ETMZ"+sname+".SNX")
-            if dff.Crop[i] == 'WH':
-                SNX_fname = path.join(Wdir_path, "ETWH"+sname+".SNX")
-            elif dff.Crop[i] == 'MZ':
-                SNX_fname = path.join(Wdir_path, "ETMZ"+sname+".SNX")
-            else:  # SG
-                SNX_fname = path.join(Wdir_path, "ETSG"+sname+".SNX")
-
-            SNX_fname = SNX_fname.replace("/", "\\")
-            new_str2 = '{0:<95}{1:4s}'.format(SNX_fname, repr(1).rjust(4)) + temp_str[99:]
-            fw.write(new_str2)
-            fr.close()
-            fw.close()
-            #=====================================================================
-            #3) Run DSSAT executable
-            os.chdir(Wdir_path)  #change directory  #check if needed or not
-            if dff.Crop[i] == 'WH':
-                args = "DSCSM047.EXE CSCER047 B DSSBatch.v47"
-                fout_name = path.join(Wdir_path, "ETWH"+sname+".OSU")
-            elif dff.Crop[i] == 'MZ':
-                args = "DSCSM047.EXE MZCER047 B DSSBatch.v47"
-                fout_name = path.join(Wdir_path, "ETMZ"+sname+".OSU")
-            else:  # SG
-                args = "DSCSM047.EXE SGCER047 B DSSBatch.v47"
-                fout_name = path.join(Wdir_path, "ETSG"+sname+".OSU")
-            subprocess.call(args) ##Run executable with argument  , stdout=FNULL, stderr=FNULL, shell=False)
-
-            #4) read DSSAT output => Read Summary.out from all scenario output
-            # fout_name = path.join(Wdir_path, "SUMMARY.OUT")
-            df_OUT=pd.read_csv(fout_name,delim_whitespace=True ,skiprows=3)
-            HWAM = df_OUT.iloc[:,20].values  #read 21th column only
-            EXPERIMENT = df_OUT.iloc[:,7].values  #read 4th column only
-            PDAT = df_OUT.iloc[:,13].values  #read 14th column only
-            ADAT = df_OUT.iloc[:,15].values  #read 14th column only
-            MDAT = df_OUT.iloc[:,16].values  #read 14th column only    
-            YEAR = df_OUT.iloc[:,13].values//1000
-            if int(dff.TargetYr[i]) <= int(dff.LastYear[i]):
-                doy = repr(PDAT[0])[4:]
-                target = dff.TargetYr[i] + doy
-                yr_index = np.argwhere(PDAT == int(target))
-                # print('target year:', int(dff.TargetYr[i]) )
-                # print('last sim year:', int(dff.LastYear[i]))
-                # print('PDAT:', PDAT)
-                # print('target:', target)
-                # print('yr_index:', yr_index[0][0])
-                TG_yield_temp = HWAM[yr_index[0][0]]
-            else: 
-                TG_yield_temp = np.nan
-
-            # Make a new dataframe for plotting
-            df1 = pd.DataFrame({'EXPERIMENT':EXPERIMENT})
-            df2 = pd.DataFrame({'PDAT':PDAT})
-            df3 = pd.DataFrame({'ADAT':ADAT})
-            df4 = pd.DataFrame({'HWAM':HWAM})
-            df5 = pd.DataFrame({'YEAR':YEAR})
-            temp_df = pd.concat([df1.EXPERIMENT,df5.YEAR, df2.PDAT, df3.ADAT, df4.HWAM], axis=1)
-            if i==0:
-                df = temp_df.copy()
-            else:
-                df = df.append(temp_df, ignore_index=True)
-                
-            TG_yield.append(TG_yield_temp)
-
-        x_val = np.unique(df.EXPERIMENT.values)
-        # print(df)
-        # print('x_val={}'.format(x_val))
-        #4) Make a boxplot
-        # df = px.data.tips()
-        # fig = px.box(df, x="time", y="total_bill")
-        # fig.show()s
-        # fig.update_layout(transition_duration=500)
-        # df = px.data.tips()
-        # fig = px.box(df, x="Scenario Name", y="Yield [kg/ha]")
-        fig = px.box(df, x="EXPERIMENT", y="HWAM", title='Yield Boxplot')
-        fig.add_scatter(x=x_val,y=TG_yield, mode='markers') #, mode='lines+markers') #'lines')
-        fig.update_xaxes(title= 'Scenario Name [*Note:Red dot(s) represents yield(s) based on the weather of target year]')
-        fig.update_yaxes(title= 'Yield [kg/ha]')
-        # # return fig
-
-        fig2 = go.Figure()
-        for i in x_val:
-            x_data = df.HWAM[df['EXPERIMENT']==i].values
-            x_data = np.sort(x_data)
-            fx_scf = [1.0/len(x_data)] * len(x_data) #pdf
-            Fx_scf= 1.0-np.cumsum(fx_scf)  #for exceedance curve
-
-            fig2.add_trace(go.Scatter(x=x_data, y=Fx_scf,
-                        mode='lines+markers',
-                        name=i))
-        # Edit the layout
-        fig2.update_layout(title='Yield Exceedance Curve',
-                        xaxis_title='Yield [kg/ha]',
-                        yaxis_title='Probability of Exceedance [-]')
-        # fig3.update_yaxes(title= 'Probability of Exceedance [-]')
-        # fig3.update_xaxes(title= 'Yield [kg/ha]')
-
-        # fig3 = px.line(df, x="YEAR", y="HWAM", color='EXPERIMENT', title='Yield Time-series')
-        # fig3.update_xaxes(title= 'Year')
-        # fig3.update_yaxes(title= 'Yield [kg/ha]')
-
-        #make a new dataframe to save into CSV
-        yr_val = np.unique(df.YEAR.values)
-        df_out = pd.DataFrame({'YEAR':yr_val})
-
-        fig3 = go.Figure()
-        for i in x_val:
-            x_data = df.YEAR[df['EXPERIMENT']==i].values
-            y_data = df.HWAM[df['EXPERIMENT']==i].values
-
-            ##make a new dataframe to save into CSV
-            df_temp = pd.DataFrame({i:y_data})
-            df_out = pd.concat([df_out, df_temp], axis=1)
-
-            fig3.add_trace(go.Scatter(x=x_data, y=y_data,
-                        mode='lines+markers',
-                        name=i))
-        # Edit the layout
-        fig3.update_layout(title='Yield Time-Series',
-                        xaxis_title='Year',
-                        yaxis_title='Yield [kg/ha]')
-        #save simulated yield outputs into a csv file <<<<<<=======================
-        fname = path.join(Wdir_path, "simulated_yield.csv")
-        df_out.to_csv(fname, index=False)
+    no_figures = [dash.no_update] * 6
+    trigger = dash.callback_context.triggered[0]['prop_id']
+    if trigger.startswith('simulate-button-state'):
+        fcst = None
+        if fcst_radio == 'on':
+            try:
+                fcst = forecast.parse_forecast(fcst_season, fcst_below, fcst_normal, fcst_above, fcst_members)
+            except ValueError as e:
+                return no_figures + [dash.no_update, True, 'Simulation not started: {}'.format(e), 0]
+        if job_id is not None:  #previous simulation of this browser session => not needed anymore
+            sim_queue.stop(job_id)
+        job_id = sim_queue.submit(simulate_create_figure, sce_in_table, session_id, fcst, n_total=len(sce_in_table))
+        return no_figures + [job_id, False, 'Simulation queued (job {})'.format(job_id[:8]), 0]
+
+    job = sim_queue.get(job_id)
+    if job is None:  #e.g., job submitted to another worker process
+        return no_figures + [dash.no_update, True, 'Simulation job not found, please simulate again', 0]
+    progress = 100 * job.n_done // max(job.n_total, 1)
+    if job.state == 'failed':
+        return no_figures + [dash.no_update, True, 'Simulation failed: ' + job.error, 0]
+    if job.state == 'cancelled':
+        return no_figures + [dash.no_update, True, 'Simulation cancelled', 0]
+    if job.state != 'done':
+        return no_figures + [dash.no_update, False, job_message(job, 'Simulation'), progress]
+    return job.result + [dash.no_update, True, 'Simulation done: {} scenarios'.format(job.n_total), 100]
+
+def simulate_create_figure(job, sce_in_table, session_id, fcst=None):
+    # 1) Read saved scenario summaries and get a list of scenarios to run
+    # dff = pd.read_json(intermediate, orient='split')
+    dff = pd.DataFrame(sce_in_table)  #read dash_table.DataTable into pd df #J(5/3/2021)
+    sce_numbers = len(dff.sce_name.values)
+
+    # 2) Get results of scenarios with the same inputs simulated before (cache) or precomputed (yield atlas)
+    #    => DSSAT runs only for the others
+    sce_keys = [result_cache.scenario_key(Wdir_path, row) for row in dff.to_dict('records')]
+    collect_presimulated(session_id, sce_keys)  #results of the runs started when the scenarios were added
+    sim_results = [stored_result(dff.iloc[i], key) for i, key in enumerate(sce_keys)]
+    idx_run = [i for i in range(sce_numbers) if sim_results[i] is None]
+    #SNX of the scenarios to run rendered in memory (snx_template) => written only where DSSAT runs
+    snx_texts = [render_SNX(dff.iloc[i]) for i in idx_run]
+    n_cached = sce_numbers - len(idx_run)
+    job.set_progress(n_cached)
+    workspaces.check_quota(session_id)  #QuotaExceeded => job failed with the message in sim-status
+    out_dir = workspaces.get(session_id)
+
+    #EJ(5/3/2021) run DSSAT for each scenarios with individual V47
+    # 3) Write V47 file and Run DSSAT executable (one launch per crop in batch mode, or per scenario)
+    with job_token(job) as token:
+        fout_names = dssat_runner.run_scenarios(Wdir_path, dff.iloc[idx_run].reset_index(drop=True), snx_texts=snx_texts,
+                                                out_dir=out_dir, progress=lambda n_done: job.set_progress(n_cached + n_done),
+                                                token=token)
+    for i, fout_name in zip(idx_run, fout_names):
+        #4) read DSSAT output => Read Summary.out from all scenario output
+        sim_results[i] = read_OSU(fout_name, dff.iloc[i])
+        sim_cache.put(sce_keys[i], sim_results[i])
+    archive_results(dff.iloc[idx_run], [sim_results[i] for i in idx_run], [sce_keys[i] for i in idx_run])
+
+    labels = run_metrics.labels_of(dff.Crop, dff.stn_name)
+    stage_t0 = time.perf_counter()
+    #keep simulated results of this session for the enterprise budgets (EB_figure)
+    sim_table = results_store.make_table(dff.sce_name.values, sim_results, OSU_COLS, sce_keys)
+    sessions.put(session_id, 'sim_table', sim_table)
+    sessions.put(session_id, 'sim_keys', {result_cache.scenario_inputs(row): key
+                                          for row, key in zip(dff.to_dict('records'), sce_keys)})
+
+    # Make a new dataframe for plotting (all scenarios at once from the columnar table)
+    isce = sim_table['SCE']  #scenario index of each row
+    x_val = np.array([dssat_runner.exname(c, s) for c, s in zip(dff.Crop, dff.sce_name)])
+    df = pd.DataFrame({'EXPERIMENT': x_val[isce], 'YEAR': sim_table['PDAT']//1000, 'PDAT': sim_table['PDAT'],
+                       'ADAT': sim_table['ADAT'], 'HWAM': sim_table['HWAM']})
+    TG_yield = target_year_values(dff, sim_table, sim_table['HWAM'])
+    run_metrics.record('statistics', time.perf_counter() - stage_t0, scenarios=sce_numbers, **labels)
+    #box plot and exceedance curves: historical yields, or each scenario next to its forecast ensemble
+    box_df, box_isce, box_x, box_target, box_values = df, isce, x_val, TG_yield, sim_table['HWAM']
+    if fcst is not None:
+        with run_metrics.timed('forecast_ensemble', scenarios=sce_numbers, members=fcst['members'], **labels):
+            box_df, box_isce, box_x, box_target, box_values = forecast_view(dff, sim_table, x_val, TG_yield, fcst)
+    stage_t0 = time.perf_counter()
+    #4) Make a boxplot
+    # df = px.data.tips()
+    # fig = px.box(df, x="time", y="total_bill")
+    # fig.show()s
+    # fig.update_layout(transition_duration=500)
+    # df = px.data.tips()
+    # fig = px.box(df, x="Scenario Name", y="Yield [kg/ha]")
+    #raw values, or box statistics + WebGL curves for large results (sim_figures)
+    mode = sim_figures.figure_mode(len(box_df))
+    fig = sim_figures.box_figure(box_df, 'HWAM', box_isce, box_x, box_target, 'Yield Boxplot',
+                                 'Scenario Name [*Note:Red dot(s) represents yield(s) based on the weather of target year]',
+                                 'Yield [kg/ha]', mode)
+    # # return fig
+
+    fig2 = sim_figures.exceedance_figure(box_values, box_isce, box_x, 'Yield Exceedance Curve', 'Yield [kg/ha]', mode)
+    # fig3 = px.line(df, x="YEAR", y="HWAM", color='EXPERIMENT', title='Yield Time-series')
+    # fig3.update_xaxes(title= 'Year')
+    # fig3.update_yaxes(title= 'Yield [kg/ha]')
+
+    #time-series + new dataframe to save into CSV (one column per scenario)
+    fig3, df_out = sim_figures.timeseries_figure(df, 'HWAM', 'Yield Time-Series', 'Yield [kg/ha]', mode)
+    #save simulated yield outputs into a csv file <<<<<<=======================
+    fname = path.join(out_dir, "simulated_yield.csv")
+    df_out.to_csv(fname, index=False)
+    sessions.put(session_id, 'yield_table', df_out)  #for the table pages and the CSV download
+    run_metrics.record('figure_build', time.perf_counter() - stage_t0, scenarios=sce_numbers, mode=mode, **labels)
+
+
+    return [
+        dcc.Graph(id='yield-boxplot',figure=fig), 
+        dcc.Graph(id='yield-exceedance',figure=fig2),
+        dcc.Graph(id='yield-ts',figure=fig3),
+        [{"name": i, "id": i} for i in df_out.columns],
+        0,  #first page => yield_table_page sends the rows
+        -(-len(df_out) // TABLE_PAGE_SIZE)
+        ]
 
+    # return
 
-        return [
-            dcc.Graph(id='yield-boxplot',figure=fig), 
-            dcc.Graph(id='yield-exceedance',figure=fig2),
-            dcc.Graph(id='yield-ts',figure=fig3),
-            dash_table.DataTable(columns=[{"name": i, "id": i} for i in df_out.columns],data=df_out.to_dict('records'),
-                style_table={'overflowX': 'auto'}, 
-                style_cell={   # all three widths are needed
-                    'minWidth': '10px', 'width': '10px', 'maxWidth': '30px',
-                    'overflow': 'hidden',
-                    'textOverflow': 'ellipsis', }),
-            df_out.to_dict('records')
-            ]
+#===============================
+#seasonal forecast: historical yields of scenario i (index 2i) followed by its forecast ensemble (index 2i+1)
+#members = historical years resampled with the tercile weights (forecast.ensemble) => yields of these years
+def forecast_view(dff, sim_table, x_val, target, fcst):
+    rows, member_sce, _ = forecast.ensemble(weather, dff.stn_name.values, sim_table, fcst)
+    isce = np.concatenate([2 * sim_table['SCE'], 2 * member_sce + 1])
+    order = np.argsort(isce, kind='stable')  #px.box => boxes in the order of the rows
+    x_fcst = np.empty(2 * len(x_val), dtype=object)
+    x_fcst[0::2] = x_val
+    x_fcst[1::2] = [x + ' forecast' for x in x_val]
+    values = np.concatenate([sim_table['HWAM'], sim_table['HWAM'][rows]])[order]
+    df_fcst = pd.DataFrame({'EXPERIMENT': x_fcst[isce[order]], 'HWAM': values})
+    target_fcst = np.full(len(x_fcst), np.nan)  #target-year markers only on the historical boxes
+    target_fcst[0::2] = target
+    return df_fcst, isce[order], x_fcst, target_fcst, values
 
-    # return
+#===============================
+#target-year markers shared by the yield and enterprise budget views (figures: sim_figures)
+def session_table(session_id, dff):
+    #rows of the scenarios of dff in the table of the last simulation of the session, matched by their inputs
+    #(no file access), None if one of them was not simulated
+    sim_keys = sessions.get(session_id, 'sim_keys') or {}
+    sce_keys = [sim_keys.get(result_cache.scenario_inputs(row)) for row in dff.to_dict('records')]
+    return results_store.select_scenarios(sessions.get(session_id, 'sim_table'), sce_keys, OSU_COLS)
+
+def target_year_values(dff, sim_table, values):
+    #value of the target year of each scenario (NaN if the target year is after the last simulated year)
+    target = np.where(dff.TargetYr.astype(int) <= dff.LastYear.astype(int), dff.TargetYr.astype(float), np.nan)
+    return sim_stats.target_values(values, sim_table['PDAT']//1000, sim_table['SCE'], target)
 
 #===============================
 #Last callback to create figures for Enterprise budgeting
 @app.callback(Output(component_id='EBbox-container', component_property='children'),
                 Output(component_id='EBcdf-container', component_property='children'),
                 Output(component_id='EBtimeseries-container', component_property='children'),
-                Output(component_id='EBtables-container', component_property='children'),
-                Output('memory-EB-table', 'data'),
+                Output('EB-result-table', 'columns'),
+                Output('EB-result-table', 'page_current'),
+                Output('EB-result-table', 'page_count'),
+                Output('EB-status', 'children'),
                 Input('EB-button-state', 'n_clicks'),
-                State('scenario-table','data') ### scenario summary table
+                State('scenario-table','data'), ### scenario summary table
+                State('session-id', 'data') ### key of the simulated results in the session store
               )
 
-def EB_figure(n_clicks, sce_in_table):
+@run_metrics.timed_callback
+def EB_figure(n_clicks, sce_in_table, session_id):
     if n_clicks is None:
         raise PreventUpdate
         return 
     else: 
         # 1) Read saved scenario summaries and get a list of scenarios to run
         dff = pd.DataFrame(sce_in_table)  #read dash_table.DataTable into pd df #J(5/3/2021)
-        print('Callback EB_figure:', dff)
-        print('Callback EB_figure:', sce_in_table)
         sce_numbers = len(dff.sce_name.values)
-        Wdir_path = 'C:\\IRI\\Python_Dash\\ET_DSS_hist\\TEST\\'
-        os.chdir(Wdir_path)  #change directory  #check if needed or not
-        TG_GMargin = []
 
         #EJ(5/3/2021) Read DSSAT output for each scenarios
-        for i in range(sce_numbers):
-            sname = dff.sce_name.values[i]
-            if dff.Crop[i] == 'WH':
-                fout_name = path.join(Wdir_path, "ETWH"+sname+".OSU")
-            elif dff.Crop[i] == 'MZ':
-                fout_name = path.join(Wdir_path, "ETMZ"+sname+".OSU")
-            else:  # SG
-                fout_name = path.join(Wdir_path, "ETSG"+sname+".OSU")
-
-            #4) read DSSAT output => Read Summary.out from all scenario output
-            df_OUT=pd.read_csv(fout_name,delim_whitespace=True ,skiprows=3)
-            HWAM = df_OUT.iloc[:,20].values  #read 21th column only
-            EXPERIMENT = df_OUT.iloc[:,7].values  #read 4th column only
-            PDAT = df_OUT.iloc[:,13].values  #read 14th column only
-            ADAT = df_OUT.iloc[:,15].values  #read 14th column only
-            MDAT = df_OUT.iloc[:,16].values  #read 14th column only    
-            YEAR = df_OUT.iloc[:,13].values//1000
-            NICM = df_OUT.iloc[:,39].values  #read 40th column only,  #NICM   Tot N app kg/ha Inorganic N applied (kg [N]/ha)
-            HWAM[HWAM < 0]=0 #==> if HWAM == -99, consider it as "0" yield (i.e., crop failure)
-            #Compute gross margin
-            GMargin=HWAM*float(dff.CropPrice[i])- float(dff.NFertCost[i])*NICM - float(dff.SeedCost[i]) - float(dff.OtherVariableCosts[i]) - float(dff.FixedCosts[i])
-            # GMargin_data[0:len(HWAM),x]
-            if int(dff.TargetYr[i]) <= int(dff.LastYear[i]):
-                doy = repr(PDAT[0])[4:]
-                target = dff.TargetYr[i] + doy
-                yr_index = np.argwhere(PDAT == int(target))
-                TG_GMargin_temp = GMargin[yr_index[0][0]]
-            else: 
-                TG_GMargin_temp = np.nan
-
-            # Make a new dataframe for plotting
-            df1 = pd.DataFrame({'EXPERIMENT':EXPERIMENT})
-            df2 = pd.DataFrame({'PDAT':PDAT})
-            df3 = pd.DataFrame({'ADAT':ADAT})
-            df4 = pd.DataFrame({'HWAM':HWAM})
-            df5 = pd.DataFrame({'YEAR':YEAR})
-            df6 = pd.DataFrame({'NICM':NICM})
-            df7 = pd.DataFrame({'GMargin':GMargin})
-            temp_df = pd.concat([df1.EXPERIMENT,df5.YEAR, df2.PDAT, df3.ADAT, df4.HWAM, df6.NICM, df7.GMargin], ignore_index=True, axis=1)
-            if i==0:
-                df = temp_df.copy()
-            else:
-                df = df.append(temp_df, ignore_index=True)
-
-            TG_GMargin.append(TG_GMargin_temp)
-
-        # adding column name to the respective columns
-        df.columns =['EXPERIMENT', 'YEAR','PDAT', 'ADAT','HWAM','NICM','GMargin']
-        x_val = np.unique(df.EXPERIMENT.values)
-        print(df)
-        fig = px.box(df, x="EXPERIMENT", y="GMargin", title='Gross Margin Boxplot')
-        fig.add_scatter(x=x_val,y=TG_GMargin, mode='markers') #, mode='lines+markers') #'lines')
-        fig.update_xaxes(title= 'Scenario Name')
-        fig.update_yaxes(title= 'Gross Margin[Birr/ha]')
-
-        fig2 = go.Figure()
-        for i in x_val:
-            x_data = df.GMargin[df['EXPERIMENT']==i].values
-            x_data = np.sort(x_data)
-            fx_scf = [1.0/len(x_data)] * len(x_data) #pdf
-            Fx_scf= 1.0-np.cumsum(fx_scf)  #for exceedance curve
-
-            fig2.add_trace(go.Scatter(x=x_data, y=Fx_scf,
-                        mode='lines+markers',
-                        name=i))
-        # Edit the layout
-        fig2.update_layout(title='Gross Margin Exceedance Curve',
-                        xaxis_title='Gross Margin[Birr/ha]',
-                        yaxis_title='Probability of Exceedance [-]')
-
-        #make a new dataframe to save into CSV
-        yr_val = np.unique(df.YEAR.values)
-        df_out = pd.DataFrame({'YEAR':yr_val})
-
-        fig3 = go.Figure()
-        for i in x_val:
-            x_data = df.YEAR[df['EXPERIMENT']==i].values
-            y_data = df.GMargin[df['EXPERIMENT']==i].values
-
-            ##make a new dataframe to save into CSV
-            df_temp = pd.DataFrame({i:y_data})
-            df_out = pd.concat([df_out, df_temp], axis=1)
-
-            fig3.add_trace(go.Scatter(x=x_data, y=y_data,
-                        mode='lines+markers',
-                        name=i))
-        # Edit the layout
-        fig3.update_layout(title='Gross Margin Time-Series',
-                        xaxis_title='Year',
-                        yaxis_title='Gross Margin[Birr/ha]')
-        #save simulated yield outputs into a csv file <<<<<<=======================
-        fname = path.join(Wdir_path, "simulated_yield_GMargin.csv")
-        df_out.to_csv(fname, index=False)
+        #4) simulated results kept by run_create_figure for this session (no file access)
+        sim_table = session_table(session_id, dff)
+        if sim_table is None:  #e.g., scenarios added or edited after the simulation
+            return [], [], [], dash.no_update, dash.no_update, dash.no_update, 'Please simulate all scenarios first'
+        labels = run_metrics.labels_of(dff.Crop, dff.stn_name)
+        stage_t0 = time.perf_counter()
+        isce = sim_table['SCE']  #scenario index of each row
+        PDAT = sim_table['PDAT']
+        NICM = sim_table['NICM']  #NICM   Tot N app kg/ha Inorganic N applied (kg [N]/ha)
+        HWAM = np.where(sim_table['HWAM'] < 0, 0, sim_table['HWAM']) #==> if HWAM == -99, consider it as "0" yield (i.e., crop failure)
+        #Compute gross margin for all scenarios and years at once
+        price = dff[EB_COLS].astype(float).values[isce]  #prices/costs of the scenario of each row
+        GMargin = results_store.gross_margin(HWAM, NICM, price)
+        x_val = np.array([dssat_runner.exname(c, s) for c, s in zip(dff.Crop, dff.sce_name)])
+        TG_GMargin = target_year_values(dff, sim_table, GMargin)
+
+        # Make a new dataframe for plotting
+        df = pd.DataFrame({'EXPERIMENT': x_val[isce], 'YEAR': PDAT//1000, 'PDAT': PDAT, 'ADAT': sim_table['ADAT'],
+                           'HWAM': HWAM, 'NICM': NICM, 'GMargin': GMargin})
+        run_metrics.record('statistics', time.perf_counter() - stage_t0, scenarios=sce_numbers, **labels)
+        stage_t0 = time.perf_counter()
+        mode = sim_figures.figure_mode(len(df))
+        fig = sim_figures.box_figure(df, 'GMargin', isce, x_val, TG_GMargin, 'Gross Margin Boxplot', 'Scenario Name',
+                                     'Gross Margin[Birr/ha]', mode)
+
+        fig2 = sim_figures.exceedance_figure(GMargin, isce, x_val, 'Gross Margin Exceedance Curve', 'Gross Margin[Birr/ha]', mode)
+        #time-series + new dataframe to save into CSV
+        fig3, df_out = sim_figures.timeseries_figure(df, 'GMargin', 'Gross Margin Time-Series', 'Gross Margin[Birr/ha]', mode)
+        sessions.put(session_id, 'EB_table', df_out)  #for the table pages and the CSV download
+        run_metrics.record('figure_build', time.perf_counter() - stage_t0, scenarios=sce_numbers, mode=mode, **labels)
         return [
             dcc.Graph(id='EB-boxplot',figure=fig), 
             dcc.Graph(id='EB-exceedance',figure=fig2),
             dcc.Graph(id='EB-ts',figure=fig3),
-            dash_table.DataTable(columns=[{"name": i, "id": i} for i in df_out.columns],
-                data=df_out.to_dict('records'),
-                style_cell={'whiteSpace': 'normal','height': 'auto',},),
-            df_out.to_dict('records')
+            [{"name": i, "id": i} for i in df_out.columns],
+            0,
+            -(-len(df_out) // TABLE_PAGE_SIZE),
+            None
             ]
 
+#===============================
+#Callbacks of the factorial sweep
+# - "Run factorial sweep" => expand the grid and submit a background job (same cache and DSSAT batch runs as the scenarios)
+# - sweep-interval => status of the job; only the medians of each scenario go to the browser
+@app.callback(Output('sweep-job-id', 'data'),
+                Output('sweep-interval', 'disabled'),
+                Output('sweep-status', 'children'),
+                Output('sweep-progress', 'value'),
+                Output('sweep-summary', 'data'),
+                Output('sweep-cultivar-view', 'options'),
+                Output('sweep-cultivar-view', 'value'),
+                Input('sweep-button', 'n_clicks'),
+                Input('sweep-interval', 'n_intervals'),
+                State('ETstation', 'value'),
+                State('year1', 'value'),
+                State('year2', 'value'),
+                State('crop-radio', 'value'),
+                State('ETsoil', 'value'),
+                State('ini-H2O', 'value'),
+                State('ini-NO3', 'value'),
+                State('target-year', 'value'),
+                State('EB_radio', 'value'),
+                State('EB-table','data'),
+                State('sweep-plt-first', 'date'),
+                State('sweep-plt-last', 'date'),
+                State('sweep-plt-step', 'value'),
+                State('sweep-density', 'value'),
+                State('sweep-nrate', 'value'),
+                State('sweep-cultivars', 'value'),
+                State('sweep-job-id', 'data'),
+                State('session-id', 'data')
+              )
+@run_metrics.timed_callback
+def run_sweep_grid(n_clicks, n_intervals, station, year1, year2, crop, soil, iH2O, iNO3, target_year, EB_radio, EB_in_table,
+                   plt_first, plt_last, plt_step, densities, n_rates, cultivars, job_id, session_id):
+    if n_clicks is None:
+        raise PreventUpdate
+    no_result = [dash.no_update] * 3
+    trigger = dash.callback_context.triggered[0]['prop_id']
+    if trigger.startswith('sweep-button'):
+        base = {'Crop': crop, 'stn_name': station, 'FirstYear': year1, 'LastYear': year2, 'soil': soil, 'iH2O': iH2O,
+                'iNO3': iNO3, 'TargetYr': target_year or '-99'}
+        base.update({c: '-99' for c in EB_COLS})
+        if EB_radio == 'EB_Yes':
+            base.update({c: str(EB_in_table[0][c]) for c in EB_COLS})
+        try:
+            missing_years = weather.missing_years(station, year1, year2)
+            if missing_years:
+                raise ValueError('no weather data for {} in {}'.format(station, ', '.join(map(str, missing_years))))
+            grid = sweep.expand_grid(base, sweep.date_range(plt_first, plt_last, plt_step or 0), sweep.parse_values(densities),
+                                     sweep.parse_values(n_rates), [c[7:] for c in cultivars or []])
+        except (KeyError, ValueError) as e:
+            return [dash.no_update, True, 'Sweep not started: {}'.format(e), 0] + no_result
+        if job_id is not None:
+            sim_queue.stop(job_id)
+        job_id = sim_queue.submit(simulate_sweep, grid, session_id, n_total=len(grid))
+        return [job_id, False, 'Sweep of {} scenarios queued (job {})'.format(len(grid), job_id[:8]), 0] + no_result
+
+    job = sim_queue.get(job_id)
+    if job is None:
+        return [dash.no_update, True, 'Sweep job not found, please run it again', 0] + no_result
+    if job.state == 'failed':
+        return [dash.no_update, True, 'Sweep failed: ' + job.error, 0] + no_result
+    if job.state == 'cancelled':
+        return [dash.no_update, True, 'Sweep cancelled', 0] + no_result
+    if job.state != 'done':
+        return [dash.no_update, False, job_message(job, 'Sweep'), 100 * job.n_done // max(job.n_total, 1)] + no_result
+    cultivars = sorted(set(r['Cultivar'] for r in job.result))
+    return [dash.no_update, True, 'Sweep done: {} scenarios'.format(job.n_total), 100, job.result,
+            [{'label': c, 'value': c} for c in cultivars], cultivars[0]]
+
+def simulate_sweep(job, grid, session_id):
+    #run the grid in chunks (results of each chunk are cached => a new sweep with some of the same scenarios is faster)
+    workspaces.check_quota(session_id)
+    out_dir = workspaces.get(session_id)
+    parts = []
+    with job_token(job) as token:
+        for start in range(0, len(grid), sweep.CHUNK_SIZE):
+            chunk = grid.iloc[start:start + sweep.CHUNK_SIZE].reset_index(drop=True)
+            parts.append(sweep.run_chunk(Wdir_path, chunk, sim_cache, progress=lambda n: job.set_progress(start + n),
+                                         out_dir=out_dir, archive=archive, token=token))
+    summary = sweep.grid_summary(grid, pd.concat(parts, ignore_index=True))
+    return summary.to_dict('records')
+
+@app.callback(Output('sweep-heatmap-container', 'children'),
+                Output('sweep-curve-container', 'children'),
+                Input('sweep-summary', 'data'),
+                Input('sweep-metric', 'value'),
+                Input('sweep-cultivar-view', 'value'),
+              )
+@run_metrics.timed_callback
+def sweep_figures(summary, metric, cultivar):
+    if not summary:
+        raise PreventUpdate
+    df = pd.DataFrame(summary)
+    if cultivar in set(df.Cultivar):
+        df = df[df.Cultivar == cultivar]
+    if df[metric].isnull().all():
+        return html.Div('No gross margin: enter the enterprise budget in 13) and run the sweep again'), None
+    df = df.assign(NRate=df.NRate.astype(float), density=df.plt_density.astype(float))
+    label = 'Median yield [kg/ha]' if metric == 'HWAM' else 'Median gross margin [Birr/ha]'
+    #heatmap of planting date x N rate for each planting density
+    zmin, zmax = df[metric].min(), df[metric].max()
+    heatmaps = []
+    for density, df_d in df.groupby('density'):
+        z = df_d.pivot_table(index='NRate', columns='Plt-date', values=metric)
+        fig = go.Figure(go.Heatmap(z=z.values, x=z.columns, y=z.index, zmin=zmin, zmax=zmax, colorbar={'title': label}))
+        fig.update_layout(title='{}: density {:g} plants/m2'.format(label, density),
+                          xaxis_title='Planting date [MM-DD]', yaxis_title='N rate [N kg/ha]')
+        heatmaps.append(dcc.Graph(figure=fig))
+    #response curves: planting date on x, one line per N rate and density
+    df_curve = df.sort_values('Plt-date').assign(**{'N rate': df.NRate.map('{:g}'.format), 'Density': df.density.map('{:g}'.format)})
+    fig2 = px.line(df_curve, x='Plt-date', y=metric, color='N rate', line_dash='Density',
+                   title='Response to planting date, N rate and density')
+    fig2.update_traces(mode='lines+markers')
+    fig2.update_layout(xaxis_title='Planting date [MM-DD]', yaxis_title=label)
+    return heatmaps, dcc.Graph(figure=fig2)
+
+#===============================
+#Daily dynamics: daily outputs of one scenario (run again in the session workspace if they are not there, e.g., cached results)
+@app.callback(Output('daily-scenario', 'options'),
+              Input('scenario-table', 'data'))
+def set_daily_scenario_options(sce_in_table):
+    return [{'label': row['sce_name'], 'value': row['sce_name']} for row in (sce_in_table or [])
+            if row.get('Crop') in cultivar_options]
+
+@app.callback(Output('daily-container', 'children'),
+              Output('daily-status', 'children'),
+              Input('daily-button', 'n_clicks'),
+              Input('daily-var', 'value'),
+              State('daily-scenario', 'value'),
+              State('scenario-table', 'data'),
+              State('session-id', 'data'))
+@run_metrics.timed_callback
+def daily_figure(n_clicks, var, sname, sce_in_table, session_id):
+    if n_clicks is None or sname is None:
+        raise PreventUpdate
+    row = next((r for r in sce_in_table if r['sce_name'] == sname and r.get('Crop') in cultivar_options), None)
+    if row is None:
+        return None, 'Scenario {} is not in the scenario table'.format(sname)
+    ext, label = DAILY_VARS[var]
+    #daily outputs of these inputs => directory named after the cache key (an edited scenario is run again)
+    run_dir = path.join(workspaces.get(session_id), 'daily', result_cache.scenario_key(Wdir_path, row)[:16])
+    fname = daily_reader.daily_fname(run_dir, row['Crop'], sname, ext)
+    if not path.isfile(fname):
+        workspaces.check_quota(session_id)
+        os.makedirs(run_dir, exist_ok=True)
+        dssat_runner.run_scenarios(Wdir_path, pd.DataFrame([row]), n_workers=1,
+                                   snx_texts=[render_SNX(row)], out_dir=run_dir)
+        if not path.isfile(fname):
+            return None, 'No daily output ({}) for scenario {}'.format(ext, sname)
+    years, das, values = daily_reader.DailyOutput(fname).stack(var)
+    target = int(row['TargetYr']) if int(row['TargetYr']) <= int(row['LastYear']) else None
+    fig = sim_figures.daily_figure(years, das, values, target, '{}: {}'.format(sname, label), label)
+    return dcc.Graph(figure=fig), ''
+
+#===============================
+#Season climate: growing season (PDAT-MDAT) of each simulated year from the station daily arrays (season_climate)
+@app.callback(Output('climate-table', 'data'),
+              Output('climate-table', 'columns'),
+              Output('climate-container', 'children'),
+              Output('climate-status', 'children'),
+              Input('climate-button', 'n_clicks'),
+              Input('climate-var', 'value'),
+              State('scenario-table', 'data'),
+              State('session-id', 'data'))
+@run_metrics.timed_callback
+def climate_figure(n_clicks, var, sce_in_table, session_id):
+    if n_clicks is None:
+        raise PreventUpdate
+    dff = pd.DataFrame([row for row in (sce_in_table or []) if row.get('Crop') in cultivar_options])
+    if len(dff) == 0:
+        return [], [], None, 'No scenario in the scenario table'
+    sim_table = session_table(session_id, dff)
+    if sim_table is None:
+        return [], [], None, 'Please simulate all scenarios first'
+    with run_metrics.timed('season_climate', scenarios=len(dff), **run_metrics.labels_of(dff.Crop, dff.stn_name)):
+        climate = season_climate.season_climate(climate_index, dff.stn_name.values, sim_table)
+        yields = np.where(sim_table['HWAM'] < 0, 0, sim_table['HWAM'])  #crop failure (-99) => zero yield
+        r = season_climate.correlations(climate, yields, sim_table['SCE'], len(dff))
+    x_val = np.array([dssat_runner.exname(c, s) for c, s in zip(dff.Crop, dff.sce_name)])
+    #correlation table: one row per scenario
+    columns = [{'name': 'Scenario', 'id': 'EXPERIMENT'}] + [{'name': 'r ' + v, 'id': k} for k, v in season_climate.VARS.items()]
+    data = [dict(EXPERIMENT=name, **{k: None if np.isnan(r[i, j]) else round(float(r[i, j]), 2)
+                                     for j, k in enumerate(season_climate.VARS)}) for i, name in enumerate(x_val)]
+    isce = sim_table['SCE']
+    df = pd.DataFrame(dict({'EXPERIMENT': x_val[isce], 'YEAR': sim_table['PDAT']//1000, 'HWAM': yields}, **climate))
+    label = season_climate.VARS[var]
+    fig = sim_figures.climate_figure(df[sim_table['PDAT'] > 0], 'HWAM', var, 'Yield and {}'.format(label), 'Yield [kg/ha]', label)
+    return data, columns, dcc.Graph(figure=fig), ''
+
+#===============================
+#Archive query: filters on the partition columns (crop/station/soil) only open the matching directories,
+#the year range is pushed down to the Parquet files; only the grouping columns and the metric are read
+@app.callback(Output('archive-table', 'data'),
+              Output('archive-table', 'columns'),
+              Output('archive-container', 'children'),
+              Output('archive-status', 'children'),
+              Input('archive-button', 'n_clicks'),
+              State('archive-crop', 'value'),
+              State('archive-station', 'value'),
+              State('archive-soil', 'value'),
+              State('archive-first-year', 'value'),
+              State('archive-last-year', 'value'),
+              State('archive-group-by', 'value'),
+              State('archive-metric', 'value'))
+@run_metrics.timed_callback
+def query_archive(n_clicks, crops, stations, soils, first_year, last_year, group_by, metric):
+    if n_clicks is None:
+        raise PreventUpdate
+    filters = [(c, 'in', values) for c, values in [('Crop', crops), ('stn_name', stations), ('soil', soils)] if values]
+    if first_year is not None:
+        filters.append(('YEAR', '>=', int(first_year)))
+    if last_year is not None:
+        filters.append(('YEAR', '<=', int(last_year)))
+    group_by = group_by or []
+    try:
+        df = archive.summarize(filters, group_by, metric)
+    except results_archive.ArchiveUnavailable as e:
+        return [], [], None, str(e)
+    if not len(df):
+        return [], [], None, 'No archived results match these filters'
+    columns = [{'name': ARCHIVE_GROUPS.get(c, c), 'id': c} for c in df.columns]
+    label = 'Yield [kg/ha]' if metric == 'HWAM' else 'Gross margin [Birr/ha]'
+    #median of each group with the 10-90% range
+    names = df[group_by].astype(str).agg(' / '.join, axis=1) if group_by else df.iloc[:, 0]
+    fig = go.Figure(go.Bar(x=names, y=df['median'], error_y={'type': 'data', 'symmetric': False,
+                                                             'array': df['q90'] - df['median'],
+                                                             'arrayminus': df['median'] - df['q10']}))
+    fig.update_layout(title='Median {} (10-90% range) of the archived results'.format(label.split(' [')[0].lower()),
+                      xaxis_title=' / '.join(ARCHIVE_GROUPS[c] for c in group_by) or 'All', yaxis_title=label)
+    status = '{:,} simulated values in {} group(s)'.format(int(df['count'].sum()), len(df))
+    return df.round(3).to_dict('records'), columns, dcc.Graph(figure=fig), status
+
 # =============================================
-# def writeSNX_main_hist(Wdir_path,input1,input2,input3,input4,input5,input6,input7,input8,input9,input10):
-def writeSNX_main_hist(Wdir_path,input1,input2,input3,input4,crop,input5,input6,input7,input8,
-                       input9,input10,fert_app, df_fert):    
-    # print('check writeSNX_main')
-    # print(input1)  #MELK
-    # print(input2)  #1981
-    # print(input3)  #2014
-    # print(input4)  #2021-06-15
-    # print(input50)  #MZ crop type
-    # print(input5)  #CIMT01 BH540-Kassie
-    # print(input6)  #ETET001_18
-    # print(input7)  #0.7
-    # print(input8)  #H
-    # print(input9)  #6
-    # print(input10)  #scenario name
-    WSTA = input1
-    NYERS = repr(int(input3) - int(input2) + 1)
-    plt_year = input2
-    if input4 is not None:
-        date_object = date.fromisoformat(input4)
-        date_string = date_object.strftime('%B %d, %Y')
-        plt_doy = date_object.timetuple().tm_yday
-        # print(date_string)  #June 15, 2021 
-        # print(plt_doy)  #166
-    PDATE = plt_year[2:] + repr(plt_doy).zfill(3)
-        #   IC_date = first_year * 1000 + (plt_doy - 1)
-        #   PDATE = repr(first_year)[2:] + repr(plt_doy).zfill(3)
-        # ICDAT = repr(IC_date)[2:]
-    ICDAT = plt_year[2:] + repr(plt_doy-1).zfill(3)  #Initial condition => 1 day before planting
-    SDATE = ICDAT
-    INGENO = input5[0:6]  
-    CNAME = input5[7:]  
-    ID_SOIL = input6
-    PPOP = input9  #planting density
-    i_NO3 = input8  # self.label_04.cget("text")[0:1]  #self.NO3_soil.getvalue()[0][0:1] #'H' #or 'L'
-    IC_w_ratio = float(input7)
-    # crop = 'MZ' #EJ(1/6/2021) temporary
-
-    #1) make SNX
-    if crop == 'WH':
-        temp_snx = path.join(Wdir_path, "TEMP_ETWH.SNX")
-        snx_name = 'ETWH'+input10[:4]+'.SNX'
-    elif crop == 'MZ':
-        temp_snx = path.join(Wdir_path, "TEMP_ETMZ.SNX")
-        snx_name = 'ETMZ'+input10[:4]+'.SNX'
-    else:  # SG
-        temp_snx = path.join(Wdir_path, "TEMP_ETSG.SNX")
-        snx_name = 'ETSG'+input10[:4]+'.SNX'
-    # # temp_snx = path.join(Wdir_path, "ETMZTEMP.SNX")
-    # temp_snx = path.join(Wdir_path, "TEMP_ETMZ.SNX")
-    # snx_name = 'ETMZ'+input10[:4]+'.SNX'
-    SNX_fname = path.join(Wdir_path, snx_name)
-    fr = open(temp_snx, "r")  # opens temp SNX file to read
-    fw = open(SNX_fname, "w")  # opens SNX file to write
-    # read lines 1-9 from temp file
-    for line in range(0, 14):
-        temp_str = fr.readline()
-        fw.write(temp_str)
-
-    MI = '0' 
-    if fert_app == 'Fert':
-        MF = '1'
-    else: 
-        MF = '0'
-    # MF = '1'
-    SA = '0'
-    IC = '1'
-    MP = '1'
-    MR = '0'
-    MC = '0'
-    MT = '0'
-    ME = '0'
-    MH = '0'
-    SM = '1'
-    temp_str = fr.readline()
-    FL = '1'
-    fw.write('{0:3s}{1:31s}{2:3s}{3:3s}{4:3s}{5:3s}{6:3s}{7:3s}{8:3s}{9:3s}{10:3s}{11:3s}{12:3s}{13:3s}'.format(
-        FL.rjust(3), '1 0 0 ET-SIMAGRI                 1',
-        FL.rjust(3), SA.rjust(3), IC.rjust(3), MP.rjust(3), MI.rjust(3), MF.rjust(3), MR.rjust(3), MC.rjust(3),
-        MT.rjust(3), ME.rjust(3), MH.rjust(3), SM.rjust(3)))
-    fw.write(" \n")
-
-    # read lines from temp file
-    for line in range(0, 3):
-        temp_str = fr.readline()
-        fw.write(temp_str)
-
-    # write *CULTIVARS
-    temp_str = fr.readline()
-    new_str = temp_str[0:3] + crop + temp_str[5:6] + INGENO + temp_str[12:13] + CNAME
-    fw.write(new_str)
-    fw.write(" \n")
-
-    # read lines from temp file
-    for line in range(0, 3):
-        temp_str = fr.readline()
-        fw.write(temp_str)
-    # ================write *FIELDS
-    # Get soil info from *.SOL
-    SOL_file = path.join(Wdir_path, "ET.SOL")
-    # soil_depth, wp, fc, nlayer = get_soil_IC(SOL_file, ID_SOIL)
-    soil_depth, wp, fc, nlayer, SLTX = get_soil_IC(SOL_file, ID_SOIL)
-    SLDP = repr(soil_depth[-1])
-    ID_FIELD = WSTA + '0001'
-    WSTA_ID =  WSTA
-    fw.write(
-        '{0:3s}{1:8s}{2:5s}{3:3s}{4:6s}{5:4s}  {6:10s}{7:4s}'.format(FL.rjust(3), ID_FIELD, WSTA_ID.rjust(5),
-                                                                        '       -99   -99   -99   -99   -99   -99 ',
-                                                                        SLTX.ljust(6), SLDP.rjust(4), ID_SOIL,
-                                                                        ' -99'))
-    fw.write(" \n")
-    temp_str = fr.readline()  # 1 -99      CCER       -99   -99 DR000   -99   -99
-    temp_str = fr.readline()  # @L ...........XCRD ...........YCRD .....ELEV
-    fw.write(temp_str)
-    temp_str = fr.readline()  # 1             -99             -99       -99   ==> skip
-    # ================write *FIELDS - second section
-    fw.write('{0:3s}{1:89s}'.format(FL.rjust(3),
-                                    '            -99             -99       -99               -99   -99   -99   -99   -99   -99'))
-    fw.write(" \n")
-    fw.write(" \n")
-
-    # read lines from temp file
-    for line in range(0, 3):
-        temp_str = fr.readline()
-        fw.write(temp_str)
-
-    # write *INITIAL CONDITIONS
-    temp_str = fr.readline()
-    new_str = temp_str[0:9] + ICDAT + temp_str[14:]
-    fw.write(new_str)
-    temp_str = fr.readline()  # @C  ICBL  SH2O  SNH4  SNO3
-    fw.write(temp_str)
-    temp_str = fr.readline()
-    for nline in range(0, nlayer):
-        if nline == 0:  # first layer
-            temp_SH2O = IC_w_ratio * (fc[nline] - wp[nline]) + wp[nline]  # EJ(6/25/2015): initial AWC=70% of maximum AWC
-            if i_NO3 == 'H':
-                SNO3 = '15'  # **EJ(4/29/2020) used one constant number regardless of soil types
-            else:  # i_NO3 == 'L':
-                SNO3 = '5'  # **EJ(5/27/2015)
-        elif nline == 1:  # second layer
-            temp_SH2O = IC_w_ratio * (fc[nline] - wp[nline]) + wp[nline]  # EJ(6/25/2015): initial AWC=70% of maximum AWC
-            if i_NO3 == 'H':
-                SNO3 = '2'  # **EJ(4/29/2020) used one constant number regardless of soil types
-            else:  # elif i_NO3 == 'L':
-                SNO3 = '.5'  # **EJ(4/29/2020) used one constant number regardless of soil types
-        else:
-            temp_SH2O = fc[nline]  # float
-            SNO3 = '0'  # **EJ(5/27/2015)
-        SH2O = repr(temp_SH2O)[0:5]  # convert float to string
-        new_str = temp_str[0:5] + repr(soil_depth[nline]).rjust(3) + ' ' + SH2O.rjust(5) + temp_str[14:22] + SNO3.rjust(4) + "\n"
-        fw.write(new_str)
-    fw.write("  \n")
-    # print('ICDAT= {0}'.format(ICDAT))  #test here
-    # print('fc[0]= {0}'.format(fc[0] ))  #test here
-    # print('test after writing init')  #test here
-    for nline in range(0, 10):
-        temp_str = fr.readline()
-        # print temp_str
-        if temp_str[0:9] == '*PLANTING':
-            break
-
-    fw.write(temp_str)  # *PLANTING DETAILS
-    temp_str = fr.readline()  # @P PDATE EDATE
-    fw.write(temp_str)
-    # write *PLANTING DETAILS
-    temp_str = fr.readline()
-    PPOE = PPOP #planting density 
-    new_str = temp_str[0:3] + PDATE + '   -99' + PPOP.rjust(6) + PPOE.rjust(6) + temp_str[26:]
-    fw.write(new_str)
-    fw.write("  \n")
-    # print('PPOE = {0}'.format(PPOE))  #test here
-    # write *IRRIGATION AND WATER MANAGEMENT, if irrigation on reported dates
-    # skip irrigation for now   #EJ(1/6/2021) temporary
-
-    # write *FERTILIZERS (INORGANIC)
-    #get fertilizer info using dash_table.DataTable(https://dash.plotly.com/datatable/callbacks
-    #use editable datatable https://dash.plotly.com/datatable/editable
-    for nline in range(0, 20):
-        temp_str = fr.readline()
-        # print temp_str
-        if temp_str[0:12] == '*FERTILIZERS':
-            break
-    fw.write(temp_str)  # *FERTILIZERS (INORGANIC)
-    temp_str = fr.readline()  # @F FDATE  FMCD  FACD 
-    fw.write(temp_str)
-    temp_str = fr.readline()  #1     0 FE005 AP001     5    30   -99   -99   -99   -99   -99   -99
-#-0------------        # write *FERTILIZERS (INORGANIC)
-    if fert_app == 'Fert':
-        print(df_fert)
-        df_fert = df_fert.astype(float)
-        df_filtered = df_fert[(df_fert["DAP"] >= 0) & (df_fert["NAmount"] >= 0)]
-        fert_count = len(df_filtered)  #Get the number of rows: len(df)  => May need more error-checking
-        FDATE = df_filtered.DAP.values
-        FMCD = 'FE005'  #Urea
-        FACD = 'AP001'  #Broadcast, not incorporated    
-        FDEP = '5'   #5cm depth
-        FAMN = df_filtered.NAmount.values
-        FAMP = '-99'
-        FAMK = '-99'
-
-        if fert_count > 0:   # fertilizer applied
-            for i in range(fert_count):
-                new_str = temp_str[0:5] + repr(int(FDATE[i])).rjust(3) + ' ' + FMCD.rjust(5) + ' ' + FACD.rjust(5) + ' ' + FDEP.rjust(5) + ' ' + repr(FAMN[i]).rjust(5) + ' ' + FAMP.rjust(5) + ' ' + FAMK.rjust(5) + temp_str[44:]
-                fw.write(new_str)
-            fw.write(" \n")
-#-------------------------------------------
-    # else: #if no fertilzier applied
-    #     temp_str = fr.readline()  #  1     0 FE005 AP002 
-    #     fw.write(temp_str)
-    #     temp_str = fr.readline()  #  1    45 FE005 AP002
-    #     fw.write(temp_str)
-
-    fw.write("  \n")
-    for nline in range(0, 20):
-        temp_str = fr.readline()
-        # print temp_str
-        if temp_str[0:11] == '*SIMULATION':
-            break
-    fw.write(temp_str)  # *SIMULATION CONTROLS
-    temp_str = fr.readline()
-    fw.write(temp_str)  # @N GENERAL     NYERS NREPS START SDATE RSEED SNAME
-    # write *SIMULATION CONTROLS
-    temp_str = fr.readline()
-    new_str = temp_str[0:18] + NYERS.rjust(2) + temp_str[20:33] + SDATE + temp_str[38:]
-    fw.write(new_str)
-    temp_str = fr.readline()  # @N OPTIONS
-    fw.write(temp_str)
-    temp_str = fr.readline()  # 1 OP
-    fw.write(' 1 OP              Y     Y     Y     N     N     N     N     N     D'+ "\n")
-    temp_str = fr.readline()  # @N METHODS
-    fw.write(temp_str)
-    temp_str = fr.readline()  # 1 ME
-    fw.write(temp_str)
-    temp_str = fr.readline()  # @N MANAGEMENT
-    fw.write(temp_str)
-    temp_str = fr.readline()  # 1 MA
-    # new_str = temp_str[0:25] + IRRIG + temp_str[26:31] + FERTI + temp_str[32:]
-    # fw.write(new_str)
-    fw.write(temp_str)
-    temp_str = fr.readline()  # @N OUTPUTS
-    fw.write(temp_str)
-    temp_str = fr.readline()  # 1 OU
-    fw.write(temp_str)
-
-    # read lines from temp file
-    for line in range(0, 5):
-        temp_str = fr.readline()
-        fw.write(temp_str)
-    # irrigation method
-    temp_str = fr.readline()  # 1 IR
-    fw.write(temp_str)
-    # if self._Setting.DSSATSetup2.rbIrrigation.get() == 0:  # automatic when required
-    #     IMDEP = self._Setting.DSSATSetup2.IA_mng_depth.getvalue()
-    #     ITHRL = self._Setting.DSSATSetup2.IA_threshold.getvalue()
-    #     IREFF = self._Setting.DSSATSetup2.IA_eff_fraction.getvalue()
-    #     fw.write(' 1 IR          ' + IMDEP.rjust(5) + ITHRL.rjust(6) + '   100 GS000 IR001    10'+ IREFF.rjust(6)+ "\n")
-    # else:
-    #     # new_str = temp_str[0:39] + IMETH + temp_str[44:]
-    #     fw.write(temp_str)
-
-    # read lines from temp file
-    for line in range(0, 7):
-        temp_str = fr.readline()
-        fw.write(temp_str)
-
-    fr.close()
-    fw.close()
-    return
+def read_OSU(fout_name, row=None):
+    #read DSSAT summary output (*.OSU) => dict of arrays for the columns used in the figures and budgets
+    #NICM   Tot N app kg/ha Inorganic N applied (kg [N]/ha). -99 is kept as it is (e.g., HWAM=-99 => crop failure)
+    #row: scenario of the output (labels of the 'osu_parse' timing)
+    with run_metrics.timed('osu_parse', **scenario_labels(row)):
+        return osu_reader.read_osu(fout_name, OSU_COLS, missing=None)
+
+def render_SNX(row):
+    #SNX text of a scenario (row of the scenario summary table), timed as 'snx_render'
+    with run_metrics.timed('snx_render', **scenario_labels(row)):
+        return snx_template.render_row(Wdir_path, row)
+
+def scenario_labels(row):
+    return {} if row is None else {'crop': row['Crop'], 'station': row['stn_name'], 'scenario': row['sce_name']}
 # =============================================
 # def writeV47_main_hist(Wdir_path,sname,crop):  # sname includes full path
 #     sname = sname.replace("/", "\\")
@@ -1239,35 +1493,6 @@ def writeSNX_main_hist(Wdir_path,input1,input2,input3,input4,crop,input5,input6,
 #     fr.close()
 #     fw.close()
 
-#===============================================================
-def get_soil_IC(SOL_file, ID_SOIL):
-    # SOL_file=Wdir_path.replace("/","\\") + "\\SN.SOL"
-    # initialize
-    depth_layer = []
-    ll_layer = []
-    ul_layer = []
-    n_layer = 0
-    soil_flag = 0
-    count = 0
-    fname = open(SOL_file, "r")  # opens *.SOL
-    for line in fname:
-        if ID_SOIL in line:
-            soil_depth = line[33:38]#37]
-            s_class = line[25:29]
-            soil_flag = 1
-        if soil_flag == 1:
-            count = count + 1
-            if count >= 7:
-                depth_layer.append(int(line[0:6]))
-                ll_layer.append(float(line[13:18]))
-                ul_layer.append(float(line[19:24]))
-                n_layer = n_layer + 1
-                if line[3:6].strip() == soil_depth.strip():
-                    fname.close()
-                    break
-    return depth_layer, ll_layer, ul_layer, n_layer, s_class
-
-
 if __name__ == "__main__":
     # app.run_server(debug=True)
     app.run_server(debug=False)  #https://github.com/plotly/dash/issues/108
@@ -0,0 +1,67 @@
+#Benchmark: one DSSAT launch per scenario vs. batch mode (one launch per crop model) for 1, 10 and 100 scenarios
+#runs in a copy of the TEST directory with copies of ETMZcccc.SNX as scenarios
+#usage: python benchmarks/bench_batch.py [--exe path/to/DSCSM047.EXE] [--sizes 1 10 100] [--workers 1]
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from os import path
+
+import pandas as pd
+
+REPO_PATH = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+import dssat_runner
+
+launches = [0]
+_run_DSSAT = dssat_runner.run_DSSAT
+
+def counting_run_DSSAT(*args, **kwargs):
+    launches[0] += 1
+    return _run_DSSAT(*args, **kwargs)
+
+def make_workdir(n_sce):
+    #copy of TEST with n_sce scenarios (SNX files ETMZb000.SNX, ETMZb001.SNX, ...)
+    Wdir_path = path.join(tempfile.mkdtemp(prefix="bench_batch_"), "TEST")
+    shutil.copytree(path.join(REPO_PATH, "TEST"), Wdir_path)
+    snames = ['b{:03d}'.format(i) for i in range(n_sce)]
+    for sname in snames:
+        shutil.copy2(path.join(Wdir_path, "ETMZcccc.SNX"), path.join(Wdir_path, dssat_runner.snx_name('MZ', sname)))
+    dff = pd.DataFrame({'Crop': ['MZ'] * n_sce, 'sce_name': snames, 'stn_name': ['MELK'] * n_sce})
+    return Wdir_path, dff
+
+def run(Wdir_path, dff, batch, n_workers):
+    launches[0] = 0
+    t0 = time.perf_counter()
+    fout_names = dssat_runner.run_scenarios(Wdir_path, dff, n_workers=n_workers, batch=batch)
+    elapsed = time.perf_counter() - t0
+    n_ok = sum(path.isfile(f) for f in fout_names)
+    return launches[0], elapsed, n_ok
+
+def main():
+    parser = argparse.ArgumentParser(description='DSSAT batch mode benchmark')
+    parser.add_argument('--exe', help='DSSAT executable (default: SIMAGRI_DSSAT_EXE or DSCSM047.EXE in the work directory)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100], help='numbers of scenarios')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes (launches are only counted with 1)')
+    args = parser.parse_args()
+    if args.exe:
+        os.environ['SIMAGRI_DSSAT_EXE'] = path.abspath(args.exe)
+    dssat_runner.run_DSSAT = counting_run_DSSAT
+
+    print('{:>10}{:>14}{:>10}{:>12}{:>10}{:>10}'.format('scenarios', 'mode', 'launches', 'time[s]', 'outputs', 'speed-up'))
+    for n_sce in args.sizes:
+        Wdir_path, dff = make_workdir(n_sce)
+        try:
+            t_single = None
+            for mode, batch in (('per-scenario', False), ('batch', True)):
+                n_launch, elapsed, n_ok = run(Wdir_path, dff, batch, args.workers)
+                t_single = t_single or elapsed
+                print('{:>10}{:>14}{:>10}{:>12.3f}{:>10}{:>10.1f}'.format(n_sce, mode, n_launch if args.workers <= 1 else '-',
+                                                                        elapsed, n_ok, t_single / elapsed))
+        finally:
+            shutil.rmtree(path.dirname(Wdir_path), ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
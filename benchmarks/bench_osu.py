@@ -0,0 +1,55 @@
+#Benchmark: OSU parsing with pandas (read_csv + iloc, used before) vs. osu_reader on the TEST fixtures
+#usage: python benchmarks/bench_osu.py [--copies 100] [--repeat 5]
+import os
+import sys
+import glob
+import time
+import argparse
+from os import path
+
+import numpy as np
+import pandas as pd
+
+REPO_PATH = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+import osu_reader
+
+COLS = ['EXNAME', 'PDAT', 'ADAT', 'MDAT', 'HWAM', 'NICM']
+
+def read_pandas(fname):
+    #previous code in run_create_figure/EB_figure
+    df_OUT = pd.read_csv(fname, sep=r'\s+', skiprows=3)
+    return {'EXNAME': df_OUT.iloc[:,7].values, 'PDAT': df_OUT.iloc[:,13].values, 'ADAT': df_OUT.iloc[:,15].values,
+            'MDAT': df_OUT.iloc[:,16].values, 'HWAM': df_OUT.iloc[:,20].values, 'NICM': df_OUT.iloc[:,39].values}
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='OSU parsing benchmark')
+    parser.add_argument('--copies', type=int, default=100, help='number of times the fixture files are read (bulk size)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fnames = sorted(glob.glob(path.join(REPO_PATH, 'TEST', '*.OSU'))) * args.copies
+    print('{} OSU files ({} fixtures x {})'.format(len(fnames), len(fnames) // args.copies, args.copies))
+
+    #check that both readers give the same values
+    for fname in set(fnames):
+        a, b = read_pandas(fname), osu_reader.read_osu(fname, COLS, missing=None)
+        assert all((a[c] == b[c]).all() for c in COLS), fname
+
+    t_pandas = best_time(lambda: [read_pandas(f) for f in fnames], args.repeat)
+    t_osu = best_time(lambda: [osu_reader.read_osu(f, COLS) for f in fnames], args.repeat)
+    t_bulk = best_time(lambda: osu_reader.read_osu_many(fnames, COLS), args.repeat)
+    print('{:<28}{:>10}{:>10}'.format('reader', 'total[s]', 'speed-up'))
+    for name, t in [('pandas read_csv + iloc', t_pandas), ('osu_reader.read_osu', t_osu), ('osu_reader.read_osu_many', t_bulk)]:
+        print('{:<28}{:>10.4f}{:>10.1f}'.format(name, t, t_pandas / t))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#Benchmark of the stages of the simulation pipeline (everything but the DSSAT runs) on the TEST fixtures
+#at several scales (number of scenarios), written into a JSON file that can be compared with a previous run
+# - snx        : SNX text of each scenario (snx_template.render_row, replaces writeSNX_main_hist)
+# - soil       : soil info for the initial conditions (soil_catalog.get_soil_IC)
+# - weather    : season weather of each scenario (weather_store slices of the TEST WTH files)
+# - osu        : summary outputs of the scenarios (osu_reader.read_osu_many of ETMZcccc/dddd.OSU)
+# - budget     : gross margins, target-year values and statistics of all scenarios (EB_figure computations)
+# - figures_*  : box plot, exceedance curves and time-series of the yields, 'full' and 'aggregate' modes (needs plotly)
+#usage: python benchmarks/bench_pipeline.py [--sizes 1 50 1000] [--repeat 5] [--output bench_pipeline.json]
+#       python benchmarks/bench_pipeline.py --baseline old.json [--tolerance 0.2]  => exit code 1 if a stage got slower
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from os import path
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+REPO_PATH = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+import osu_reader
+import results_store
+import sim_stats
+import snx_template
+import soil_catalog
+import weather_store
+
+TEST_PATH = path.join(REPO_PATH, 'TEST')
+OSU_COLS = ['PDAT', 'ADAT', 'MDAT', 'HWAM', 'NICM']
+PRICES = {'CropPrice': 5.0, 'NFertCost': 25.0, 'SeedCost': 600.0, 'OtherVariableCosts': 1500.0, 'FixedCosts': 1000.0}
+
+# =============================================
+def make_scenarios(n_sce):
+    #n_sce rows of the scenario summary table (the golden scenarios repeated with unique names) + enterprise budget
+    with open(path.join(TEST_PATH, 'golden', 'scenarios.json'), 'r') as f:
+        rows = json.load(f)
+    scenarios = []
+    for i in range(n_sce):
+        row = dict(rows[i % len(rows)], sce_name='{:04d}'.format(i))
+        row.update(PRICES)
+        scenarios.append(row)
+    return pd.DataFrame(scenarios)
+
+def make_results(n_sce):
+    #simulated results of n_sce scenarios: the TEST OSU files with the yields scaled differently for each scenario
+    base = [osu_reader.read_osu(path.join(TEST_PATH, f), OSU_COLS, missing=None) for f in ('ETMZcccc.OSU', 'ETMZdddd.OSU')]
+    rng = np.random.default_rng(0)
+    results = []
+    for i in range(n_sce):
+        r = dict(base[i % len(base)])
+        r['HWAM'] = np.where(r['HWAM'] < 0, r['HWAM'], (r['HWAM'] * rng.uniform(0.5, 1.5)).astype(r['HWAM'].dtype))
+        results.append(r)
+    return results
+
+# =============================================
+def stage_snx(dff, results):
+    rows = dff.to_dict('records')
+    return lambda: [snx_template.render_row(TEST_PATH, row) for row in rows]
+
+def stage_soil(dff, results):
+    soils = list(dff.soil)
+    SOL_file = path.join(TEST_PATH, 'ET.SOL')
+    return lambda: [soil_catalog.get_soil_IC(SOL_file, soil) for soil in soils]
+
+def stage_weather(dff, results, cache_dir):
+    store = weather_store.WeatherStore(TEST_PATH, cache_dir)
+    seasons = [(row['stn_name'], int(row['FirstYear']), int(row['LastYear']),
+                pd.Timestamp('2021-' + row['Plt-date']).dayofyear) for row in dff.to_dict('records')]
+    return lambda: [store.slice(stn, first, last, doy, doy + 120) for stn, first, last, doy in seasons]
+
+def stage_osu(dff, results):
+    fnames = [path.join(TEST_PATH, ('ETMZcccc.OSU', 'ETMZdddd.OSU')[i % 2]) for i in range(len(dff))]
+    return lambda: osu_reader.read_osu_many(fnames, OSU_COLS, missing=None)
+
+def budget(dff, results):
+    table = results_store.make_table(dff.sce_name.values, results, OSU_COLS)
+    isce = table['SCE']
+    HWAM = np.where(table['HWAM'] < 0, 0, table['HWAM'])
+    price = dff[results_store.EB_COLS].astype(float).values[isce]
+    GMargin = results_store.gross_margin(HWAM, table['NICM'], price)
+    target = sim_stats.target_values(GMargin, table['PDAT'] // 1000, isce, dff.TargetYr.astype(int).values)
+    return sim_stats.summarize(GMargin, isce, len(dff)), target
+
+def stage_budget(dff, results):
+    return lambda: budget(dff, results)
+
+def yield_figures(dff, results, mode):
+    import sim_figures
+    table = results_store.make_table(dff.sce_name.values, results, OSU_COLS)
+    isce = table['SCE']
+    x_val = np.array(['ET' + c + s for c, s in zip(dff.Crop, dff.sce_name)])
+    df = pd.DataFrame({'EXPERIMENT': x_val[isce], 'YEAR': table['PDAT'] // 1000, 'HWAM': table['HWAM']})
+    target = sim_stats.target_values(df.HWAM.values, df.YEAR.values, isce, dff.TargetYr.astype(int).values)
+    return (sim_figures.box_figure(df, 'HWAM', isce, x_val, target, 'Yield Boxplot', 'Scenario Name', 'Yield [kg/ha]', mode),
+            sim_figures.exceedance_figure(df.HWAM.values, isce, x_val, 'Yield Exceedance Curve', 'Yield [kg/ha]', mode),
+            sim_figures.timeseries_figure(df, 'HWAM', 'Yield Time-Series', 'Yield [kg/ha]', mode))
+
+def stage_figures_full(dff, results):
+    return lambda: yield_figures(dff, results, 'full')
+
+def stage_figures_aggregate(dff, results):
+    return lambda: yield_figures(dff, results, 'aggregate')
+
+STAGES = ['snx', 'soil', 'weather', 'osu', 'budget', 'figures_full', 'figures_aggregate']
+
+# =============================================
+def measure(func, repeat):
+    #first call (e.g., templates/catalog parsed, files in the page cache) + best and median of the next calls [s]
+    t0 = time.perf_counter()
+    func()
+    first = time.perf_counter() - t0
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return {'first': first, 'best': min(times), 'median': float(np.median(times)), 'repeat': repeat}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes, stages, repeat):
+    #=> {stage: {str(n_sce): timings or {'skipped': reason}}}
+    results = {stage: {} for stage in stages}
+    cache_dir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    try:
+        for n_sce in sizes:
+            dff, sim_results = make_scenarios(n_sce), make_results(n_sce)
+            for stage in stages:
+                try:
+                    func = stage_weather(dff, sim_results, cache_dir) if stage == 'weather' else \
+                        globals()['stage_' + stage](dff, sim_results)
+                    timing = measure(func, repeat)
+                    timing['per_scenario_ms'] = 1000 * timing['best'] / n_sce
+                except ImportError as e:  #plotly not installed
+                    timing = {'skipped': str(e)}
+                results[stage][str(n_sce)] = timing
+                print_timing(stage, n_sce, timing)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+def print_timing(stage, n_sce, timing):
+    if 'skipped' in timing:
+        print('{:<20}{:>7}  skipped: {}'.format(stage, n_sce, timing['skipped']))
+    else:
+        print('{:<20}{:>7}{:>11.4f}{:>11.4f}{:>11.4f}{:>13.3f}'.format(stage, n_sce, timing['first'], timing['best'],
+                                                                      timing['median'], timing['per_scenario_ms']))
+
+def compare(results, baseline, tolerance):
+    #best times vs. the baseline => number of stages slower than baseline * (1 + tolerance)
+    print('\n{:<20}{:>7}{:>11}{:>11}{:>8}'.format('stage', 'n_sce', 'base[s]', 'best[s]', 'ratio'))
+    n_slower = 0
+    for stage, by_size in results.items():
+        for n_sce, timing in by_size.items():
+            base = baseline['results'].get(stage, {}).get(n_sce)
+            if base is None or 'best' not in base or 'best' not in timing:
+                continue
+            ratio = timing['best'] / base['best']
+            slower = ratio > 1 + tolerance
+            n_slower += slower
+            print('{:<20}{:>7}{:>11.4f}{:>11.4f}{:>8.2f}{}'.format(stage, n_sce, base['best'], timing['best'], ratio,
+                                                                  '  SLOWER' if slower else ''))
+    return n_slower
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the simulation pipeline stages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 50, 1000], help='numbers of scenarios')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls of each stage (after a first call)')
+    parser.add_argument('--output', default='bench_pipeline.json', help='JSON file with the timings')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown accepted before a stage is reported')
+    args = parser.parse_args()
+
+    print('{:<20}{:>7}{:>11}{:>11}{:>11}{:>13}'.format('stage', 'n_sce', 'first[s]', 'best[s]', 'median[s]', 'per sce[ms]'))
+    results = run(args.sizes, args.stages, args.repeat)
+    report = {'meta': {'date': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+                       'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                       'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'repeat': args.repeat},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('timings written into', args.output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        n_slower = compare(results, baseline, args.tolerance)
+        print('{} stage(s) slower than the baseline (commit {}) by more than {:.0%}'.format(
+            n_slower, baseline['meta'].get('commit'), args.tolerance))
+        sys.exit(1 if n_slower else 0)
+
+if __name__ == "__main__":
+    main()
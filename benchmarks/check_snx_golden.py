@@ -0,0 +1,43 @@
+#Golden check of snx_template: SNX files rendered for TEST/golden/scenarios.json must be byte-identical to the files
+#written by the previous line-by-line writer (writeSNX_main_hist) in TEST/golden, + rendering speed
+#usage: python benchmarks/check_snx_golden.py [--repeat 1000]
+import sys
+import json
+import time
+import argparse
+from os import path
+
+REPO_PATH = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+import snx_template
+
+TEST_PATH = path.join(REPO_PATH, 'TEST')
+GOLDEN_PATH = path.join(TEST_PATH, 'golden')
+
+def main():
+    parser = argparse.ArgumentParser(description='SNX renderer golden check')
+    parser.add_argument('--repeat', type=int, default=1000, help='renders of each scenario for the timing')
+    args = parser.parse_args()
+
+    with open(path.join(GOLDEN_PATH, 'scenarios.json'), 'r') as f:
+        rows = json.load(f)
+    n_failed = 0
+    for row in rows:
+        golden = snx_template.snx_fname(GOLDEN_PATH, row)
+        with open(golden, 'r', newline='') as f:
+            expected = f.read()
+        ok = snx_template.render_row(TEST_PATH, row) == expected
+        n_failed += not ok
+        print('{:<16}{}'.format(path.basename(golden), 'OK' if ok else 'DIFFERENT'))
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        for row in rows:
+            snx_template.render_row(TEST_PATH, row)
+    elapsed = time.perf_counter() - t0
+    print('{} scenarios rendered in {:.3f} s => {:.0f} scenarios/s'.format(args.repeat * len(rows), elapsed,
+                                                                           args.repeat * len(rows) / elapsed))
+    sys.exit(1 if n_failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#Stand-in for the DSSAT executable (DSCSM047.EXE) to test and load-test the app without the model
+# - same command line as DSSAT: dssat_stub.py <crop model> B DSSBatch.V47 (run in the directory of the batch file)
+# - reads the SNX files listed in the batch file (cultivar, station, soil, planting date, density, N, years)
+# - writes the summary output with one row per experiment and year (same fixed-width layout as DSSAT) and, optionally,
+#   the daily plant growth and soil water outputs; named as DSSAT does: <first experiment>.OSU/.OPG/.OSW if FNAME=Y
+#   in the SNX (as in the templates), otherwise Summary.OUT, PlantGro.OUT and SoilWat.OUT
+# - yields are deterministic: they depend only on the SNX inputs and the year (same inputs => same outputs)
+#settings (environment variables, as the app starts the executable with fixed arguments):
+# - SIMAGRI_STUB_LATENCY: seconds of "model run" per simulated year (default 0)
+# - SIMAGRI_STUB_DAILY  : 1 => daily outputs (default 0)
+#usage: SIMAGRI_DSSAT_EXE=/path/to/benchmarks/dssat_stub.py python app.py
+import os
+import sys
+import math
+import time
+import random
+from datetime import date, timedelta
+
+LATENCY = float(os.environ.get('SIMAGRI_STUB_LATENCY', '0'))
+DAILY = os.environ.get('SIMAGRI_STUB_DAILY', '0') == '1'
+Y2K_CUTOFF = 50  #two-digit years of the SNX: < 50 => 20yy, otherwise 19yy
+
+#crop => (yield potential range [kg/ha], optimal density [plants/m2], harvest index)
+CROPS = {'MZ': ((5000, 8000), 6.0, 0.45), 'SG': ((3000, 5000), 12.0, 0.35), 'WH': ((3000, 5500), 250.0, 0.40)}
+
+#summary output columns: (name, width, text column)
+OSU_COLS = [('RUNNO', 7, False), ('TRNO', 6, False), ('R#', 2, False), ('O#', 2, False), ('P#', 2, False),
+            ('CR', 2, True), ('MODEL', 8, True), ('EXNAME', 8, True), ('TNAM', 25, True), ('FNAM', 8, True),
+            ('WSTA', 8, True), ('SOIL_ID', 10, True), ('SDAT', 7, False), ('PDAT', 7, False), ('EDAT', 7, False),
+            ('ADAT', 7, False), ('MDAT', 7, False), ('HDAT', 7, False), ('DWAP', 5, False), ('CWAM', 7, False),
+            ('HWAM', 7, False), ('HWAH', 7, False), ('BWAH', 7, False), ('HIAM', 5, False), ('LAIX', 5, False),
+            ('IR#M', 5, False), ('IRCM', 5, False), ('PRCM', 5, False), ('ETCM', 5, False), ('NI#M', 5, False),
+            ('NICM', 5, False), ('NUCM', 5, False), ('NLCM', 5, False)]
+OPG_COLS = ['LAID', 'CWAD', 'GWAD', 'WSPD', 'NSTD']
+OSW_COLS = ['SWTD', 'PREC', 'DRNC']
+
+# =============================================
+def read_batch(fname):
+    #SNX files listed under '@FILEX' in the batch file
+    with open(fname, 'r') as f:
+        lines = f.read().splitlines()
+    start = next(i for i, line in enumerate(lines) if line.startswith('@FILEX')) + 1
+    return [line[:95].strip() for line in lines[start:] if line.strip() and line[0] not in '!@*']
+
+def section(lines, name, header):
+    #data lines following the header line (starting with header) of the section *name
+    out = []
+    in_section = in_header = False
+    for line in lines:
+        if line.startswith('*'):
+            in_section = line.startswith('*' + name)
+            in_header = False
+        elif in_section and line.startswith('@'):
+            in_header = line.startswith(header)
+        elif in_section and in_header and line.strip():
+            out.append(line.split())
+    return out
+
+def two_digit_date(yyddd):
+    yy, doy = int(yyddd[:-3]), int(yyddd[-3:])
+    return (2000 if yy < Y2K_CUTOFF else 1900) + yy, doy
+
+def read_snx(fname):
+    with open(fname, 'r') as f:
+        lines = f.read().splitlines()
+    cultivar = section(lines, 'CULTIVARS', '@C CR')[0]
+    field = section(lines, 'FIELDS', '@L ID_FIELD')[0]
+    planting = section(lines, 'PLANTING', '@P PDATE')[0]
+    general = section(lines, 'SIMULATION CONTROLS', '@N GENERAL')[0]
+    outputs = section(lines, 'SIMULATION CONTROLS', '@N OUTPUTS')
+    fert = section(lines, 'FERTILIZERS', '@F FDATE')
+    soil_n = section(lines, 'INITIAL CONDITIONS', '@C  ICBL')
+    first_year, sdoy = two_digit_date(general[5])
+    return {'exname': os.path.splitext(os.path.basename(fname))[0][:8], 'crop': cultivar[1], 'cultivar': cultivar[2],
+            'station': field[1], 'soil': field[-2], 'pdoy': two_digit_date(planting[1])[1],
+            'density': float(planting[3]), 'first_year': first_year, 'sdoy': sdoy, 'n_years': int(general[2]),
+            'n_fert': sum(float(r[5]) for r in fert if len(r) > 5), 'n_soil': sum(float(r[4]) for r in soil_n if len(r) > 4),
+            'h2o': sum(float(r[2]) for r in soil_n if len(r) > 2) / max(len(soil_n), 1),
+            'fname': bool(outputs) and outputs[0][2] == 'Y'}
+
+# =============================================
+def yyddd(d):
+    return d.year * 1000 + d.timetuple().tm_yday
+
+def simulate(snx, year):
+    #one season => summary values + daily curves
+    ymin, ymax = CROPS.get(snx['crop'], CROPS['MZ'])[0]
+    opt_density, hi = CROPS.get(snx['crop'], CROPS['MZ'])[1:]
+    y_pot = random.Random('{cultivar}-{soil}'.format(**snx)).uniform(ymin, ymax)
+    season = random.Random('{}-{}-{}'.format(snx['station'], year, snx['pdoy'] // 10))  #same weather at a station
+    rain = season.gauss(550, 150)
+    f_water = min(1.0, max(0.05, (rain + 400 * snx['h2o']) / 650))
+    f_n = 1 - 0.6 * math.exp(-(snx['n_fert'] + snx['n_soil']) / 70)
+    f_density = math.exp(-((snx['density'] - opt_density) / opt_density) ** 2)
+    noise = random.Random('{cultivar}-{soil}-{density}-{n_fert}-{year}'.format(year=year, **snx)).uniform(0.9, 1.1)
+    HWAM = int(y_pot * f_water * f_n * f_density * noise)
+    failure = f_water < 0.3
+    sdat = date(year, 1, 1) + timedelta(days=snx['sdoy'] - 1)
+    pdat = date(year, 1, 1) + timedelta(days=snx['pdoy'] - 1)
+    n_days = 120 + int(20 * (snx['density'] / opt_density))
+    out = {'SDAT': yyddd(sdat), 'PDAT': yyddd(pdat), 'EDAT': yyddd(pdat + timedelta(days=6)),
+           'ADAT': yyddd(pdat + timedelta(days=n_days // 2 + 10)), 'MDAT': yyddd(pdat + timedelta(days=n_days)),
+           'HDAT': yyddd(pdat + timedelta(days=n_days)), 'DWAP': -99, 'CWAM': int(HWAM / hi), 'HWAM': -99 if failure else HWAM,
+           'HWAH': -99 if failure else HWAM, 'BWAH': 0, 'HIAM': hi, 'LAIX': round(4 * f_density * f_n, 1), 'IR#M': 0,
+           'IRCM': 0, 'PRCM': int(rain), 'ETCM': int(0.8 * rain), 'NI#M': int(snx['n_fert'] > 0), 'NICM': int(snx['n_fert']),
+           'NUCM': int(HWAM / 50), 'NLCM': int(0.05 * snx['n_fert'])}
+    daily = None
+    if DAILY:
+        days = (pdat - sdat).days + n_days + 1
+        rows = []
+        swtd = 200 * snx['h2o'] * 2
+        for das in range(days):
+            dap = das - (pdat - sdat).days
+            t = max(dap, 0) / n_days
+            prec = max(0.0, season.gauss(rain / n_days, 6)) if season.random() < 0.4 else 0.0
+            swtd = min(400.0, max(50.0, swtd + prec - 3.5 * f_water))
+            rows.append({'date': sdat + timedelta(days=das), 'DAS': das, 'DAP': dap,
+                         'LAID': round(out['LAIX'] * math.sin(math.pi * t) if dap >= 0 else 0, 2),
+                         'CWAD': int(out['CWAM'] / (1 + math.exp(-10 * (t - 0.5)))) if dap >= 0 else 0,
+                         'GWAD': int(HWAM * max(0.0, (t - 0.55) / 0.45)) if dap >= 0 else 0,
+                         'WSPD': round(1 - f_water * season.uniform(0.8, 1.0), 3), 'NSTD': round(1 - f_n, 3),
+                         'SWTD': int(swtd), 'PREC': int(prec), 'DRNC': int(max(0.0, swtd - 350))})
+        daily = rows
+    return out, daily
+
+# =============================================
+def osu_header():
+    parts = []
+    for name, width, text in OSU_COLS:
+        parts.append(name.ljust(width, '.') if text else name.rjust(width))
+    return '@' + ' '.join(parts)  #names end where the values of the rows end (' ' + values)
+
+def osu_row(values):
+    parts = []
+    for name, width, text in OSU_COLS:
+        v = values[name]
+        parts.append(str(v).ljust(width)[:width] if text else ('{:.3f}'.format(v) if isinstance(v, float) else str(v)).rjust(width))
+    return ' ' + ' '.join(parts)
+
+def daily_block(run, snx, model, columns, rows):
+    head = ['*DSSAT Cropping System Model Ver. 4.7.5.008 (stub)', '',
+            '*RUN {:>3}        : ET-SIMAGRI                {} {}    1'.format(run, model, snx['exname']),
+            ' MODEL          : ' + model, ' EXPERIMENT     : {} SN STUB'.format(snx['exname']),
+            ' TREATMENT  1   : ET-SIMAGRI                ' + model, '',
+            '@YEAR DOY   DAS   DAP' + ''.join('{:>7}'.format(c) for c in columns)]
+    for r in rows:
+        head.append(' {:4d} {:3d} {:5d} {:5d}'.format(r['date'].year, r['date'].timetuple().tm_yday, r['DAS'], r['DAP']) +
+                    ''.join('{:>7}'.format(r[c]) for c in columns))
+    return '\n'.join(head) + '\n\n'
+
+def main():
+    if len(sys.argv) < 4:
+        sys.exit('usage: dssat_stub.py <crop model> B DSSBatch.V47')
+    model, batch_fname = sys.argv[1], sys.argv[3]
+    snx_list = [read_snx(f) for f in read_batch(batch_fname)]
+    time.sleep(LATENCY * sum(s['n_years'] for s in snx_list))
+    summary = ['*SUMMARY : STUB     DSSAT Cropping System Model Ver. 4.7.5.008 (stub)', '',
+               '!IDENTIFIERS......................... EXPERIMENT AND TREATMENT.......... SITE INFORMATION',
+               osu_header()]
+    plantgro = ['*GROWTH ASPECTS OUTPUT FILE\n\n']
+    soilwat = ['*SOIL WATER DAILY OUTPUT FILE\n\n']
+    run = 0
+    for snx in snx_list:
+        for year in range(snx['first_year'], snx['first_year'] + snx['n_years']):
+            run += 1
+            values, daily = simulate(snx, year)
+            values.update({'RUNNO': run, 'TRNO': 1, 'R#': 1, 'O#': 0, 'P#': 1, 'CR': snx['crop'], 'MODEL': model,
+                           'EXNAME': snx['exname'], 'TNAM': 'ET-SIMAGRI', 'FNAM': snx['station'] + '0001',
+                           'WSTA': '{}{:02d}01'.format(snx['station'], year % 100), 'SOIL_ID': snx['soil']})
+            summary.append(osu_row(values))
+            if daily is not None:
+                plantgro.append(daily_block(run, snx, model, OPG_COLS, daily))
+                soilwat.append(daily_block(run, snx, model, OSW_COLS, daily))
+    if snx_list and snx_list[0]['fname']:
+        names = [snx_list[0]['exname'] + ext for ext in ('.OSU', '.OPG', '.OSW')]
+    else:
+        names = ['Summary.OUT', 'PlantGro.OUT', 'SoilWat.OUT']
+    with open(names[0], 'w') as f:
+        f.write('\n'.join(summary) + '\n')
+    if DAILY:
+        with open(names[1], 'w') as f:
+            f.write(''.join(plantgro))
+        with open(names[2], 'w') as f:
+            f.write(''.join(soilwat))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#End-to-end load test of the web app with the DSSAT stand-in (benchmarks/dssat_stub.py), no browser and no DSSAT
+# - N concurrent sessions, each: add scenarios (make_sce_table), "Simulate all scenarios" (run_create_figure,
+#   polled like the sim-interval does until the job is done) and the enterprise budget figures (EB_figure)
+# - the callbacks are called through the Flask test client (same POST /_dash-update-component requests as the browser)
+# - one run per worker configuration (batch mode x DSSAT worker processes x simulation job threads), each with an empty
+#   result cache. The worker processes only matter without batch mode (batch => one DSSAT launch per crop)
+# - reported: p50/p95/p99 latency of each request and of a whole session, sessions and scenarios per second
+#usage: python benchmarks/load_test.py [--sessions 20] [--scenarios 3] [--batch 1 0] [--workers 1 4] [--job-threads 1 2]
+#                                      [--latency 0.01] [--output load_test.json]
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from os import path
+from datetime import datetime
+
+import numpy as np
+
+REPO_PATH = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+STATIONS = [('MELK', 'ETET001_18'), ('AWAS', 'ETET000010'), ('BAKO', 'ETET000011')]
+FERT_TABLE = [{'DAP': 0, 'NAmount': 30}, {'DAP': 45, 'NAmount': 30}, {'DAP': -99, 'NAmount': -99}, {'DAP': -99, 'NAmount': -99}]
+EB_TABLE = [{'CropPrice': 5, 'NFertCost': 25, 'SeedCost': 600, 'OtherVariableCosts': 1500, 'FixedCosts': 1000}]
+
+# =============================================
+def setup_env(work_dir, latency):
+    #copy of TEST as SIMAGRI_WDIR, the stub as DSSAT executable; cache, workspaces and archive in work_dir
+    Wdir_path = path.join(work_dir, 'TEST')
+    shutil.copytree(path.join(REPO_PATH, 'TEST'), Wdir_path)
+    os.environ.update({'SIMAGRI_WDIR': Wdir_path + os.sep,
+                       'SIMAGRI_DSSAT_EXE': path.join(REPO_PATH, 'benchmarks', 'dssat_stub.py'),
+                       'SIMAGRI_WORKSPACE_ROOT': path.join(work_dir, 'workspaces'),
+                       'SIMAGRI_ARCHIVE_DIR': path.join(work_dir, 'archive'),
+                       'SIMAGRI_STUB_LATENCY': str(latency)})
+    os.environ.pop('SIMAGRI_SESSION_DIR', None)
+
+class Client:
+    #calls of the app callbacks through the Flask test client, found by one of their outputs
+    def __init__(self, app):
+        self.app = app
+        self.client = app.server.test_client()
+
+    def callback(self, output):
+        for key, spec in self.app.callback_map.items():
+            if output in key.strip('.').split('...'):
+                return key, spec
+        raise KeyError(output)
+
+    def call(self, output, values, trigger):
+        #values: {'id.property': value} for the inputs and states => ({'id.property': value} of the outputs, seconds)
+        key, spec = self.callback(output)
+        outputs = [dict(zip(('id', 'property'), o.rsplit('.', 1))) for o in key.strip('.').split('...')]
+        body = {'output': key, 'outputs': outputs if key.startswith('..') else outputs[0],
+                'inputs': [dict(i, value=values.get(i['id'] + '.' + i['property'])) for i in spec['inputs']],
+                'state': [dict(s, value=values.get(s['id'] + '.' + s['property'])) for s in spec['state']],
+                'changedPropIds': [trigger]}
+        t0 = time.perf_counter()
+        response = self.client.post('/_dash-update-component', json=body)
+        elapsed = time.perf_counter() - t0
+        if response.status_code == 204:  #PreventUpdate
+            return {}, elapsed
+        if response.status_code != 200:
+            raise RuntimeError('{} failed with HTTP {}'.format(output, response.status_code))
+        out = json.loads(response.get_data(as_text=True))['response']
+        return {i + '.' + p: v for i, props in out.items() for p, v in props.items()}, elapsed
+
+# =============================================
+def run_session(app, k, n_sce, poll, timings):
+    #one user: add n_sce scenarios, simulate, enterprise budget => timings[name].append(seconds)
+    import session_store
+    client = Client(app.app)  #app module => its dash.Dash
+    session_id = session_store.new_session_id()
+    t_session = time.perf_counter()
+    table = [{'Crop': 'N/A'}]
+    for i in range(n_sce):
+        station, soil = STATIONS[(k + i) % len(STATIONS)]
+        values = {'write-button-state.n_clicks': i + 1, 'ETstation.value': station, 'year1.value': '1981',
+                  'year2.value': '2010', 'plt-date-picker.date': '2021-{:02d}-15'.format(5 + (k + i) % 3),
+                  'crop-radio.value': 'MZ', 'cultivar-dropdown.value': 'CIMT01 BH540-Kassie', 'ETsoil.value': soil,
+                  'ini-H2O.value': '0.7', 'ini-NO3.value': 'H', 'plt-density.value': str(4 + (k * n_sce + i) % 5),
+                  'sce-name.value': '{:02d}{:02d}'.format(k % 100, i), 'target-year.value': '2000',
+                  'fert_input.value': 'Fert', 'fert-table.data': FERT_TABLE, 'EB_radio.value': 'EB_Yes',
+                  'EB-table.data': EB_TABLE, 'scenario-table.data': table}
+        out, elapsed = client.call('scenario-table.data', values, 'write-button-state.n_clicks')
+        timings['make_sce_table'].append(elapsed)
+        table = out['scenario-table.data']
+    table = [row for row in table if row.get('Crop') != 'N/A']  #placeholder row deleted as a user does
+
+    values = {'simulate-button-state.n_clicks': 1, 'sim-interval.n_intervals': 0, 'scenario-table.data': table,
+              'session-id.data': session_id}
+    t_simulate = time.perf_counter()
+    out, elapsed = client.call('sim-job-id.data', values, 'simulate-button-state.n_clicks')
+    timings['run_create_figure (submit)'].append(elapsed)
+    values['sim-job-id.data'] = out['sim-job-id.data']
+    while True:
+        time.sleep(poll)
+        values['sim-interval.n_intervals'] += 1
+        out, elapsed = client.call('sim-job-id.data', values, 'sim-interval.n_intervals')
+        timings['run_create_figure (poll)'].append(elapsed)
+        status = str(out.get('sim-status.children'))
+        if out.get('sim-interval.disabled'):
+            if not status.startswith('Simulation done'):
+                raise RuntimeError(status)
+            break
+    timings['simulation (click to figures)'].append(time.perf_counter() - t_simulate)
+
+    values = {'EB-button-state.n_clicks': 1, 'scenario-table.data': table, 'session-id.data': session_id}
+    out, elapsed = client.call('EBbox-container.children', values, 'EB-button-state.n_clicks')
+    timings['EB_figure'].append(elapsed)
+    if out.get('EB-status.children'):
+        raise RuntimeError(out['EB-status.children'])
+    timings['session'].append(time.perf_counter() - t_session)
+
+def run_config(app, batch, n_workers, n_threads, n_sessions, n_sce, poll, cache_dir):
+    #all sessions at once, each in its own thread
+    import dssat_runner
+    import result_cache
+    import sim_jobs
+    dssat_runner.BATCH_MODE = batch
+    dssat_runner.N_WORKERS = n_workers
+    app.sim_queue = sim_jobs.JobQueue(n_threads=n_threads)
+    app.sim_cache = result_cache.ResultCache(tempfile.mkdtemp(dir=cache_dir))  #empty cache => every scenario is run
+    timings = {name: [] for name in ['make_sce_table', 'run_create_figure (submit)', 'run_create_figure (poll)',
+                                     'simulation (click to figures)', 'EB_figure', 'session']}
+    errors = []
+
+    def session(k):
+        try:
+            run_session(app, k, n_sce, poll, timings)
+        except Exception as e:
+            errors.append('session {}: {}'.format(k, e))
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(k,)) for k in range(n_sessions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    n_done = len(timings['session'])
+    return {'batch': batch, 'workers': n_workers, 'job_threads': n_threads, 'sessions': n_sessions, 'scenarios_per_session': n_sce,
+            'wall_s': wall, 'sessions_per_s': n_done / wall, 'scenarios_per_s': n_done * n_sce / wall,
+            'errors': errors, 'latency_s': {name: percentiles(values) for name, values in timings.items()}}
+
+def percentiles(values):
+    if not values:
+        return {'n': 0}
+    p = np.percentile(values, [50, 95, 99])
+    return {'n': len(values), 'p50': p[0], 'p95': p[1], 'p99': p[2], 'max': max(values)}
+
+def print_config(result):
+    print('\nbatch={batch:d} workers={workers} job_threads={job_threads}: {sessions} sessions x {scenarios_per_session} scenarios in '
+          '{wall_s:.1f} s => {sessions_per_s:.2f} sessions/s, {scenarios_per_s:.1f} scenarios/s'.format(**result))
+    print('{:<32}{:>6}{:>10}{:>10}{:>10}'.format('request', 'n', 'p50[s]', 'p95[s]', 'p99[s]'))
+    for name, p in result['latency_s'].items():
+        if p['n']:
+            print('{:<32}{:>6}{:>10.3f}{:>10.3f}{:>10.3f}'.format(name, p['n'], p['p50'], p['p95'], p['p99']))
+    for error in result['errors']:
+        print('ERROR', error)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the app with the DSSAT stand-in')
+    parser.add_argument('--sessions', type=int, default=20, help='concurrent browser sessions')
+    parser.add_argument('--scenarios', type=int, default=3, help='scenarios added and simulated by each session')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1], choices=[0, 1], help='batch mode (SIMAGRI_BATCH)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='DSSAT worker processes (SIMAGRI_WORKERS)')
+    parser.add_argument('--job-threads', type=int, nargs='+', default=[1, 2], help='simulation job threads (SIMAGRI_JOB_THREADS)')
+    parser.add_argument('--latency', type=float, default=0.01, help='stub run time per simulated year [s]')
+    parser.add_argument('--poll', type=float, default=0.2, help='seconds between the status requests (sim-interval)')
+    parser.add_argument('--output', default='load_test.json', help='JSON file with the results')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='simagri_load_')
+    try:
+        setup_env(work_dir, args.latency)
+        import app  #after the environment is set: the app reads it at import
+        results = []
+        for batch in args.batch:
+            for n_workers in args.workers:
+                for n_threads in args.job_threads:
+                    results.append(run_config(app, bool(batch), n_workers, n_threads, args.sessions, args.scenarios,
+                                              args.poll, work_dir))
+                    print_config(results[-1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump({'meta': {'date': datetime.now().isoformat(timespec='seconds'), 'latency_per_year_s': args.latency,
+                            'poll_s': args.poll, 'cpu_count': os.cpu_count()}, 'results': results}, f, indent=1)
+    print('\nresults written into', args.output)
+    sys.exit(1 if any(r['errors'] for r in results) else 0)
+
+if __name__ == "__main__":
+    main()
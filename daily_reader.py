@@ -0,0 +1,131 @@
+#Streaming reader of the DSSAT daily outputs (*.OPG PlantGro, *.OSW SoilWat, *.OPN PlantN, *.OSN SoilNi, *.OWE Weather, ...)
+# - a file holds one block per run (= year): '*DSSAT ...', '*RUN n', ' EXPERIMENT : ETMZcccc ...', '@YEAR DOY DAS ...' header
+#   and the daily rows
+# - index: byte offsets of the header and rows of each run, built by one pass over the lines (nothing decoded)
+#   and kept while the file does not change => one run/year is read by seeking to its rows
+# - only the requested columns are decoded (fixed-width slices as in osu_reader) into float32/int32 arrays
+import os
+import threading
+from os import path
+
+import numpy as np
+
+import osu_reader
+
+#extension of the daily outputs named after the experiment (FNAME=Y) => name of the same output without FNAME
+DAILY_FILES = {'OPG': 'PlantGro.OUT', 'OSW': 'SoilWat.OUT', 'OPN': 'PlantN.OUT', 'OSN': 'SoilNi.OUT',
+               'OWE': 'Weather.OUT', 'OEB': 'ET.OUT', 'ONO': 'N2O.OUT'}
+
+_indexes = {}  #file name => (mtime_ns, size, runs)
+_indexes_lock = threading.Lock()
+
+# =============================================
+def scan_runs(f):
+    #one pass over a binary file => list of runs: {'run', 'exname', 'year', 'header', 'start', 'end', 'n_rows'}
+    #'start'/'end': byte offsets of the daily rows; 'block': offset of the '*DSSAT' line starting the run
+    runs = []
+    run = None
+    block = 0
+    offset = 0
+    for line in f:
+        if line.startswith(b'*DSSAT'):
+            block = offset
+        elif line.startswith(b'*RUN'):
+            run = {'run': int(line[4:].split()[0]), 'exname': '', 'year': None, 'header': None, 'block': block,
+                   'start': None, 'end': None, 'n_rows': 0}
+            runs.append(run)
+        elif run is not None and line.lstrip().startswith(b'EXPERIMENT'):
+            run['exname'] = line.split(b':', 1)[1].split()[0].decode()
+        elif run is not None and line.startswith(b'@'):
+            run['header'] = line.decode().rstrip('\r\n')
+            run['start'] = run['end'] = offset + len(line)
+        elif run is not None and run['header'] is not None and line.strip() and line[:1] not in b'*!':
+            if run['year'] is None:
+                run['year'] = int(line[:5])
+            run['end'] = offset + len(line)
+            run['n_rows'] += 1
+        offset += len(line)
+    return [r for r in runs if r['header'] is not None]
+
+def get_index(fname):
+    st = os.stat(fname)
+    with _indexes_lock:
+        cached = _indexes.get(fname)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+    with open(fname, 'rb') as f:
+        runs = scan_runs(f)
+    with _indexes_lock:
+        _indexes[fname] = (st.st_mtime_ns, st.st_size, runs)
+    return runs
+
+def decode_block(header, data, columns=None, missing=np.nan):
+    #daily rows of one run (bytes) => {column: float32 array} (YEAR, DOY, DAS, DAP as int32)
+    lines = [line for line in data.decode().splitlines() if line.strip() and line[0] not in '*!@']
+    if not lines:
+        names = [s[0] for s in osu_reader.header_spans(header)]
+        return {c: np.empty(0, dtype=np.float32) for c in (columns or names)}
+    values = osu_reader.decode_lines(header, lines, columns, missing)
+    return {c: v.astype(np.int32 if v.dtype.kind == 'i' else np.float32) for c, v in values.items()}
+
+# =============================================
+class DailyOutput:
+    def __init__(self, fname):
+        self.fname = fname
+        self.runs = get_index(fname)
+
+    def years(self):
+        return [r['year'] for r in self.runs]
+
+    def columns(self):
+        return [s[0] for s in osu_reader.header_spans(self.runs[0]['header'])] if self.runs else []
+
+    def read_run(self, i, columns=None, missing=np.nan):
+        #i-th run of the file (0-based); only its rows are read
+        run = self.runs[i]
+        with open(self.fname, 'rb') as f:
+            f.seek(run['start'])
+            data = f.read(run['end'] - run['start'])
+        return decode_block(run['header'], data, columns, missing)
+
+    def read_year(self, year, columns=None, missing=np.nan):
+        #run starting in year (None if that year was not simulated)
+        for i, run in enumerate(self.runs):
+            if run['year'] == int(year):
+                return self.read_run(i, columns, missing)
+        return None
+
+    def iter_runs(self, columns=None, missing=np.nan):
+        #walk the file one run at a time => (run info, {column: array})
+        with open(self.fname, 'rb') as f:
+            for run in self.runs:
+                f.seek(run['start'])
+                yield run, decode_block(run['header'], f.read(run['end'] - run['start']), columns, missing)
+
+    def stack(self, column, x='DAS'):
+        #one row per run, one column per day (aligned on x = DAS by default), NaN for the days missing in a run
+        #=> (years, x values, 2D float32 array)
+        runs = [(run, v) for run, v in self.iter_runs([x, column]) if len(v[x])]
+        if not runs:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty((0, 0), dtype=np.float32)
+        x_min = min(int(v[x].min()) for _, v in runs)
+        x_max = max(int(v[x].max()) for _, v in runs)
+        out = np.full((len(runs), x_max - x_min + 1), np.nan, dtype=np.float32)
+        for k, (run, v) in enumerate(runs):
+            out[k, v[x] - x_min] = v[column]
+        return np.array([r['year'] for r, _ in runs]), np.arange(x_min, x_max + 1, dtype=np.int32), out
+
+# =============================================
+def split_by_exname(fname):
+    #daily output of a batch run (runs of several experiments) => {EXNAME: text of its run blocks (with the file title)}
+    runs = get_index(fname)
+    with open(fname, 'rb') as f:
+        data = f.read()
+    title = data[:runs[0]['block']] if runs else b''
+    parts = {}
+    for run in runs:
+        parts.setdefault(run['exname'], [title]).append(data[run['block']:run['end']])
+    return {exname: b''.join(blocks).decode() for exname, blocks in parts.items()}
+
+def daily_fname(out_dir, crop, sname, ext):
+    return path.join(out_dir, "ET" + crop + sname + "." + ext)
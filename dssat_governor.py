@@ -0,0 +1,215 @@
+#Host-wide limit on the DSSAT processes: all web workers, job threads and pool processes of the host share
+#SIMAGRI_MAX_DSSAT slots (lock files in SIMAGRI_GOVERNOR_DIR, released by the OS if a process dies)
+# - a run waits for a free slot with a queue ticket => queue_position(owner) for the status messages
+# - each run is killed after SIMAGRI_DSSAT_TIMEOUT seconds per scenario of the launch (RunTimeout)
+# - a Token cancels the runs of its owner (e.g., a simulation job whose browser session went away) in any process:
+#   waiting runs leave the queue, running ones are killed (RunCancelled)
+# - stdout/stderr of DSSAT and its WARNING.OUT are written into DSSAT.LOG of the run directory
+import os
+import time
+import uuid
+import glob
+import tempfile
+import subprocess
+from os import path
+
+try:
+    import fcntl
+except ImportError:  #Windows
+    fcntl = None
+    import msvcrt
+
+MAX_PROCS = int(os.environ.get('SIMAGRI_MAX_DSSAT', os.cpu_count() or 1))
+TIMEOUT_S = float(os.environ.get('SIMAGRI_DSSAT_TIMEOUT', '300'))  #per scenario of a launch
+GOVERNOR_DIR = os.environ.get('SIMAGRI_GOVERNOR_DIR', path.join(tempfile.gettempdir(), 'simagri_dssat'))
+POLL_S = 0.2  #max. time between two checks of the process, the slots and the cancel token
+TICKET_TTL = 10  #queue tickets not refreshed for this many seconds (process gone) are ignored
+LOG_NAME = 'DSSAT.LOG'
+MAX_LOG_BYTES = 64 * 1024  #of WARNING.OUT added to DSSAT.LOG
+
+class RunCancelled(Exception):
+    pass
+
+class RunTimeout(Exception):
+    pass
+
+# =============================================
+class Token:
+    #cancellation of all the runs of one owner (file => seen by the pool processes and the other workers)
+    def __init__(self, owner):
+        self.owner = owner
+        self.fname = path.join(GOVERNOR_DIR, 'cancel', owner)
+
+    def cancel(self):
+        os.makedirs(path.dirname(self.fname), exist_ok=True)
+        open(self.fname, 'w').close()
+
+    def cancelled(self):
+        return path.exists(self.fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.fname)
+        except OSError:
+            pass
+
+def check(token):
+    if token is not None and token.cancelled():
+        raise RunCancelled('DSSAT run cancelled ({})'.format(token.owner))
+
+# =============================================
+def lock(f):
+    #non-blocking exclusive lock => True if acquired
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+def unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def try_slots():
+    #first free slot => its open (locked) lock file, None if all are busy
+    os.makedirs(GOVERNOR_DIR, exist_ok=True)
+    for i in range(MAX_PROCS):
+        f = open(path.join(GOVERNOR_DIR, 'slot-{:03d}.lock'.format(i)), 'a+')
+        if lock(f):
+            return f
+        f.close()
+    return None
+
+def tickets():
+    #queue tickets of the waiting runs (oldest first); stale ones are removed
+    now = time.time()
+    fresh = []
+    for fname in sorted(glob.glob(path.join(GOVERNOR_DIR, 'queue', '*'))):
+        try:
+            if now - path.getmtime(fname) < TICKET_TTL:
+                fresh.append(fname)
+            else:
+                os.remove(fname)
+        except OSError:  #removed meanwhile
+            pass
+    return fresh
+
+def queue_position(owner):
+    #1 + number of runs waiting before the first waiting run of owner, None if owner has no waiting run
+    for i, fname in enumerate(tickets()):
+        if path.basename(fname).split('_', 2)[2] == owner:
+            return i + 1
+    return None
+
+def status():
+    #busy slots (checked without blocking) and waiting runs of the host
+    busy = 0
+    for i in range(MAX_PROCS):
+        fname = path.join(GOVERNOR_DIR, 'slot-{:03d}.lock'.format(i))
+        if path.isfile(fname):
+            with open(fname, 'a+') as f:
+                if lock(f):
+                    unlock(f)
+                else:
+                    busy += 1
+    return {'slots': MAX_PROCS, 'busy': busy, 'waiting': len(tickets())}
+
+def acquire(token=None, owner=''):
+    #wait for a free slot => its lock file (release() after the run)
+    slot = try_slots()
+    if slot is not None:
+        return slot
+    os.makedirs(path.join(GOVERNOR_DIR, 'queue'), exist_ok=True)
+    ticket = path.join(GOVERNOR_DIR, 'queue', '{:020d}_{}_{}'.format(time.time_ns(), uuid.uuid4().hex[:8], owner))
+    open(ticket, 'w').close()
+    try:
+        while True:
+            check(token)
+            #runs queued before this one try first (up to the number of slots at once)
+            queue = tickets()
+            if ticket not in queue or queue.index(ticket) < MAX_PROCS:
+                slot = try_slots()
+                if slot is not None:
+                    return slot
+            time.sleep(POLL_S)
+            os.utime(ticket)
+    finally:
+        try:
+            os.remove(ticket)
+        except OSError:
+            pass
+
+def release(slot):
+    unlock(slot)
+    slot.close()
+
+# =============================================
+def run(args, cwd, n_sce=1, token=None):
+    #run DSSAT in a slot => (return code, CPU seconds or None, seconds waited for the slot)
+    owner = '' if token is None else token.owner
+    t0 = time.perf_counter()
+    slot = acquire(token, owner)
+    wait_seconds = time.perf_counter() - t0
+    try:
+        check(token)
+        log_fname = path.join(cwd, LOG_NAME)
+        with open(log_fname, 'w') as log:
+            proc = subprocess.Popen(args, cwd=cwd, stdout=log, stderr=subprocess.STDOUT) ##Run executable with argument
+            try:
+                cpu_seconds = wait(proc, TIMEOUT_S * n_sce, token)
+            except (RunCancelled, RunTimeout):
+                proc.kill()
+                proc.wait()
+                raise
+            append_warnings(cwd, log)
+    finally:
+        release(slot)
+    return proc.returncode, cpu_seconds, wait_seconds
+
+def wait(proc, timeout, token):
+    #end of the process (polled: the timeout and the token are checked in between) => CPU seconds (None without os.wait4)
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while True:
+        if hasattr(os, 'wait4'):
+            pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                return usage.ru_utime + usage.ru_stime
+            time.sleep(delay)
+        else:
+            try:
+                proc.wait(timeout=delay)
+                return None
+            except subprocess.TimeoutExpired:
+                pass
+        check(token)
+        if time.monotonic() > deadline:
+            raise RunTimeout('DSSAT run killed after {:g} s ({})'.format(timeout, ' '.join(proc.args)))
+        delay = min(2 * delay, POLL_S)
+
+def append_warnings(cwd, log):
+    #WARNING.OUT of this run (DSSAT appends to it) => end of DSSAT.LOG
+    fname = path.join(cwd, 'WARNING.OUT')
+    if path.isfile(fname):
+        with open(fname, 'r', errors='replace') as f:
+            text = f.read(MAX_LOG_BYTES)
+        log.write('\n*** WARNING.OUT ***\n' + text)
+
+def read_log(cwd, n_lines=20):
+    #last lines of DSSAT.LOG (e.g., for an error message)
+    fname = path.join(cwd, LOG_NAME)
+    if not path.isfile(fname):
+        return ''
+    with open(fname, 'r', errors='replace') as f:
+        return ''.join(f.readlines()[-n_lines:])
@@ -0,0 +1,342 @@
+#Helpers to run DSSAT for the scenarios in the scenario summary table
+# - serial mode  : original behaviour, each scenario is run one by one in Wdir_path with the shared DSSBatch.V47
+# - process pool : each scenario gets its own scratch directory (own DSSBatch.V47, SNX and static inputs)
+#                  and runs are spread over several worker processes
+# - batch mode   : all scenarios of a crop are listed in one DSSBatch.V47 => one DSSAT launch per crop model,
+#                  the combined summary output is split back into one *.OSU per scenario (by EXNAME),
+#                  and the daily outputs into one *.OPG, *.OSW, ... per scenario (by EXPERIMENT, daily_reader)
+# - out_dir      : directory of the SNX and outputs of the runs (e.g., workspace of a session); Wdir_path is then only read
+# - timings (run_metrics): V47 write, DSSAT wall and CPU time, split of the batch outputs. Runs in the process pool
+#   return their timings with their results (run_metrics.in_worker)
+# - the WTH files of the simulated years are written into the scratch directories from weather_store
+#   (memory-mapped arrays of each station), the raw station files are only read when the store is (re)built
+# - every DSSAT launch goes through dssat_governor (host-wide slots, timeout, cancellation with a Token);
+#   its console output and WARNING.OUT are copied back as <out_dir>/ETxx<sname>.LOG (ETxx_batch.LOG in batch mode)
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+from os import path
+from concurrent.futures import ProcessPoolExecutor
+
+import osu_reader
+import daily_reader
+import run_metrics
+import dssat_governor
+import weather_store
+
+#DSSAT crop model name (command line argument) and prefix of the genotype files (*.CUL, *.ECO, *.SPE)
+crop_model = {'WH': 'CSCER047', 'MZ': 'MZCER047', 'SG': 'SGCER047'}
+crop_genotype = {'WH': 'WHCER047', 'MZ': 'MZCER047', 'SG': 'SGCER047'}
+
+#number of worker processes. 1 => run scenarios one by one in Wdir_path (no process pool)
+N_WORKERS = int(os.environ.get('SIMAGRI_WORKERS', os.cpu_count() or 1))
+#parent directory for the per-run scratch directories (None => system temp directory)
+SCRATCH_ROOT = os.environ.get('SIMAGRI_SCRATCH')
+#1 => one DSSAT launch per crop model for all the scenarios to run (batch mode), 0 => one launch per scenario
+BATCH_MODE = os.environ.get('SIMAGRI_BATCH', '1') == '1'
+#max. number of scenarios per DSSAT launch in batch mode (the scenarios of a crop are also split over the workers)
+BATCH_SIZE = int(os.environ.get('SIMAGRI_BATCH_SIZE', '50'))
+
+_pool = None
+_pool_size = 0
+_weather = {}  #Wdir_path => weather_store.WeatherStore (one per process, also in the pool workers)
+
+# =============================================
+def get_pool(n_workers):
+    #process pool is kept alive between callbacks to avoid paying the process start-up for every click
+    global _pool, _pool_size
+    if _pool is None or _pool_size != n_workers:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = ProcessPoolExecutor(max_workers=n_workers)
+        _pool_size = n_workers
+    return _pool
+
+def in_pool(pool, func, *iterables):
+    #pool.map(func, ...) with the timings of the worker processes added to the metrics of this process
+    for result, records in pool.map(run_metrics.in_worker, *([func] * len(iterables[0]),) + iterables):
+        run_metrics.replay(records)
+        yield result
+
+# =============================================
+def get_exe(Wdir_path):
+    return os.environ.get('SIMAGRI_DSSAT_EXE', path.join(Wdir_path, "DSCSM047.EXE"))
+
+def snx_name(crop, sname):
+    return "ET" + crop + sname + ".SNX"
+
+def osu_name(crop, sname):
+    return "ET" + crop + sname + ".OSU"
+
+def exname(crop, sname):
+    #EXNAME in the DSSAT outputs (name of the SNX file without extension, max. 8 characters)
+    return ("ET" + crop + sname)[:8]
+
+def check_names(crops, snames):
+    #scenario names must give distinct SNX/EXNAME (the outputs are matched by EXNAME) => ValueError otherwise
+    seen = set()
+    for crop, sname in zip(crops, snames):
+        sname = '' if sname is None else str(sname)
+        if not 1 <= len(sname) <= 8 - len("ET" + crop) or not sname.isalnum():
+            raise ValueError("scenario name '{}' must have 1 to {} letters or digits".format(sname, 8 - len("ET" + crop)))
+        if exname(crop, sname) in seen:
+            raise ValueError("scenario name '{}' is used twice for crop {}".format(sname, crop))
+        seen.add(exname(crop, sname))
+
+# =============================================
+def writeV47(Wdir_path, run_dir, crop, SNX_fname):
+    #write DSSBatch.V47 into run_dir pointing to SNX_fname, using the crop-specific template in Wdir_path
+    return writeV47_batch(Wdir_path, run_dir, crop, [SNX_fname])
+
+def writeV47_batch(Wdir_path, run_dir, crop, SNX_fnames):
+    #write DSSBatch.V47 into run_dir with one line (treatment 1) per SNX file
+    t0 = time.perf_counter()
+    temp_dv7 = path.join(Wdir_path, "DSSBatch_template_" + crop + ".V47")
+    dv7_fname = path.join(run_dir, "DSSBatch.V47")
+    fr = open(temp_dv7, "r")  # opens temp DV4 file to read
+    fw = open(dv7_fname, "w")
+    # read template and write lines
+    for line in range(0, 10):
+        temp_str = fr.readline()
+        fw.write(temp_str)
+
+    temp_str = fr.readline()
+    for SNX_fname in SNX_fnames:
+        new_str2 = '{0:<95}{1:4s}'.format(path.normpath(SNX_fname), repr(1).rjust(4)) + temp_str[99:]
+        fw.write(new_str2 if new_str2.endswith('\n') else new_str2 + '\n')
+    fr.close()
+    fw.close()
+    run_metrics.record('v47_write', time.perf_counter() - t0, crop=crop, scenarios=len(SNX_fnames))
+    return dv7_fname
+
+# =============================================
+def link_or_copy(src, dst):
+    #hard link if possible (same file system, no extra disk space), otherwise copy
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def get_weather(Wdir_path):
+    if Wdir_path not in _weather:
+        _weather[Wdir_path] = weather_store.WeatherStore(Wdir_path, path.join(Wdir_path, "cache", "weather"))
+    return _weather[Wdir_path]
+
+def write_weather(Wdir_path, run_dir, stations, years=None):
+    #WTH files of each station written into run_dir from the weather store
+    #years: (FirstYear, LastYear) of each scenario => only these years (+ the next one for the seasons ending in it),
+    #None => all years of the station. Years without weather data are skipped (weather_store.report_missing)
+    wanted = {}
+    for k, station in enumerate(stations):
+        first, last = years[k] if years is not None and years[k] is not None else (None, None)
+        if not first or not last or wanted.get(station, set()) is None:
+            wanted[station] = None
+        else:
+            wanted.setdefault(station, set()).update(range(int(first), int(last) + 2))
+    for station, station_years in sorted(wanted.items()):
+        try:
+            weather = get_weather(Wdir_path).get(station)
+        except KeyError:  #no WTH file for this station => DSSAT reports it
+            continue
+        if station_years is not None:
+            station_years = sorted(station_years & set(weather.years.tolist()))
+        weather.write_wth(run_dir, station_years)
+
+def make_run_dir(Wdir_path, crop, sname, station, snx_dir=None, years=None):
+    #scratch directory with its own copy of the SNX and the static inputs (CUL/ECO/SPE/SOL/WTH)
+    return make_batch_dir(Wdir_path, crop, [sname], [station], prefix="ET" + crop + sname + "_", snx_dir=snx_dir,
+                          years=None if years is None else [years])
+
+def make_batch_dir(Wdir_path, crop, snames, stations, prefix=None, link_snx=True, snx_dir=None, years=None):
+    #scratch directory with the SNX of all scenarios in snames (in snx_dir, default Wdir_path) and the static inputs they need
+    #(WTH files of the simulated years written from the weather store, years: (FirstYear, LastYear) of each scenario)
+    run_dir = tempfile.mkdtemp(prefix=prefix or "ET" + crop + "_batch_", dir=SCRATCH_ROOT)
+    static_files = [path.join(Wdir_path, crop_genotype[crop] + ext) for ext in (".CUL", ".ECO", ".SPE")]
+    static_files.append(path.join(Wdir_path, "ET.SOL"))
+    write_weather(Wdir_path, run_dir, stations, years)
+    if link_snx:
+        static_files.extend(path.join(snx_dir or Wdir_path, snx_name(crop, sname)) for sname in snames)
+    for fname in static_files:
+        if path.isfile(fname):
+            link_or_copy(fname, path.join(run_dir, path.basename(fname)))
+    return run_dir
+
+# =============================================
+def exe_command(Wdir_path):
+    #a Python stand-in for the executable (e.g., benchmarks/dssat_stub.py) is run with this interpreter (any OS)
+    exe = get_exe(Wdir_path)
+    return [sys.executable, exe] if exe.endswith(".py") else [exe]
+
+def run_DSSAT(Wdir_path, run_dir, crop, n_sce=1, token=None, **labels):
+    #one DSSAT launch for n_sce scenarios in a governor slot (RunTimeout, RunCancelled if token is cancelled)
+    #labels: station, scenario, ... of the 'dssat' timing (wall time + CPU time of the process where os.wait4 exists)
+    args = exe_command(Wdir_path) + [crop_model[crop], "B", "DSSBatch.V47"]
+    t0 = time.perf_counter()
+    returncode, cpu_seconds, wait_seconds = dssat_governor.run(args, run_dir, n_sce, token)
+    run_metrics.record('dssat_wait', wait_seconds, crop=crop, **labels)
+    run_metrics.record('dssat', time.perf_counter() - t0 - wait_seconds, cpu_seconds, crop=crop, returncode=returncode,
+                       scenarios=n_sce, **labels)
+    if returncode != 0:
+        print('WARNING: DSSAT returned {} in {}:\n{}'.format(returncode, run_dir, dssat_governor.read_log(run_dir)))
+    return returncode
+
+def copy_log(run_dir, out_dir, name):
+    #console output + WARNING.OUT of the run => out_dir
+    fname = path.join(run_dir, dssat_governor.LOG_NAME)
+    if path.isfile(fname):
+        shutil.copy2(fname, path.join(out_dir, name + ".LOG"))
+
+def run_scenario_inplace(Wdir_path, crop, sname, station=None, token=None):
+    #original mode: shared DSSBatch.V47 and outputs in Wdir_path
+    writeV47(Wdir_path, Wdir_path, crop, path.join(Wdir_path, snx_name(crop, sname)))
+    run_DSSAT(Wdir_path, Wdir_path, crop, token=token, station=station, scenario=sname)
+    copy_log(Wdir_path, Wdir_path, "ET" + crop + sname)
+    return path.join(Wdir_path, osu_name(crop, sname))
+
+def run_scenario_sandbox(Wdir_path, crop, sname, station, out_dir=None, token=None, years=None):
+    #run one scenario in its own scratch directory and copy its outputs (ETxx<sname>.*) back to out_dir (default Wdir_path)
+    out_dir = out_dir or Wdir_path
+    run_dir = make_run_dir(Wdir_path, crop, sname, station, snx_dir=out_dir, years=years)
+    try:
+        writeV47(Wdir_path, run_dir, crop, path.join(run_dir, snx_name(crop, sname)))
+        try:
+            run_DSSAT(Wdir_path, run_dir, crop, token=token, station=station, scenario=sname)
+        finally:
+            copy_log(run_dir, out_dir, "ET" + crop + sname)
+        for fname in glob.glob(path.join(run_dir, "ET" + crop + sname + ".*")):
+            if not fname.upper().endswith(".SNX"):
+                shutil.copy2(fname, path.join(out_dir, path.basename(fname)))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return path.join(out_dir, osu_name(crop, sname))
+
+def run_batch(Wdir_path, crop, snames, stations, snx_texts=None, out_dir=None, token=None, years=None):
+    #run all scenarios of one crop with a single DSSAT launch in a scratch directory
+    #the combined summary output is split by EXNAME into ETxx<sname>.OSU files in out_dir (default Wdir_path)
+    #snx_texts: SNX of each scenario rendered in memory (written only into the scratch directory), None => SNX in out_dir
+    out_dir = out_dir or Wdir_path
+    run_dir = make_batch_dir(Wdir_path, crop, snames, stations, link_snx=snx_texts is None, snx_dir=out_dir, years=years)
+    try:
+        if snx_texts is not None:
+            write_snx_texts(run_dir, crop, snames, snx_texts)
+        writeV47_batch(Wdir_path, run_dir, crop, [path.join(run_dir, snx_name(crop, sname)) for sname in snames])
+        labels = run_metrics.labels_of([crop], stations)
+        try:
+            run_DSSAT(Wdir_path, run_dir, crop, n_sce=len(snames), token=token, station=labels['station'])
+        finally:
+            copy_log(run_dir, out_dir, "ET" + crop + "_batch")
+        #outputs are named after the SNX (FNAME=Y) or Summary.OUT; both may hold the rows of several experiments
+        t0 = time.perf_counter()
+        parts = {}
+        for fname in glob.glob(path.join(run_dir, "*.OSU")) + glob.glob(path.join(run_dir, "Summary.OUT")):
+            with open(fname, "r") as f:
+                parts.update(osu_reader.split_by_exname(f.read()))
+        fout_names = []
+        for sname in snames:
+            fout_name = path.join(out_dir, osu_name(crop, sname))
+            if exname(crop, sname) in parts:
+                with open(fout_name, "w") as f:
+                    f.write(parts[exname(crop, sname)])
+            elif path.isfile(fout_name):  #no result for this scenario => do not leave the output of a previous run
+                os.remove(fout_name)
+            fout_names.append(fout_name)
+        #daily outputs (*.OPG, *.OSW, ... or PlantGro.OUT, SoilWat.OUT, ...) are split by EXPERIMENT the same way
+        for ext, out_name in daily_reader.DAILY_FILES.items():
+            parts = {}
+            for fname in glob.glob(path.join(run_dir, "*." + ext)) + glob.glob(path.join(run_dir, out_name)):
+                for name, text in daily_reader.split_by_exname(fname).items():
+                    #runs of the same experiment in several files => file title only once
+                    parts[name] = parts[name] + text[text.find('*DSSAT'):] if name in parts else text
+            for sname in snames:
+                fout_name = daily_reader.daily_fname(out_dir, crop, sname, ext)
+                if exname(crop, sname) in parts:
+                    with open(fout_name, "w") as f:
+                        f.write(parts[exname(crop, sname)])
+                elif path.isfile(fout_name):
+                    os.remove(fout_name)
+        #other per-experiment outputs (if any) are copied back as in the other modes
+        skip = tuple("." + ext for ext in ["SNX", "OSU"] + list(daily_reader.DAILY_FILES))
+        for sname in snames:
+            for fname in glob.glob(path.join(run_dir, "ET" + crop + sname + ".*")):
+                if not fname.upper().endswith(skip):
+                    shutil.copy2(fname, path.join(out_dir, path.basename(fname)))
+        run_metrics.record('osu_split', time.perf_counter() - t0, scenarios=len(snames), **labels)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return fout_names
+
+def write_snx_texts(out_dir, crop, snames, snx_texts):
+    for sname, text in zip(snames, snx_texts):
+        with open(path.join(out_dir, snx_name(crop, sname)), "w") as f:
+            f.write(text)
+
+# =============================================
+def run_scenarios(Wdir_path, dff, n_workers=None, progress=None, batch=None, snx_texts=None, out_dir=None, token=None):
+    #run all scenarios in dff (scenario summary table) and return the list of *.OSU names in the same order as dff
+    #progress(n_done) is called after each scenario (after each sub-batch in batch mode)
+    #snx_texts: SNX of each scenario (snx_template.render_row), None => SNX files already written in out_dir
+    #out_dir: directory of the SNX and outputs (default Wdir_path). With another directory, nothing is written into Wdir_path
+    #token: dssat_governor.Token cancelling the runs (e.g., of a simulation job)
+    out_dir = out_dir or Wdir_path
+    if n_workers is None:
+        n_workers = N_WORKERS
+    if batch is None:
+        batch = BATCH_MODE
+    crops = list(dff.Crop.values)
+    snames = list(dff.sce_name.values)
+    stations = list(dff.stn_name.values)
+    #simulated years of each scenario => WTH files of these years only (all years of the station without these columns)
+    years = list(zip(dff.FirstYear.values, dff.LastYear.values)) if 'FirstYear' in dff and 'LastYear' in dff else [None] * len(snames)
+    check_names(crops, snames)
+    if batch:
+        return run_scenarios_batch(Wdir_path, crops, snames, stations, n_workers, progress, snx_texts, out_dir, token, years)
+    if snx_texts is not None:
+        for crop, sname, text in zip(crops, snames, snx_texts):
+            write_snx_texts(out_dir, crop, [sname], [text])
+    if (n_workers <= 1 or len(snames) <= 1) and path.samefile(out_dir, Wdir_path):
+        results = (run_scenario_inplace(Wdir_path, crops[i], snames[i], stations[i], token) for i in range(len(snames)))
+    elif n_workers <= 1 or len(snames) <= 1:  #one by one, but the static inputs are not in out_dir => scratch directories
+        results = (run_scenario_sandbox(Wdir_path, crops[i], snames[i], stations[i], out_dir, token, years[i])
+                   for i in range(len(snames)))
+    else:
+        pool = get_pool(n_workers)
+        #executor.map keeps the order of the inputs, so the outputs are merged in the same order as the table
+        n = len(snames)
+        results = in_pool(pool, run_scenario_sandbox, [Wdir_path] * n, crops, snames, stations, [out_dir] * n, [token] * n, years)
+    fout_names = []
+    for fout_name in results:
+        fout_names.append(fout_name)
+        if progress is not None:
+            progress(len(fout_names))
+    return fout_names
+
+def run_scenarios_batch(Wdir_path, crops, snames, stations, n_workers, progress=None, snx_texts=None, out_dir=None, token=None,
+                        years=None):
+    #one DSSAT launch per sub-batch of the scenarios of a crop model: each crop is split into n_workers sub-batches
+    #(more if they would have more than BATCH_SIZE scenarios), run in the process pool, each in its own scratch directory
+    groups = {}  #crop => indices of its scenarios
+    for i, crop in enumerate(crops):
+        groups.setdefault(crop, []).append(i)
+    batches = []  #(crop, indices of the scenarios of the sub-batch)
+    for crop, idx in groups.items():
+        n_sub = min(len(idx), max(n_workers, -(-len(idx) // BATCH_SIZE)))
+        batches.extend((crop, idx[len(idx) * k // n_sub:len(idx) * (k + 1) // n_sub]) for k in range(n_sub))
+    args = [(Wdir_path, crop, [snames[i] for i in idx], [stations[i] for i in idx],
+             None if snx_texts is None else [snx_texts[i] for i in idx], out_dir, token,
+             None if years is None else [years[i] for i in idx]) for crop, idx in batches]
+    if n_workers <= 1 or len(batches) <= 1:
+        results = (run_batch(*a) for a in args)
+    else:
+        results = in_pool(get_pool(n_workers), run_batch, *zip(*args))
+    fout_names = [None] * len(snames)
+    n_done = 0
+    for (crop, idx), batch_names in zip(batches, results):
+        for i, fout_name in zip(idx, batch_names):
+            fout_names[i] = fout_name
+        n_done += len(idx)
+        if progress is not None:
+            progress(n_done)
+    return fout_names
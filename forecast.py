@@ -0,0 +1,101 @@
+#Seasonal forecast ensembles: tercile probabilities of the season rainfall (below/near/above normal) => weights of the
+#historical years of each scenario, and realizations drawn by weighted resampling of these years
+# - the years of a scenario are split into terciles of their rainfall in the forecast season (the 3-month season starting
+#   in the planting year, from the weather_store arrays); a year of tercile k gets weight p_k / number of years in k
+# - a realization is a whole historical season (weather of one year), so its yield is the yield simulated for that year:
+#   the ensemble reuses the historical run of the scenario (cache, atlas or DSSAT) instead of one DSSAT run per member
+# - the members of all scenarios are drawn at once (inverse CDF of the cumulated weights with np.searchsorted)
+import numpy as np
+
+import sim_stats
+
+SEASONS = ['JFM', 'FMA', 'MAM', 'AMJ', 'MJJ', 'JJA', 'JAS', 'ASO', 'SON', 'OND', 'NDJ', 'DJF']  #start month = index + 1
+N_MEMBERS = 500
+MAX_MEMBERS = 5000
+SEED = 0  #same forecast => same members (figures do not change when the simulation is run again)
+
+# =============================================
+def parse_forecast(season, below, normal, above, n_members):
+    #inputs of the forecast panel => {'season', 'probs' (fractions), 'members'}; ValueError with a message for the user
+    if season not in SEASONS:
+        raise ValueError("select a forecast season")
+    try:
+        probs = np.array([float(below), float(normal), float(above)])
+        n_members = int(n_members or N_MEMBERS)
+    except (TypeError, ValueError):
+        raise ValueError("enter the probabilities of the three terciles and the number of realizations")
+    if (probs < 0).any() or abs(probs.sum() - 100) > 1:
+        raise ValueError("tercile probabilities must add up to 100% (now {:g}%)".format(probs.sum()))
+    if not 10 <= n_members <= MAX_MEMBERS:
+        raise ValueError("number of realizations must be between 10 and {}".format(MAX_MEMBERS))
+    return {'season': season, 'probs': (probs / probs.sum()).tolist(), 'members': n_members}
+
+def season_rainfall(station_weather, years, season):
+    #rainfall [mm] of the 3-month season starting in each year (NaN if a day of the season is missing)
+    start_month = SEASONS.index(season) + 1
+    years = np.asarray(years)
+    dates = np.asarray(station_weather.dates)
+    rain = np.asarray(station_weather.var('RAIN'), dtype=np.float64)
+    day = (dates // 1000 - 1970).astype('datetime64[Y]').astype('datetime64[D]') + (dates % 1000 - 1)
+    month = day.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    offset = (month - start_month) % 12  #months since the start of the season (0-2 => in the season)
+    season_year = dates // 1000 - (month < start_month)  #e.g., January of a DJF season => season of the year before
+    first = int(years.min()) if len(years) else 0
+    k = season_year - first
+    sel = (offset < 3) & (k >= 0) & (k <= (years.max() - first if len(years) else -1))
+    n_year = int(years.max()) - first + 1 if len(years) else 0
+    total = np.bincount(k[sel], weights=np.where(rain[sel] < 0, np.nan, rain[sel]), minlength=n_year)
+    n_days = np.bincount(k[sel], minlength=n_year)
+    #complete seasons only: number of days of the 3 months in that year
+    start = (np.arange(n_year) + first - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (start_month - 1)
+    expected = ((start + 3).astype('datetime64[D]') - start.astype('datetime64[D]')).astype(np.int64)
+    total = np.where(n_days == expected, total, np.nan)
+    return total[years - first] if len(years) else total
+
+def year_weights(rain, isce, n_sce, probs):
+    #weight of each simulated year (rows of the results, scenario index isce) from its rainfall tercile; sum 1 by scenario
+    #years without season rainfall get no weight; a tercile without years => its probability goes to the others
+    rain = np.asarray(rain, dtype=float)
+    ok = np.isfinite(rain)
+    q = sim_stats.quantiles(rain[ok], isce[ok], n_sce, q=(1 / 3, 2 / 3))
+    cat = (rain > q[isce, 0]).astype(np.int64) + (rain > q[isce, 1])
+    counts = np.bincount((isce * 3 + cat)[ok], minlength=3 * n_sce).reshape(n_sce, 3)
+    weights = np.where(ok, np.asarray(probs)[cat] / np.maximum(counts[isce, cat], 1), 0.0)
+    total = np.bincount(isce, weights=weights, minlength=n_sce)
+    return np.where(total[isce] > 0, weights / np.where(total[isce] > 0, total[isce], 1), 0.0), cat
+
+def draw_members(weights, isce, n_sce, n_members, seed=SEED):
+    #n_members rows of each scenario drawn with their weights => (row indices, scenario of each member)
+    #rows must be sorted by scenario (results_store.make_table); scenarios without weights get no members
+    order = np.argsort(isce, kind='stable')
+    cum = np.cumsum(weights[order])
+    total = np.bincount(isce, weights=weights, minlength=n_sce)
+    has = np.flatnonzero(total > 0)
+    base = np.concatenate([[0.0], np.cumsum(total)])[has]  #cumulated weight before each scenario
+    u = base[:, None] + np.random.default_rng(seed).random((len(has), n_members)) * total[has, None]
+    rows = order[np.minimum(np.searchsorted(cum, u.ravel(), side='right'), len(order) - 1)]
+    member_sce = np.repeat(has, n_members)
+    #rounding of the cumulated sums may give the first row of the next scenario => last weighted row of the scenario
+    wrong = isce[rows] != member_sce
+    if wrong.any():
+        last = np.zeros(n_sce, dtype=np.int64)
+        weighted = order[weights[order] > 0]
+        last[isce[weighted]] = weighted  #rows sorted by scenario => the last one of each scenario is kept
+        rows[wrong] = last[member_sce[wrong]]
+    return rows, member_sce
+
+def ensemble(store, stations, sim_table, fcst, seed=SEED):
+    #forecast members of all scenarios: stations (of each scenario), sim_table (results_store.make_table)
+    #=> (rows of sim_table drawn, scenario of each member, tercile of each row)
+    isce = sim_table['SCE']
+    n_sce = len(stations)
+    years = np.where(sim_table['PDAT'] > 0, sim_table['PDAT'] // 1000, -1)
+    rain = np.full(len(isce), np.nan)
+    station_of_row = np.asarray(stations)[isce]
+    for station in set(stations):
+        rows = np.flatnonzero((station_of_row == station) & (years > 0))
+        if len(rows):
+            rain[rows] = season_rainfall(store.get(station), years[rows], fcst['season'])
+    weights, cat = year_weights(rain, isce, n_sce, fcst['probs'])
+    rows, member_sce = draw_members(weights, isce, n_sce, fcst['members'], seed)
+    return rows, member_sce, cat
@@ -0,0 +1,123 @@
+#Reader for DSSAT summary outputs (*.OSU, Summary.OUT)
+# - columns are found by name from the '@' header row (no fixed column numbers)
+# - fields are decoded as fixed-width slices of the lines (TNAM with spaces is read correctly)
+# - only the requested columns are decoded, straight into typed numpy arrays
+import numpy as np
+
+#text columns of the summary output. Other columns are numbers (int64 if no decimal point in the column, else float64)
+TEXT_COLS = {'CR', 'MODEL', 'EXNAME', 'TNAM', 'FNAM', 'WSTA', 'SOIL_ID'}
+MISSING = -99  #DSSAT missing value
+
+# =============================================
+def header_spans(header):
+    #(name, start, end) of each column from the '@' header line
+    #DSSAT numbers are right-aligned under the column name => a field starts right after the end of the previous name
+    spans = []
+    prev_end = 1  #skip '@'
+    pos = 1
+    n = len(header)
+    while pos < n:
+        while pos < n and header[pos] == ' ':
+            pos += 1
+        if pos >= n:
+            break
+        start = pos
+        while pos < n and header[pos] != ' ':
+            pos += 1
+        spans.append((header[start:pos].rstrip('.'), prev_end, pos))
+        prev_end = pos
+    return spans
+
+def split_osu(text):
+    #header line and data lines of a summary output
+    lines = text.splitlines()
+    for n_header, line in enumerate(lines):
+        if line.startswith('@'):
+            break
+    else:
+        raise ValueError("no '@' header line in summary output")
+    data = [line for line in lines[n_header + 1:] if line.strip() and line[0] not in '*!@']
+    return lines[n_header], data
+
+# =============================================
+def decode_column(block, name, start, end, missing):
+    #block: 2D uint8 array (rows x characters). Returns the typed array of one column
+    field = np.ascontiguousarray(block[:, start:end]).view('S%d' % (end - start)).ravel()
+    if name in TEXT_COLS:
+        return np.char.strip(field.astype(str))
+    blank = ((block[:, start:end] == 32) | (block[:, start:end] == 0)).all(axis=1)
+    if blank.any():
+        field = field.copy()
+        field[blank] = str(MISSING).encode()
+    if (block[:, start:end] == ord('.')).any():
+        values = field.astype(np.float64)
+    else:
+        values = field.astype(np.int64)
+    if missing is not None:
+        is_missing = values == MISSING
+        if is_missing.any():
+            values = values.astype(np.float64)
+            values[is_missing] = missing
+    return values
+
+def decode_lines(header, lines, columns=None, missing=np.nan):
+    spans = header_spans(header)
+    names = [s[0] for s in spans]
+    if columns is None:
+        columns = names
+    missing_cols = [c for c in columns if c not in names]
+    if missing_cols:
+        raise KeyError("columns not in summary output: " + ", ".join(missing_cols))
+    width = max([len(header)] + [len(line) for line in lines])
+    block = np.array([line.encode() for line in lines], dtype='S%d' % width).view(np.uint8).reshape(len(lines), width)
+    span_of = {s[0]: s for s in spans}
+    return {c: decode_column(block, *span_of[c], missing) for c in columns}
+
+# =============================================
+def read_osu(fname, columns=None, missing=np.nan):
+    #read one summary output => {column name: numpy array}
+    #missing: value used for the -99 sentinel in numeric columns (None => keep -99)
+    with open(fname, 'r') as f:
+        header, lines = split_osu(f.read())
+    return decode_lines(header, lines, columns, missing)
+
+def read_osu_many(fnames, columns=None, missing=np.nan):
+    #read many summary outputs into one columnar table. 'FILE' is the index of the file in fnames for each row
+    #files with the same header are decoded together (one slice per column for all their rows)
+    groups = {}  #header => (list of data lines, list of file index per line)
+    for ifile, fname in enumerate(fnames):
+        with open(fname, 'r') as f:
+            header, lines = split_osu(f.read())
+        group = groups.setdefault(header, ([], []))
+        group[0].extend(lines)
+        group[1].extend([ifile] * len(lines))
+    parts = []
+    for header, (lines, file_index) in groups.items():
+        part = decode_lines(header, lines, columns, missing)
+        part['FILE'] = np.array(file_index, dtype=np.int32)
+        parts.append(part)
+    if not parts:
+        return {}
+    table = {c: np.concatenate([p[c] for p in parts]) for c in parts[0]}
+    if len(parts) > 1:  #keep the order of fnames
+        order = np.argsort(table['FILE'], kind='stable')
+        table = {c: v[order] for c, v in table.items()}
+    return table
+
+# =============================================
+def split_by_exname(text):
+    #combined summary output of a batch run (several experiments) => {EXNAME: text of a summary output with its rows only}
+    #the lines before the first data row (title, '!' and '@' header) are kept in each part
+    lines = text.splitlines()
+    for n_header, line in enumerate(lines):
+        if line.startswith('@'):
+            break
+    else:
+        raise ValueError("no '@' header line in summary output")
+    _, start, end = [s for s in header_spans(lines[n_header]) if s[0] == 'EXNAME'][0]
+    head = lines[:n_header + 1]
+    parts = {}
+    for line in lines[n_header + 1:]:
+        if line.strip() and line[0] not in '*!@':
+            parts.setdefault(line[start:end].strip(), []).append(line)
+    return {exname: "\n".join(head + rows) + "\n" for exname, rows in parts.items()}
@@ -0,0 +1,146 @@
+#Cache of simulated results keyed by a hash of the scenario inputs
+# - key  : everything that goes into the SNX (station, years, planting date, crop, cultivar, soil, iH2O, iNO3, density, fertilizer)
+#          + the version (content hash) of the templates, DSSAT executable, CUL/ECO/SPE, SOL and WTH files
+# - tiers: bounded in-memory LRU per process + on-disk *.npz shared by all gunicorn workers
+import os
+import glob
+import json
+import hashlib
+import tempfile
+import threading
+from os import path
+from collections import OrderedDict
+
+import numpy as np
+
+import dssat_runner
+
+#columns of the scenario summary table that reach the SNX (snx_template.render_row)
+SCE_KEY_COLS = ["Crop", "Cultivar", "stn_name", "Plt-date", "FirstYear", "LastYear", "soil", "iH2O", "iNO3", "plt_density"]
+FERT_COLS = [("1_Fert(DOY)", "1_Fert(Kg/ha)"), ("2_Fert(DOY)", "2_Fert(Kg/ha)"),
+             ("3_Fert(DOY)", "3_Fert(Kg/ha)"), ("4_Fert(DOY)", "4_Fert(Kg/ha)")]
+
+CACHE_SIZE = int(os.environ.get('SIMAGRI_CACHE_SIZE', '256'))  #max. number of scenarios kept in memory
+CACHE_DIR = os.environ.get('SIMAGRI_CACHE_DIR')  #None => <Wdir_path>/cache
+
+_file_hashes = {}  #fname => (mtime, size, sha256 of the file content), only the latest version of each file
+
+# =============================================
+def file_hash(fname):
+    #content hash, recomputed only when mtime or size changes
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return 'missing'
+    memo = _file_hashes.get(fname)
+    if memo is None or memo[:2] != (st.st_mtime_ns, st.st_size):
+        h = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        memo = _file_hashes[fname] = (st.st_mtime_ns, st.st_size, h.hexdigest())
+    return memo[2]
+
+def input_files_version(Wdir_path, crop, station):
+    #model/template/input files used by a run of this crop at this station
+    fnames = [path.join(Wdir_path, "TEMP_ET" + crop + ".SNX"),
+              path.join(Wdir_path, "DSSBatch_template_" + crop + ".V47"),
+              dssat_runner.get_exe(Wdir_path),
+              path.join(Wdir_path, "ET.SOL")]
+    fnames.extend(path.join(Wdir_path, dssat_runner.crop_genotype[crop] + ext) for ext in (".CUL", ".ECO", ".SPE"))
+    fnames.extend(sorted(glob.glob(path.join(Wdir_path, station + "*.WTH"))))
+    return {path.basename(f): file_hash(f) for f in fnames}
+
+# =============================================
+def _number(value):
+    #'6', '6.0' and 6 give the same SNX => same canonical value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value).strip()
+
+def fert_list(row):
+    #fertilizer applications as written into the SNX (only rows with DAP >= 0 and amount >= 0)
+    fert = []
+    for c_doy, c_amt in FERT_COLS:
+        doy, amt = _number(row.get(c_doy, -99)), _number(row.get(c_amt, -99))
+        if isinstance(doy, float) and isinstance(amt, float) and doy >= 0 and amt >= 0:
+            fert.append([doy, amt])
+    return sorted(fert)
+
+def scenario_inputs(row):
+    #canonical inputs of a row of the scenario summary table, without the versions of the input files (no file access)
+    sce = {c: _number(row.get(c)) for c in SCE_KEY_COLS}
+    sce['fert'] = fert_list(row)
+    return json.dumps(sce, sort_keys=True)
+
+def scenario_key(Wdir_path, row):
+    #canonical hash of a row of the scenario summary table (sce_name, target year and prices are not part of the key)
+    sce = json.loads(scenario_inputs(row))
+    sce['files'] = input_files_version(Wdir_path, row.get('Crop'), row.get('stn_name'))
+    text = json.dumps(sce, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# =============================================
+class ResultCache:
+    #values are dicts of numpy arrays (e.g., {'PDAT':..., 'HWAM':...})
+    def __init__(self, cache_dir, max_items=CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def _fname(self, key):
+        return path.join(self.cache_dir, key + ".npz")
+
+    def _put_memory(self, key, value):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                self.hits_memory += 1
+                return self._mem[key]
+        value = None
+        if self.cache_dir is not None and path.isfile(self._fname(key)):
+            try:
+                with np.load(self._fname(key), allow_pickle=False) as npz:
+                    value = {k: npz[k] for k in npz.files}
+            except (OSError, ValueError):  #partially written or corrupted file => miss
+                value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits_disk += 1
+                self._put_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        value = {k: np.asarray(v) for k, v in value.items()}
+        with self._lock:
+            self._put_memory(key, value)
+        if self.cache_dir is None:
+            return
+        #write to a temp file and rename => other workers never read a partial file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(suffix=".npz", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **value)
+            os.replace(tmp_name, self._fname(key))
+        except OSError:
+            if path.exists(tmp_name):
+                os.remove(tmp_name)
+
+    def stats(self):
+        with self._lock:
+            return {'hits_memory': self.hits_memory, 'hits_disk': self.hits_disk,
+                    'misses': self.misses, 'items_memory': len(self._mem)}
@@ -0,0 +1,210 @@
+#Archive of all simulated results: Parquet files partitioned by crop/station/soil (hive layout: Crop=MZ/stn_name=BAKO/soil=.../)
+# - one row per scenario and year with all the scenario parameters, the summary outputs and the gross margin
+# - every DSSAT run (web app, pre-simulation, sweeps) appends one file per partition; compact() merges the files of a partition
+# - query() reads it with pyarrow.dataset: partitions are pruned from the directory names and the other filters
+#   are pushed down to the Parquet row groups; only the requested columns are read
+# - needs pyarrow (optional): without it, appends are skipped and queries raise ArchiveUnavailable
+#usage: python results_archive.py compact [--dir path]
+#       python results_archive.py query --filter Crop=MZ --filter stn_name=BAKO --group-by soil [--metric HWAM]
+import os
+import sys
+import time
+import uuid
+import glob
+import argparse
+import tempfile
+import threading
+from os import path
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+import result_cache
+import results_store
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+ARCHIVE_DIR = os.environ.get('SIMAGRI_ARCHIVE_DIR')  #None => <Wdir_path>/archive
+PARTITION_COLS = ['Crop', 'stn_name', 'soil']
+TEXT_COLS = ['sce_name', 'Cultivar', 'Plt-date', 'iNO3', 'scenario_key']
+NUMBER_COLS = (['FirstYear', 'LastYear', 'iH2O', 'plt_density', 'TargetYr'] +
+               [c for pair in result_cache.FERT_COLS for c in pair] + results_store.EB_COLS)
+RESULT_COLS = ['YEAR', 'PDAT', 'ADAT', 'MDAT', 'HWAM', 'NICM', 'GMargin']
+OPS = ('==', '!=', '<', '<=', '>', '>=', 'in', 'not in')
+AGGS = ['count', 'mean', 'median', 'q10', 'q90', 'p_fail']
+
+class ArchiveUnavailable(Exception):
+    pass
+
+# =============================================
+def make_rows(dff, sim_results, keys):
+    #scenarios (rows of the scenario summary table) + their results (dicts of arrays with PDAT, ADAT, MDAT, HWAM, NICM)
+    #+ their result_cache.scenario_key => one row per scenario and year
+    table = results_store.make_table(dff.sce_name.values, sim_results, ['PDAT', 'ADAT', 'MDAT', 'HWAM', 'NICM'])
+    isce = table['SCE']
+    rows = {}
+    for c in PARTITION_COLS + TEXT_COLS[:-1]:
+        rows[c] = dff[c].astype(str).values[isce]
+    rows['scenario_key'] = np.asarray(keys)[isce]
+    for c in NUMBER_COLS:
+        values = pd.to_numeric(dff[c], errors='coerce').values if c in dff else np.full(len(dff), -99.0)
+        rows[c] = values.astype(np.float64)[isce]
+    rows['YEAR'] = (table['PDAT'] // 1000).astype(np.int32)
+    for c in ['PDAT', 'ADAT', 'MDAT']:
+        rows[c] = table[c].astype(np.int32)
+    rows['HWAM'] = table['HWAM'].astype(np.float64)
+    rows['NICM'] = table['NICM'].astype(np.float64)
+    price = np.column_stack([rows[c] for c in results_store.EB_COLS])
+    gmargin = results_store.gross_margin(rows['HWAM'], rows['NICM'], price)
+    rows['GMargin'] = np.where((price == -99).any(axis=1) | np.isnan(price).any(axis=1), np.nan, gmargin)
+    rows['run_time'] = np.full(len(isce), time.time())
+    return pd.DataFrame(rows)
+
+def filter_expression(filters):
+    #[(column, op, value), ...] (all must hold) => pyarrow.dataset expression
+    expr = None
+    for c, op, value in filters or []:
+        if op not in OPS:
+            raise ValueError("filter operator must be one of {}: {}".format(', '.join(OPS), op))
+        field = ds.field(c)
+        if op in ('in', 'not in'):
+            e = field.isin(list(value))
+            e = ~e if op == 'not in' else e
+        else:
+            e = {'==': field == value, '!=': field != value, '<': field < value, '<=': field <= value,
+                 '>': field > value, '>=': field >= value}[op]
+        expr = e if expr is None else expr & e
+    return expr
+
+def aggregate(df, group_by, metric, failure=0.0):
+    #count, mean, median, 10th/90th percentiles and probability of metric <= failure by group
+    if not len(df):
+        return pd.DataFrame(columns=list(group_by) + AGGS)
+    df = df.assign(fail=(df[metric] <= failure).astype(float))
+    g = df.groupby(list(group_by)) if group_by else df.assign(all='all').groupby('all')
+    out = g[metric].agg(['count', 'mean', 'median'])
+    out['q10'] = g[metric].quantile(0.1)
+    out['q90'] = g[metric].quantile(0.9)
+    out['p_fail'] = g['fail'].mean()
+    return out.reset_index()
+
+# =============================================
+class ResultsArchive:
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._dataset = None  #(list of files, dataset) => dataset discovered again only when files are added/removed
+
+    @staticmethod
+    def available():
+        return pa is not None
+
+    def partition_dir(self, values):
+        #values are URI-encoded as pyarrow expects in hive directory names
+        return path.join(self.root, *['{}={}'.format(c, quote(str(v), safe='')) for c, v in zip(PARTITION_COLS, values)])
+
+    def append(self, dff, sim_results, keys):
+        #results of the scenarios dff => one new Parquet file per partition; number of rows written
+        if pa is None or not len(dff):
+            return 0
+        rows = make_rows(dff.reset_index(drop=True), sim_results, keys)
+        for values, part in rows.groupby(PARTITION_COLS):
+            dirname = self.partition_dir(values)
+            os.makedirs(dirname, exist_ok=True)
+            self._write(dirname, part.drop(columns=PARTITION_COLS))
+        return len(rows)
+
+    def _write(self, dirname, df):
+        #temp file starting with '.' (ignored by pyarrow.dataset) and rename => readers never see a partial file
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=dirname)
+        os.close(fd)
+        pq.write_table(pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False), tmp)
+        os.replace(tmp, path.join(dirname, 'part-{}-{}.parquet'.format(int(time.time()), uuid.uuid4().hex[:8])))
+
+    def files(self):
+        return sorted(glob.glob(path.join(self.root, '*=*', '*=*', '*=*', 'part-*.parquet')))
+
+    def dataset(self):
+        if pa is None:
+            raise ArchiveUnavailable("the results archive needs pyarrow (pip install pyarrow)")
+        files = self.files()
+        with self._lock:
+            if self._dataset is None or self._dataset[0] != files:
+                partitioning = ds.partitioning(pa.schema([(c, pa.string()) for c in PARTITION_COLS]), flavor='hive')
+                dataset = ds.dataset(files, format='parquet', partitioning=partitioning, partition_base_dir=self.root) \
+                    if files else None
+                self._dataset = (files, dataset)
+            return self._dataset[1]
+
+    def query(self, filters=None, columns=None):
+        #rows matching all filters [(column, op, value), ...] => DataFrame with the requested columns
+        dataset = self.dataset()
+        if dataset is None:
+            return pd.DataFrame(columns=columns or PARTITION_COLS + TEXT_COLS + NUMBER_COLS + RESULT_COLS + ['run_time'])
+        return dataset.to_table(columns=columns, filter=filter_expression(filters)).to_pandas()
+
+    def summarize(self, filters=None, group_by=(), metric='HWAM'):
+        #statistics of metric by group (e.g., median yield by soil at one station); only the needed columns are read
+        df = self.query(filters, list(dict.fromkeys(list(group_by) + [metric])))
+        if metric == 'HWAM':  #crop failure (-99) => 0 yield as in the figures
+            df[metric] = np.where(df[metric] < 0, 0, df[metric])
+        return aggregate(df.dropna(subset=[metric]), group_by, metric)
+
+    def compact(self):
+        #merge the files of each partition into one => fewer files to open in queries
+        if pa is None:
+            raise ArchiveUnavailable("the results archive needs pyarrow (pip install pyarrow)")
+        n_files = 0
+        for dirname in sorted(set(path.dirname(f) for f in self.files())):
+            fnames = sorted(glob.glob(path.join(dirname, 'part-*.parquet')))
+            if len(fnames) < 2:
+                continue
+            df = pd.concat([pq.read_table(f).to_pandas() for f in fnames], ignore_index=True)
+            self._write(dirname, df)
+            for f in fnames:
+                os.remove(f)
+            n_files += len(fnames)
+        return n_files
+
+# =============================================
+def parse_filter(text):
+    #'Crop=MZ', 'HWAM>=1000', 'stn_name in BAKO,MELK' => (column, op, value)
+    for op in (' not in ', ' in '):
+        if op in text:
+            c, value = text.split(op, 1)
+            return c.strip(), op.strip(), [v.strip() for v in value.split(',')]
+    for op in ('>=', '<=', '!=', '==', '=', '>', '<'):
+        if op in text:
+            c, value = [t.strip() for t in text.split(op, 1)]
+            if c in NUMBER_COLS + RESULT_COLS:
+                value = float(value)
+            return c, '==' if op == '=' else op, value
+    raise ValueError("filter must look like column=value, column>=value or column in a,b: " + text)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact or query the archive of SIMAGRI simulation results')
+    parser.add_argument('command', choices=['compact', 'query'])
+    parser.add_argument('--dir', default=ARCHIVE_DIR or path.join(
+        os.environ.get('SIMAGRI_WDIR', 'C:\\IRI\\Python_Dash\\ET_DSS_hist\\TEST\\'), "archive"), help='archive directory')
+    parser.add_argument('--filter', action='append', default=[], help='e.g., Crop=MZ, HWAM>=1000, soil in A,B')
+    parser.add_argument('--group-by', action='append', default=[], help='column(s) to group by')
+    parser.add_argument('--metric', default='HWAM', help='HWAM (default), GMargin, NICM, ...')
+    args = parser.parse_args()
+    archive = ResultsArchive(args.dir)
+    try:
+        if args.command == 'compact':
+            print('{} files merged'.format(archive.compact()), file=sys.stderr)
+        else:
+            filters = [parse_filter(f) for f in args.filter]
+            print(archive.summarize(filters, args.group_by, args.metric).to_string(index=False))
+    except (ValueError, ArchiveUnavailable) as e:
+        parser.exit(1, 'error: {}\n'.format(e))
+
+if __name__ == "__main__":
+    main()
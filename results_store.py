@@ -0,0 +1,42 @@
+#Columnar tables of the simulated results (dict of numpy arrays, one row per scenario and year)
+#run_create_figure keeps the table of a simulation in the session store; EB_figure selects the scenarios it needs
+#by their result_cache.scenario_key (two scenarios may have the same name for different crops, and an edited
+#scenario has another key => its old results are not used)
+import numpy as np
+
+EB_COLS = ['CropPrice', 'NFertCost', 'SeedCost', 'OtherVariableCosts', 'FixedCosts']  #enterprise budget columns
+
+# =============================================
+def make_table(sce_names, results, columns, keys=None):
+    #concatenate the results of each scenario (list of dicts of arrays) into one columnar table
+    #'SCE' = index of the scenario of each row, 'offsets' = first row of each scenario, 'keys' = key of each scenario
+    lengths = [len(r[columns[0]]) for r in results]
+    table = {c: np.concatenate([np.asarray(r[c]) for r in results]) for c in columns}
+    table['SCE'] = np.repeat(np.arange(len(results)), lengths)
+    table['offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    table['sce_names'] = list(sce_names)
+    table['keys'] = list(sce_names if keys is None else keys)
+    return table
+
+def select_scenarios(table, keys, columns):
+    #rows of the scenarios with these keys (in this order), or None if one of them is not in the table
+    if table is None or any(k not in table['keys'] for k in keys):
+        return None
+    if list(keys) == table['keys']:
+        return table
+    idx = [table['keys'].index(k) for k in keys]
+    offsets = table['offsets']
+    rows = np.concatenate([np.arange(offsets[j], offsets[j + 1]) for j in idx])
+    lengths = [offsets[j + 1] - offsets[j] for j in idx]
+    sub = {c: table[c][rows] for c in columns}
+    sub['SCE'] = np.repeat(np.arange(len(idx)), lengths)
+    sub['offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    sub['sce_names'] = [table['sce_names'][j] for j in idx]
+    sub['keys'] = list(keys)
+    return sub
+
+def gross_margin(HWAM, NICM, price):
+    #gross margin of each row; price: rows x 5 (EB_COLS)
+    #HWAM == -99 (crop failure) is counted as zero yield
+    HWAM = np.where(HWAM < 0, 0, HWAM)
+    return HWAM*price[:,0] - price[:,1]*NICM - price[:,2] - price[:,3] - price[:,4]
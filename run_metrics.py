@@ -0,0 +1,206 @@
+#Timings of the stages of a simulation (SNX render, V47 write, DSSAT process, OSU parse, statistics, figures, callbacks
+#and JSON serialization of their responses)
+# - each timing => a histogram in memory (Prometheus text format on the /metrics route of the Flask server)
+#   and one JSON log line (logger 'simagri.metrics': stderr, or the file SIMAGRI_METRICS_LOG)
+# - metric labels: stage, crop, station (+ callback for the serialization); the scenario, session and job are only
+#   in the log lines, so that the number of series does not grow with the number of scenarios
+# - timings above SIMAGRI_SLOW_RUN_S seconds are logged as warnings with "slow": true
+# - DSSAT runs in the process pool are timed in the worker processes: collect() keeps their timings,
+#   which are returned with the results and added in the web worker with replay()
+# - other values (e.g., hit/miss counts of the caches) are read when /metrics is scraped: register()
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+SLOW_RUN_S = float(os.environ.get('SIMAGRI_SLOW_RUN_S', '30'))
+METRICS_LOG = os.environ.get('SIMAGRI_METRICS_LOG')  #None => stderr
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LABELS = ('stage', 'crop', 'station', 'callback')
+
+_local = threading.local()  #context fields (session, job) and collector of the current thread
+
+# =============================================
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(dict(ts=round(record.created, 3), level=record.levelname, **record.fields), default=str)
+
+def get_logger():
+    logger = logging.getLogger('simagri.metrics')
+    if not logger.handlers:
+        handler = logging.FileHandler(METRICS_LOG) if METRICS_LOG else logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JSONFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+# =============================================
+class Registry:
+    #histograms of the stage timings and totals of the CPU time, by label values
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._hist = {}  #label values => [count of each bucket, sum, count]
+        self._cpu = {}  #label values => CPU seconds
+        self._collectors = {}  #metric name => (help, type, function returning [(labels dict, value), ...])
+        self._lock = threading.Lock()
+
+    def register(self, name, help_text, kind, func):
+        with self._lock:
+            self._collectors[name] = (help_text, kind, func)
+
+    def observe(self, labels, seconds, cpu_seconds=None):
+        key = tuple(labels.get(c, '') for c in LABELS)
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None:
+                h = self._hist[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+            if cpu_seconds is not None:
+                self._cpu[key] = self._cpu.get(key, 0.0) + cpu_seconds
+
+    def exposition(self):
+        #Prometheus text format (version 0.0.4)
+        lines = ['# HELP simagri_stage_seconds Wall time of the stages of the simulations',
+                 '# TYPE simagri_stage_seconds histogram']
+        with self._lock:
+            hist = {k: (list(v[0]), v[1], v[2]) for k, v in self._hist.items()}
+            cpu = dict(self._cpu)
+            collectors = dict(self._collectors)
+        for key in sorted(hist):
+            counts, total, n = hist[key]
+            labels = format_labels(key)
+            for bound, count in zip(self.buckets, counts):
+                lines.append('simagri_stage_seconds_bucket{{{},le="{:g}"}} {}'.format(labels, bound, count))
+            lines.append('simagri_stage_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, n))
+            lines.append('simagri_stage_seconds_sum{{{}}} {:.6f}'.format(labels, total))
+            lines.append('simagri_stage_seconds_count{{{}}} {}'.format(labels, n))
+        lines += ['# HELP simagri_stage_cpu_seconds_total CPU time (user + system) of the DSSAT processes',
+                  '# TYPE simagri_stage_cpu_seconds_total counter']
+        for key in sorted(cpu):
+            lines.append('simagri_stage_cpu_seconds_total{{{}}} {:.6f}'.format(format_labels(key), cpu[key]))
+        for name in sorted(collectors):
+            help_text, kind, func = collectors[name]
+            lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, kind)]
+            for labels, value in func():
+                lines.append('{}{{{}}} {}'.format(name, format_labels(tuple(labels.values()), labels.keys()), value))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(key, names=LABELS):
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('{}="{}"'.format(c, escape(v)) for c, v in zip(names, key) if v != '')
+
+registry = Registry()
+
+# =============================================
+def record(stage, seconds, cpu_seconds=None, **labels):
+    #one timing: histogram (or collector of this thread, in a pool worker) + JSON log line
+    labels = {k: v for k, v in labels.items() if v is not None}
+    metric_labels = dict(stage=stage, **{c: labels[c] for c in LABELS[1:] if c in labels})
+    collector = getattr(_local, 'collector', None)
+    if collector is not None:
+        collector.append((metric_labels, seconds, cpu_seconds))
+    else:
+        registry.observe(metric_labels, seconds, cpu_seconds)
+    fields = dict(getattr(_local, 'context', {}), event='stage', stage=stage, seconds=round(seconds, 6), **labels)
+    if cpu_seconds is not None:
+        fields['cpu_seconds'] = round(cpu_seconds, 6)
+    slow = seconds > SLOW_RUN_S
+    if slow:
+        fields['slow'] = True
+    get_logger().log(logging.WARNING if slow else logging.INFO, stage, extra={'fields': fields})
+
+def register(name, help_text, kind, func):
+    #metric computed when /metrics is scraped: func() => [(labels dict, value), ...]; kind: 'counter' or 'gauge'
+    registry.register(name, help_text, kind, func)
+
+@contextmanager
+def timed(stage, **labels):
+    #with timed('osu_parse', crop='MZ', station='MELK', scenario='s1'): ...
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - t0, **labels)
+
+@contextmanager
+def context(**fields):
+    #fields added to the log lines of this thread (e.g., session and job of a simulation)
+    previous = getattr(_local, 'context', {})
+    _local.context = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+@contextmanager
+def collect():
+    #timings of this thread kept in a list instead of the registry (process pool worker => returned to the web worker)
+    _local.collector = records = []
+    try:
+        yield records
+    finally:
+        _local.collector = None
+
+def replay(records):
+    for labels, seconds, cpu_seconds in records:
+        registry.observe(labels, seconds, cpu_seconds)
+
+def in_worker(func, *args):
+    #run func in a pool worker => (result, its timings)
+    with collect() as records:
+        return func(*args), records
+
+def labels_of(crops, stations):
+    #one label value for the runs of several scenarios (e.g., batch run of scenarios at different stations)
+    crops, stations = sorted(set(crops)), sorted(set(stations))
+    return {'crop': crops[0] if len(crops) == 1 else 'mixed', 'station': stations[0] if len(stations) == 1 else 'mixed'}
+
+# =============================================
+def instrument(app):
+    #Dash app => /metrics route + 'json_serialization' timings of the callbacks decorated with timed_callback
+    #(Dash serializes the return value after the callback => request time - callback time)
+    import flask
+    server = app.server
+
+    @server.before_request
+    def start_timer():
+        flask.g.metrics_t0 = time.perf_counter()
+        flask.g.metrics_callback = None
+
+    @server.after_request
+    def serialization_time(response):
+        callback = getattr(flask.g, 'metrics_callback', None)
+        if callback is not None:
+            name, seconds = callback
+            total = time.perf_counter() - flask.g.metrics_t0
+            record('json_serialization', max(total - seconds, 0.0), callback=name, bytes=response.calculate_content_length())
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.Response(registry.exposition(), mimetype='text/plain; version=0.0.4')
+
+def timed_callback(func):
+    #decorator of a Dash callback (below @app.callback): 'callback' timing + start of the serialization time
+    import flask
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - t0
+            record('callback', seconds, callback=func.__name__)
+            if flask.has_request_context():
+                flask.g.metrics_callback = (func.__name__, seconds)
+    return wrapper
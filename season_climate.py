@@ -0,0 +1,119 @@
+#Season climate of the simulated years: rainfall, rainy days, longest dry spell, mean Tmax/Tmin and heat-stress days
+#in the growing season of each scenario and year (planting PDAT to maturity MDAT of the simulation)
+# - the daily arrays of a station (weather_store) are put once on a continuous calendar with cumulated sums
+#   (ClimateIndex, kept in memory until the WTH files change) => sums of any window = difference of two cumulated sums
+# - the longest dry spell of all windows at once: days since the last rainy day, gathered for the days of each window
+# - climate-yield correlations by scenario from the sums of the products (np.bincount)
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+RAINY_MM = 1.0  #rainy day: rainfall >= RAINY_MM
+HEAT_TMAX = 35.0  #heat-stress day: Tmax > HEAT_TMAX
+SEASON_DAYS = 120  #length of the window when the maturity date is missing (e.g., crop failure)
+VARS = OrderedDict([('RAIN', 'Season rainfall [mm]'),
+                    ('RAINY_DAYS', 'Rainy days (>= {:g} mm)'.format(RAINY_MM)),
+                    ('DRY_SPELL', 'Longest dry spell [days]'),
+                    ('TMAX', 'Mean Tmax [C]'),
+                    ('TMIN', 'Mean Tmin [C]'),
+                    ('HEAT_DAYS', 'Heat-stress days (Tmax > {:g} C)'.format(HEAT_TMAX))])
+SUMS = ('VALID', 'RAIN', 'RAINY_DAYS', 'TMAX', 'TMIN', 'HEAT_DAYS')  #columns of the cumulated sums
+
+# =============================================
+def day_number(yyyyddd):
+    #YYYYDDD => days since 1970-01-01
+    yyyyddd = np.asarray(yyyyddd, dtype=np.int64)
+    year_start = (yyyyddd // 1000 - 1970).astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+    return year_start + yyyyddd % 1000 - 1
+
+class StationIndex:
+    def __init__(self, station_weather):
+        days = day_number(station_weather.dates)
+        self.day0 = int(days[0]) if len(days) else 0
+        n_days = int(days[-1]) - self.day0 + 1 if len(days) else 0
+        #continuous calendar: NaN on the days without data (missing years) and for missing values (-99)
+        daily = np.full((n_days, 3), np.nan)
+        values = np.column_stack([station_weather.var(v) for v in ('RAIN', 'TMAX', 'TMIN')]).astype(np.float64)
+        daily[days - self.day0] = np.where(values <= -99, np.nan, values)  #RAIN, TMAX, TMIN
+        rain, tmax, tmin = daily.T
+        valid = np.isfinite(daily).all(axis=1)
+        rainy = valid & (rain >= RAINY_MM)
+        columns = np.column_stack([valid, np.where(valid, rain, 0), rainy, np.where(valid, tmax, 0),
+                                   np.where(valid, tmin, 0), valid & (tmax > HEAT_TMAX)])
+        self.cum = np.vstack([np.zeros((1, len(SUMS))), np.cumsum(columns, axis=0)])
+        #last rainy day (or day without data) up to each day => length of the dry spell ending on that day
+        self.last_wet = np.maximum.accumulate(np.where(rainy | ~valid, np.arange(n_days), -1)) if n_days else np.zeros(0, int)
+
+    def summaries(self, first_day, last_day):
+        #windows first_day-last_day (day numbers, inclusive) => {var: value of each window}, NaN if a day is missing
+        n = len(self.last_wet)
+        i0 = np.asarray(first_day, dtype=np.int64) - self.day0
+        i1 = np.asarray(last_day, dtype=np.int64) - self.day0 + 1
+        inside = (i0 >= 0) & (i1 <= n) & (i1 > i0)
+        i0, i1 = np.where(inside, i0, 0), np.where(inside, i1, 0)
+        length = i1 - i0
+        sums = self.cum[i1] - self.cum[i0]
+        complete = inside & (sums[:, 0] == length)
+        out = {}
+        for k, var in enumerate(SUMS[1:], 1):
+            value = sums[:, k] / np.maximum(length, 1) if var in ('TMAX', 'TMIN') else sums[:, k]
+            out[var] = np.where(complete, value, np.nan)
+        #dry spell: days of each window in a 2D array (n windows x longest window), padded with the first day
+        offsets = np.arange(length.max() if len(length) else 0)
+        days = i0[:, None] + np.where(offsets < length[:, None], offsets, 0)
+        run = days - np.maximum(self.last_wet[days] if n else days, i0[:, None] - 1)
+        out['DRY_SPELL'] = np.where(complete, run.max(axis=1, initial=0), np.nan)
+        return {var: out[var] for var in VARS}
+
+class ClimateIndex:
+    #StationIndex of each station, built again when the weather_store arrays change (new StationWeather)
+    def __init__(self, store):
+        self.store = store
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def get(self, station):
+        station_weather = self.store.get(station)
+        with self._lock:
+            cached = self._index.get(station)
+            if cached is None or cached[0] is not station_weather:
+                cached = self._index[station] = (station_weather, StationIndex(station_weather))
+            return cached[1]
+
+# =============================================
+def season_climate(index, stations, sim_table):
+    #climate of the growing season of each row of sim_table (results_store.make_table), stations of each scenario
+    #=> {var: array aligned with the rows}
+    pdat, mdat = np.asarray(sim_table['PDAT']), np.asarray(sim_table['MDAT'])
+    ok = pdat > 0
+    first = np.where(ok, day_number(np.where(ok, pdat, 1970001)), 0)
+    last = np.where(mdat > pdat, day_number(np.where(mdat > pdat, mdat, 1970001)), first + SEASON_DAYS - 1)
+    station_of_row = np.asarray(stations)[sim_table['SCE']]
+    out = {var: np.full(len(pdat), np.nan) for var in VARS}
+    for station in set(stations):
+        rows = np.flatnonzero((station_of_row == station) & ok)
+        if len(rows):
+            for var, values in index.get(station).summaries(first[rows], last[rows]).items():
+                out[var][rows] = values
+    return out
+
+def correlations(climate, values, isce, n_sce):
+    #Pearson correlation of values (e.g., yield) with each climate variable, by scenario => n_sce x len(VARS)
+    #(years with a missing value excluded; NaN with less than 3 years or without variation)
+    values = np.asarray(values, dtype=float)
+    r = np.full((n_sce, len(VARS)), np.nan)
+    for k, var in enumerate(VARS):
+        x = climate[var]
+        ok = np.isfinite(x) & np.isfinite(values)
+        s = isce[ok]
+        n = np.bincount(s, minlength=n_sce)
+        moments = [np.bincount(s, weights=w, minlength=n_sce)
+                   for w in (x[ok], values[ok], x[ok] * values[ok], x[ok] ** 2, values[ok] ** 2)]
+        sx, sy, sxy, sxx, syy = moments
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = sxy - sx * sy / n
+            var_x, var_y = sxx - sx ** 2 / n, syy - sy ** 2 / n
+            rk = cov / np.sqrt(var_x * var_y)
+        r[:, k] = np.where((n >= 3) & (var_x > 1e-9 * np.maximum(sxx, 1)) & (var_y > 1e-9 * np.maximum(syy, 1)), rk, np.nan)
+    return r
@@ -0,0 +1,139 @@
+#Server-side store of the results of each browser session (the browser keeps only the session key)
+# - in-process: values of the sessions used recently, evicted after SESSION_TTL seconds without access
+#   or when their total size goes over SESSION_MB (least recently used sessions first)
+# - optional on-disk backend (SIMAGRI_SESSION_DIR): values are also pickled there, so that all gunicorn workers
+#   can read them and an evicted value can be loaded again until it expires (TTL after it was written)
+import os
+import glob
+import time
+import uuid
+import pickle
+import shutil
+import tempfile
+import threading
+from os import path
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+SESSION_TTL = float(os.environ.get('SIMAGRI_SESSION_TTL', 4 * 3600))  #seconds without access before a session expires
+SESSION_MB = float(os.environ.get('SIMAGRI_SESSION_MB', 512))  #max. size of the sessions kept in memory by each worker
+SESSION_DIR = os.environ.get('SIMAGRI_SESSION_DIR')  #None => in-process only
+
+# =============================================
+def value_size(value):
+    #approximate size in bytes (DataFrames, columnar tables = dict of arrays, or anything that can be pickled)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(value_size(v) for v in value.values())
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+def valid_session_id(session_id):
+    #session ids come from the browser => only hex keys made by new_session_id are used as file names
+    return isinstance(session_id, str) and len(session_id) == 32 and all(c in '0123456789abcdef' for c in session_id)
+
+# =============================================
+class SessionStore:
+    def __init__(self, ttl=SESSION_TTL, max_mb=SESSION_MB, disk_dir=SESSION_DIR):
+        self.ttl = ttl
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.disk_dir = disk_dir
+        self._sessions = OrderedDict()  #session id => {'values', 'sizes', 'mtimes' (on disk): {name: ...}, 'atime': time}
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+        self._last_cleanup = 0
+
+    def _session_dir(self, session_id):
+        return path.join(self.disk_dir, session_id)
+
+    def _remember(self, session_id, name, value, mtime, now):
+        #keep a value in memory (lock held)
+        size = value_size(value)
+        session = self._sessions.setdefault(session_id, {'values': {}, 'sizes': {}, 'mtimes': {}, 'atime': now})
+        self._n_bytes += size - session['sizes'].get(name, 0)
+        session['values'][name] = value
+        session['sizes'][name] = size
+        session['mtimes'][name] = mtime
+        session['atime'] = now
+        self._sessions.move_to_end(session_id)
+        self._evict(now, keep=session_id)
+
+    def _disk_mtime(self, session_id, name):
+        try:
+            return os.stat(path.join(self._session_dir(session_id), name + '.pkl')).st_mtime_ns
+        except OSError:
+            return None
+
+    def put(self, session_id, name, value):
+        if not valid_session_id(session_id):
+            raise KeyError("invalid session id")
+        now = time.time()
+        mtime = None
+        if self.disk_dir:
+            os.makedirs(self._session_dir(session_id), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self._session_dir(session_id))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path.join(self._session_dir(session_id), name + '.pkl'))
+            mtime = self._disk_mtime(session_id, name)
+            if now - self._last_cleanup > self.ttl / 4:
+                self._last_cleanup = now
+                self.cleanup_disk()
+        with self._lock:
+            self._remember(session_id, name, value, mtime, now)
+
+    def get(self, session_id, name):
+        #value or None (unknown session, expired, or evicted without disk backend)
+        if not valid_session_id(session_id):
+            return None
+        now = time.time()
+        #with the disk backend, the value may have been written again by another worker => compare modification times
+        mtime = self._disk_mtime(session_id, name) if self.disk_dir else None
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if (session is not None and now - session['atime'] <= self.ttl and name in session['values']
+                    and session['mtimes'][name] == mtime):
+                session['atime'] = now
+                self._sessions.move_to_end(session_id)
+                return session['values'][name]
+        if mtime is None or now - mtime / 1e9 > self.ttl:
+            return None
+        try:
+            with open(path.join(self._session_dir(session_id), name + '.pkl'), 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        with self._lock:
+            self._remember(session_id, name, value, mtime, now)
+        return value
+
+    def _evict(self, now, keep=None):
+        #expired sessions, then least recently used ones while over the size limit (lock held)
+        for session_id in [s for s, v in self._sessions.items() if now - v['atime'] > self.ttl]:
+            self._n_bytes -= sum(self._sessions.pop(session_id)['sizes'].values())
+        while self._n_bytes > self.max_bytes and len(self._sessions) > 1:
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                break
+            self._n_bytes -= sum(self._sessions.pop(session_id)['sizes'].values())
+
+    def cleanup_disk(self):
+        #remove the on-disk sessions not written for longer than the TTL
+        if not self.disk_dir:
+            return
+        now = time.time()
+        for session_dir in glob.glob(path.join(self.disk_dir, '*')):
+            fnames = glob.glob(path.join(session_dir, '*.pkl'))
+            if all(now - os.path.getmtime(f) > self.ttl for f in fnames):
+                shutil.rmtree(session_dir, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._sessions), 'bytes': self._n_bytes}
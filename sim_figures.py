@@ -0,0 +1,119 @@
+#Figures of the yield and enterprise budget views (box plot, exceedance curves, time-series)
+# - 'full'      : every simulated value is sent to the browser (px.box with the raw samples, one SVG trace per scenario)
+# - 'aggregate' : precomputed box statistics (q1/median/q3/fences, sim_stats.box_stats), WebGL (Scattergl) curves,
+#                 exceedance curves reduced to CURVE_POINTS quantiles and, above MAX_TRACES scenarios, the time-series
+#                 binned into the median and 10-90% range of all scenarios of each year
+# - 'auto'      : 'aggregate' when there are more than MAX_POINTS simulated values, otherwise 'full'
+import os
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+import sim_stats
+
+FIGURE_MODE = os.environ.get('SIMAGRI_FIGURE_MODE', 'auto')  #auto, full or aggregate
+MAX_POINTS = int(os.environ.get('SIMAGRI_FIGURE_MAX_POINTS', '5000'))  #values (scenarios x years) shown raw in 'auto'
+CURVE_POINTS = 41  #max. points of an exceedance curve in 'aggregate'
+MAX_TRACES = 30  #max. time-series traces in 'aggregate'
+
+# =============================================
+def figure_mode(n_values, mode=None):
+    mode = mode or FIGURE_MODE
+    if mode == 'auto':
+        return 'aggregate' if n_values > MAX_POINTS else 'full'
+    return mode
+
+def box_figure(df, metric, isce, x_val, target, title, xaxis_title, yaxis_title, mode='full'):
+    #box plot of metric for each scenario + markers for the target-year values
+    if mode == 'full':
+        fig = px.box(df, x="EXPERIMENT", y=metric, title=title)
+    else:
+        b = sim_stats.box_stats(df[metric].values, isce, len(x_val))
+        fig = go.Figure(go.Box(x=x_val, q1=b.q1.values, median=b['median'].values, q3=b.q3.values,
+                               lowerfence=b.lowerfence.values, upperfence=b.upperfence.values, mean=b['mean'].values,
+                               boxpoints=False, name=metric))
+        fig.update_layout(title=title, showlegend=False)
+    fig.add_scatter(x=x_val, y=target, mode='markers')
+    fig.update_xaxes(title=xaxis_title)
+    fig.update_yaxes(title=yaxis_title)
+    return fig
+
+def exceedance_figure(values, isce, x_val, title, xaxis_title, mode='full'):
+    if mode == 'full':
+        x_data, Fx_scf, s = sim_stats.exceedance(values, isce, len(x_val))
+        curves = sim_stats.split_by_scenario((x_data, Fx_scf), s, len(x_val))
+        Scatter = go.Scatter
+    else:
+        #value exceeded with probability p = quantile 1-p of the scenario (interpolated between the sorted values)
+        Fx_scf = np.linspace(1, 0, CURVE_POINTS)
+        x_data = sim_stats.quantiles(values, isce, len(x_val), q=1 - Fx_scf)
+        curves = [(x_sce, Fx_scf) for x_sce in x_data]
+        Scatter = go.Scattergl
+    fig = go.Figure()
+    for name, (x_sce, Fx_sce) in zip(x_val, curves):
+        fig.add_trace(Scatter(x=x_sce, y=Fx_sce,
+                    mode='lines+markers' if mode == 'full' else 'lines',
+                    name=name))
+    # Edit the layout
+    fig.update_layout(title=title,
+                    xaxis_title=xaxis_title,
+                    yaxis_title='Probability of Exceedance [-]')
+    return fig
+
+def timeseries_figure(df, metric, title, yaxis_title, mode='full'):
+    #time-series of each scenario + table with one column per scenario (for the CSV file)
+    df_out = df.groupby(['YEAR', 'EXPERIMENT'])[metric].first().unstack()
+    df_out.columns.name = None
+    fig = go.Figure()
+    if mode != 'full' and len(df_out.columns) > MAX_TRACES:
+        #all scenarios of each year => median and 10-90% range
+        years = df_out.index.values
+        q = np.nanquantile(df_out.values.astype(float), [0.1, 0.5, 0.9], axis=1)
+        fig.add_trace(go.Scattergl(x=years, y=q[0], mode='lines', line={'width': 0}, showlegend=False, name='10%'))
+        fig.add_trace(go.Scattergl(x=years, y=q[2], mode='lines', line={'width': 0}, fill='tonexty', name='10-90%'))
+        fig.add_trace(go.Scattergl(x=years, y=q[1], mode='lines+markers', name='median'))
+        title = '{} (median and 10-90% of {} scenarios)'.format(title, len(df_out.columns))
+    else:
+        Scatter = go.Scatter if mode == 'full' else go.Scattergl
+        for name in df_out.columns:
+            fig.add_trace(Scatter(x=df_out.index.values, y=df_out[name].values,
+                        mode='lines+markers',
+                        name=name))
+    # Edit the layout
+    fig.update_layout(title=title,
+                    xaxis_title='Year',
+                    yaxis_title=yaxis_title)
+    return fig, df_out.reset_index()
+
+def climate_figure(df, metric, climate_var, title, yaxis_title, y2axis_title):
+    #time-series of metric (solid, left axis) and of a season climate variable (dashed, right axis) for each scenario
+    fig = go.Figure()
+    colors = px.colors.qualitative.Plotly
+    for i, (name, d) in enumerate(df.sort_values('YEAR').groupby('EXPERIMENT', sort=False)):
+        color = colors[i % len(colors)]
+        fig.add_trace(go.Scatter(x=d.YEAR.values, y=d[metric].values, mode='lines+markers', name=name,
+                                 legendgroup=name, line={'color': color}))
+        fig.add_trace(go.Scatter(x=d.YEAR.values, y=d[climate_var].values, mode='lines', name=name + ' ' + climate_var,
+                                 legendgroup=name, line={'color': color, 'dash': 'dash'}, yaxis='y2'))
+    fig.update_layout(title=title,
+                    xaxis_title='Year',
+                    yaxis_title=yaxis_title,
+                    yaxis2={'title': y2axis_title, 'overlaying': 'y', 'side': 'right', 'showgrid': False})
+    return fig
+
+def daily_figure(years, das, values, target_year, title, yaxis_title):
+    #daily values of all simulated years (rows of values) => median and 10-90% range by day + the target year
+    fig = go.Figure()
+    if len(years):
+        q = np.nanquantile(values, [0.1, 0.5, 0.9], axis=0)
+        fig.add_trace(go.Scatter(x=das, y=q[0], mode='lines', line={'width': 0}, showlegend=False, name='10%'))
+        fig.add_trace(go.Scatter(x=das, y=q[2], mode='lines', line={'width': 0}, fill='tonexty', name='10-90% of years'))
+        fig.add_trace(go.Scatter(x=das, y=q[1], mode='lines', name='median'))
+        if target_year in set(years.tolist()):
+            fig.add_trace(go.Scatter(x=das, y=values[years.tolist().index(target_year)], mode='lines',
+                                     name='target year {}'.format(target_year)))
+    fig.update_layout(title=title,
+                    xaxis_title='Days after start of simulation (1 day before planting)',
+                    yaxis_title=yaxis_title)
+    return fig
@@ -0,0 +1,150 @@
+#Background jobs for the simulations: the "Simulate all scenarios" callback only submits a job and returns its ID,
+#then a dcc.Interval callback polls the status (queued/running/done/failed/cancelled, number of scenarios completed)
+#a job not polled for abandon_after seconds (browser closed) is stopped: queued => cancelled, running => its stop hooks
+#are called (e.g., dssat_governor.Token.cancel kills its DSSAT runs)
+import os
+import time
+import uuid
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import run_metrics
+
+#number of simulation jobs run at the same time by each web worker (DSSAT itself runs in subprocesses)
+JOB_THREADS = int(os.environ.get('SIMAGRI_JOB_THREADS', '2'))
+MAX_JOBS = 200  #finished jobs kept for polling (oldest removed first)
+ABANDON_S = float(os.environ.get('SIMAGRI_ABANDON_S', '300'))  #hidden browser tabs may poll only once a minute
+
+# =============================================
+class Job:
+    def __init__(self, n_total):
+        self.job_id = uuid.uuid4().hex
+        self.state = 'queued'
+        self.n_done = 0
+        self.n_total = n_total
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.last_seen = self.submitted  #last status request
+        self.stopping = False
+        self._stop_hooks = []
+        self._finished = threading.Event()
+
+    def set_progress(self, n_done):
+        self.n_done = n_done
+
+    def on_stop(self, func):
+        #func() is called if the running job is stopped (right away if it already is)
+        self._stop_hooks.append(func)
+        if self.stopping:
+            func()
+
+    def stop(self):
+        self.stopping = True
+        for func in list(self._stop_hooks):
+            func()
+
+    def wait(self, timeout=None):
+        #True if the job finished (done, failed or cancelled) within timeout
+        return self._finished.wait(timeout)
+
+    def status(self):
+        return {'job_id': self.job_id, 'state': self.state, 'n_done': self.n_done, 'n_total': self.n_total,
+                'error': self.error}
+
+class JobQueue:
+    def __init__(self, n_threads=JOB_THREADS, abandon_after=None):
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.abandon_after = abandon_after  #None => jobs are never stopped (e.g., not polled by the browser)
+        if abandon_after:
+            threading.Thread(target=self._watch, daemon=True).start()
+
+    def _run(self, job, func, args):
+        with self._lock:
+            if job.state == 'cancelled':  #cancelled while queued
+                return
+            job.state = 'running'
+        t0 = time.perf_counter()
+        queued_seconds = time.time() - job.submitted
+        #the timings of the stages run by the job are logged with its ID (run_metrics)
+        with run_metrics.context(job=job.job_id[:8], task=func.__name__):
+            try:
+                job.result = func(job, *args)
+                job.n_done = job.n_total
+                job.state = 'done'
+            except Exception as e:
+                job.error = '{}: {}'.format(type(e).__name__, e)
+                if job.stopping:
+                    job.state = 'cancelled'
+                else:
+                    traceback.print_exc()
+                    job.state = 'failed'
+            finally:
+                run_metrics.record('job', time.perf_counter() - t0, task=func.__name__, state=job.state,
+                                   queued_seconds=round(queued_seconds, 3),
+                                   scenarios=job.n_total)
+                job._finished.set()
+
+    def submit(self, func, *args, n_total=0):
+        #func(job, *args) is run in the background; it may call job.set_progress(n_done)
+        job = Job(n_total)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > MAX_JOBS:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.state in ('queued', 'running'):
+                    break
+                self._jobs.popitem(last=False)
+        self._executor.submit(self._run, job, func, args)
+        return job.job_id
+
+    def cancel(self, job_id):
+        #a queued job is not run; True if cancelled (a running job is left to finish)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != 'queued':
+                return False
+            job.state = 'cancelled'
+        job._finished.set()
+        return True
+
+    def stop(self, job_id):
+        #queued job => cancelled, running job => stop hooks (the job ends as 'cancelled' if they make it fail)
+        if self.cancel(job_id):
+            return True
+        job = self.get(job_id, touch=False)
+        if job is None or job.state != 'running':
+            return False
+        job.stop()
+        return True
+
+    def get(self, job_id, touch=True):
+        #touch: status request of the browser => the job is not abandoned
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and touch:
+                job.last_seen = time.time()
+            return job
+
+    def position(self, job_id):
+        #1 + number of queued jobs submitted before this one (None if it is not queued)
+        with self._lock:
+            queued = [i for i, job in self._jobs.items() if job.state == 'queued']
+        return queued.index(job_id) + 1 if job_id in queued else None
+
+    def _watch(self):
+        #stop the jobs not polled for abandon_after seconds
+        while True:
+            time.sleep(min(self.abandon_after / 2, 5))
+            now = time.time()
+            with self._lock:
+                abandoned = [job for job in self._jobs.values() if job.state in ('queued', 'running') and
+                             not job.stopping and now - job.last_seen > self.abandon_after]
+            for job in abandoned:
+                run_metrics.get_logger().warning('job not polled => stopped', extra={'fields': {
+                    'event': 'job_abandoned', 'job': job.job_id[:8], 'idle_seconds': round(now - job.last_seen, 1)}})
+                self.stop(job.job_id)
@@ -0,0 +1,97 @@
+#Statistics of the simulated results of many scenarios in one grouped pass (no loop over the scenarios)
+# - inputs: values of any metric (HWAM, GMargin, ...) + scenario index of each row ('SCE' of results_store.make_table)
+# - sorted exceedance curves, quantiles, mean/std/CV, probability of crop failure and target-year values
+# - non-finite values (e.g., gross margin without prices) are left out
+import numpy as np
+import pandas as pd
+
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+# =============================================
+def sort_by_scenario(values, sce, n_sce=None):
+    #(sorted values, scenario of each value, first row of each scenario, number of values of each scenario)
+    #rows are sorted by scenario, then by value
+    values = np.asarray(values, dtype=float)
+    sce = np.asarray(sce)
+    if n_sce is None:
+        n_sce = int(sce.max()) + 1 if len(sce) else 0
+    ok = np.isfinite(values)
+    values, sce = values[ok], sce[ok]
+    order = np.lexsort((values, sce))
+    counts = np.bincount(sce, minlength=n_sce)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    return values[order], sce[order], starts, counts
+
+def exceedance(values, sce, n_sce=None):
+    #exceedance curve of each scenario => (sorted values, probability of exceedance, scenario of each point)
+    #probability of the k-th smallest of n values = 1 - k/n (as in the original figures)
+    v, s, starts, counts = sort_by_scenario(values, sce, n_sce)
+    rank = np.arange(len(v)) - starts[s] + 1
+    return v, 1.0 - rank / counts[s], s
+
+def split_by_scenario(arrays, sce, n_sce):
+    #arrays sorted by scenario => list (one item per scenario) of tuples of slices
+    bounds = np.cumsum(np.bincount(sce, minlength=n_sce))[:-1]
+    return list(zip(*[np.split(a, bounds) for a in arrays]))
+
+def quantiles(values, sce, n_sce=None, q=QUANTILES):
+    #n_sce x len(q) array (linear interpolation, same as np.quantile); NaN for scenarios without values
+    v, s, starts, counts = sort_by_scenario(values, sce, n_sce)
+    q = np.asarray(q, dtype=float)
+    pos = q[None, :] * (counts[:, None] - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    frac = pos - lo
+    out = np.full(pos.shape, np.nan)
+    has = counts > 0
+    if len(v):
+        i_lo = (starts[:, None] + lo)[has]
+        i_hi = (starts[:, None] + hi)[has]
+        out[has] = v[i_lo] * (1 - frac[has]) + v[i_hi] * frac[has]
+    return out
+
+def summarize(values, sce, n_sce=None, failure=0.0, q=QUANTILES):
+    #one row per scenario: n, mean, std, CV, min, quantiles, max and probability of value <= failure
+    #(failure=0 with yields => crop failure; with gross margins => no profit)
+    values = np.asarray(values, dtype=float)
+    sce = np.asarray(sce)
+    if n_sce is None:
+        n_sce = int(sce.max()) + 1 if len(sce) else 0
+    ok = np.isfinite(values)
+    v, s = values[ok], sce[ok]
+    n = np.bincount(s, minlength=n_sce)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(s, weights=v, minlength=n_sce) / n
+        std = np.sqrt(np.maximum(np.bincount(s, weights=v * v, minlength=n_sce) / n - mean ** 2, 0))
+        cv = std / np.abs(mean)
+        p_fail = np.bincount(s, weights=(v <= failure).astype(float), minlength=n_sce) / n
+    qs = quantiles(values, sce, n_sce, (0.0,) + tuple(q) + (1.0,))
+    df = pd.DataFrame({'n': n, 'mean': mean, 'std': std, 'CV': cv, 'min': qs[:, 0]})
+    for k, qk in enumerate(q):
+        df['q{:g}'.format(100 * qk)] = qs[:, k + 1]
+    df['max'] = qs[:, -1]
+    df['p_fail'] = p_fail
+    return df
+
+def target_values(values, years, sce, target_years):
+    #value of the target year of each scenario (NaN if the target year was not simulated)
+    target_years = np.asarray(target_years, dtype=float)
+    sce = np.asarray(sce)
+    out = np.full(len(target_years), np.nan)
+    hit = np.flatnonzero(np.asarray(years) == target_years[sce])
+    out[sce[hit]] = np.asarray(values, dtype=float)[hit]
+    return out
+
+def box_stats(values, sce, n_sce=None):
+    #box plot statistics of each scenario: q1/median/q3 and the Tukey fences (most extreme values within 1.5 IQR)
+    v, s, starts, counts = sort_by_scenario(values, sce, n_sce)
+    n_sce = len(counts)
+    q = quantiles(v, s, n_sce, (0.25, 0.5, 0.75))
+    iqr = q[:, 2] - q[:, 0]
+    lo, hi = q[:, 0] - 1.5 * iqr, q[:, 2] + 1.5 * iqr
+    inside = (v >= lo[s]) & (v <= hi[s])
+    fences = pd.Series(v[inside]).groupby(s[inside]).agg(['min', 'max']).reindex(range(n_sce))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(s, weights=v, minlength=n_sce) / counts
+    return pd.DataFrame({'q1': q[:, 0], 'median': q[:, 1], 'q3': q[:, 2], 'lowerfence': fences['min'].values,
+                         'upperfence': fences['max'].values, 'mean': mean, 'n': counts})
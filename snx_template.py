@@ -0,0 +1,192 @@
+#In-memory renderer of the scenario SNX files (replaces the line-by-line copy of TEMP_ETxx.SNX in writeSNX_main_hist)
+# - each template is parsed once into its sections (*TREATMENTS, *CULTIVARS, *FIELDS, ...) and parsed again only if it changes
+# - a scenario is rendered into a string => one write into Wdir_path, or no write at all when it is handed to a batch run
+# - output is byte-identical to writeSNX_main_hist (see benchmarks/check_snx_golden.py and TEST/golden)
+import os
+import threading
+from os import path
+from datetime import date
+
+import soil_catalog
+
+cultivar_options = {
+    'MZ': ["CIMT01 BH540-Kassie","CIMT02 MELKASA-Kassi","CIMT17 BH660-FAW-40%", "CIMT19 MELKASA2-FAW-40%", "CIMT21 MELKASA-LowY"],
+    'WH': ["CI2021 KT-KUB", "CI2022 RMSI", "CI2023 Meda wolabu", "CI2024 Sofumer", "CI2025 Hollandi"],
+    'SG': ["IB0020 ESH-1","IB0020 ESH-2","IB0027 Dekeba","IB0027 Melkam","IB0027 Teshale"]
+}
+SECTIONS = ('*TREATMENTS', '*CULTIVARS', '*FIELDS', '*INITIAL CONDITIONS', '*PLANTING DETAILS', '*FERTILIZERS',
+            '*SIMULATION CONTROLS')
+FERT_COLS = [("1_Fert(DOY)", "1_Fert(Kg/ha)"), ("2_Fert(DOY)", "2_Fert(Kg/ha)"),
+             ("3_Fert(DOY)", "3_Fert(Kg/ha)"), ("4_Fert(DOY)", "4_Fert(Kg/ha)")]
+N_SIM_CONTROL_LINES = 24  #lines of *SIMULATION CONTROLS kept from the template (up to the automatic harvest settings)
+
+_templates = {}  #template file name => (mtime, SNXTemplate)
+_templates_lock = threading.Lock()
+
+# =============================================
+def parse_sections(lines):
+    #lines of a SNX file => (lines before *TREATMENTS, {section name: lines of the section incl. its '*' line})
+    preamble, sections = [], {}
+    current = None
+    for line in lines:
+        if line.startswith('*'):
+            current = next((s for s in SECTIONS if line.startswith(s)), None)
+            if current is not None:
+                sections[current] = []
+        if current is not None:
+            sections[current].append(line)
+        elif not sections:
+            preamble.append(line)
+        #other sections after *TREATMENTS (e.g., *IRRIGATION) are not written for the scenarios
+    missing = [s for s in SECTIONS if s not in sections]
+    if missing:
+        raise ValueError("sections not in SNX template: " + ", ".join(missing))
+    return preamble, sections
+
+# =============================================
+class SNXTemplate:
+    def __init__(self, temp_snx):
+        self.temp_snx = temp_snx
+        with open(temp_snx, "r") as f:
+            lines = f.read().splitlines(keepends=True)
+        preamble, s = parse_sections(lines)
+        trt, cul, fld = s['*TREATMENTS'], s['*CULTIVARS'], s['*FIELDS']
+        ic, plt, fer, sim = s['*INITIAL CONDITIONS'], s['*PLANTING DETAILS'], s['*FERTILIZERS'], s['*SIMULATION CONTROLS']
+        #static text between the lines set for each scenario
+        self.head = ''.join(preamble + trt[:2])
+        self.trt_tail = ''.join(trt[3:] + cul[:2])
+        self.cul_line = cul[2]
+        self.cul_tail = ''.join(cul[3:] + fld[:2])
+        self.fld_mid = fld[3]
+        self.fld_tail = ''.join(fld[5:] + ic[:2])
+        self.ic_line = ic[2]
+        self.ic_layer_head = ic[3]
+        self.ic_layer_line = ic[4]
+        self.plt_head = ''.join(plt[:2])
+        self.plt_line = plt[2]
+        self.fer_head = ''.join(fer[:2])
+        self.fer_line = fer[2]
+        self.sim_head = ''.join(sim[:2])
+        self.sim_line = sim[2]
+        self.sim_options = sim[3]
+        self.sim_tail = ''.join(sim[5:N_SIM_CONTROL_LINES])
+
+    def render(self, crop, WSTA, first_year, last_year, plt_date, cultivar, soil, IC_w_ratio, i_NO3, PPOP, fert, fert_app):
+        #SNX text of one scenario
+        # - plt_date: 'YYYY-MM-DD' (only month and day are used), cultivar: e.g., 'CIMT01 BH540-Kassie'
+        # - soil: soil_catalog.SoilProfile, fert: [[DAP, amount], ...] applied if fert_app == 'Fert'
+        first_year = str(first_year)
+        NYERS = repr(int(last_year) - int(first_year) + 1)
+        plt_doy = date.fromisoformat(plt_date).timetuple().tm_yday
+        PDATE = first_year[2:] + repr(plt_doy).zfill(3)
+        ICDAT = first_year[2:] + repr(plt_doy-1).zfill(3)  #Initial condition => 1 day before planting
+        SDATE = ICDAT
+        INGENO = cultivar[0:6]
+        CNAME = cultivar[7:]
+        PPOP = str(PPOP)
+        IC_w_ratio = float(IC_w_ratio)
+        MF = '1' if fert_app == 'Fert' else '0'
+        out = [self.head]
+        # *TREATMENTS
+        out.append('{0:3s}{1:31s}{2:3s}{3:3s}{4:3s}{5:3s}{6:3s}{7:3s}{8:3s}{9:3s}{10:3s}{11:3s}{12:3s}{13:3s}'.format(
+            '  1', '1 0 0 ET-SIMAGRI                 1', '  1', '  0', '  1', '  1', '  0', MF.rjust(3),
+            '  0', '  0', '  0', '  0', '  0', '  1'))
+        out.append(" \n")
+        out.append(self.trt_tail)
+        # *CULTIVARS
+        t = self.cul_line
+        out.append(t[0:3] + crop + t[5:6] + INGENO + t[12:13] + CNAME)
+        out.append(" \n")
+        out.append(self.cul_tail)
+        # *FIELDS
+        depth, wp, fc = soil.layer_depth.tolist(), soil.ll.tolist(), soil.dul.tolist()
+        SLDP = repr(depth[-1]) if depth else ''
+        out.append('{0:3s}{1:8s}{2:5s}{3:3s}{4:6s}{5:4s}  {6:10s}{7:4s}'.format(
+            '  1', WSTA + '0001', WSTA.rjust(5), '       -99   -99   -99   -99   -99   -99 ', soil.texture.ljust(6),
+            SLDP.rjust(4), soil.soil_id, ' -99'))
+        out.append(" \n")
+        out.append(self.fld_mid)
+        out.append('{0:3s}{1:89s}'.format('  1', '            -99             -99       -99               -99   -99   -99   -99   -99   -99'))
+        out.append(" \n \n")
+        out.append(self.fld_tail)
+        # *INITIAL CONDITIONS
+        t = self.ic_line
+        out.append(t[0:9] + ICDAT + t[14:])
+        out.append(self.ic_layer_head)
+        t = self.ic_layer_line
+        for nline in range(soil.nlayer):
+            if nline == 0:  # first layer
+                temp_SH2O = IC_w_ratio * (fc[nline] - wp[nline]) + wp[nline]
+                SNO3 = '15' if i_NO3 == 'H' else '5'
+            elif nline == 1:  # second layer
+                temp_SH2O = IC_w_ratio * (fc[nline] - wp[nline]) + wp[nline]
+                SNO3 = '2' if i_NO3 == 'H' else '.5'
+            else:
+                temp_SH2O = fc[nline]
+                SNO3 = '0'
+            SH2O = repr(temp_SH2O)[0:5]
+            out.append(t[0:5] + repr(depth[nline]).rjust(3) + ' ' + SH2O.rjust(5) + t[14:22] + SNO3.rjust(4) + "\n")
+        out.append("  \n")
+        # *PLANTING DETAILS
+        out.append(self.plt_head)
+        t = self.plt_line
+        out.append(t[0:3] + PDATE + '   -99' + PPOP.rjust(6) + PPOP.rjust(6) + t[26:])
+        out.append("  \n")
+        # *FERTILIZERS (INORGANIC): FE005 = Urea, AP001 = Broadcast, not incorporated, 5cm depth
+        out.append(self.fer_head)
+        if fert_app == 'Fert':
+            t = self.fer_line
+            fert = [(float(doy), float(amt)) for doy, amt in fert if float(doy) >= 0 and float(amt) >= 0]
+            for FDATE, FAMN in fert:
+                out.append(t[0:5] + repr(int(FDATE)).rjust(3) + ' FE005 AP001     5 ' + repr(FAMN).rjust(5) +
+                           '   -99   -99' + t[44:])
+            if fert:
+                out.append(" \n")
+        out.append("  \n")
+        # *SIMULATION CONTROLS
+        out.append(self.sim_head)
+        t = self.sim_line
+        out.append(t[0:18] + NYERS.rjust(2) + t[20:33] + SDATE + t[38:])
+        out.append(self.sim_options)
+        out.append(' 1 OP              Y     Y     Y     N     N     N     N     N     D' + "\n")
+        out.append(self.sim_tail)
+        return ''.join(out)
+
+# =============================================
+def get_template(Wdir_path, crop):
+    #parsed TEMP_ETxx.SNX of a crop (parsed again if the file changes)
+    temp_snx = path.join(Wdir_path, "TEMP_ET" + crop + ".SNX")
+    mtime = os.path.getmtime(temp_snx)
+    with _templates_lock:
+        cached = _templates.get(temp_snx)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, SNXTemplate(temp_snx))
+            _templates[temp_snx] = cached
+        return cached[1]
+
+def row_fert(row):
+    #fertilizer applications of a row of the scenario summary table ('-99' in all cells => no fertilizer)
+    fert = [[row.get(c_doy, '-99'), row.get(c_amt, '-99')] for c_doy, c_amt in FERT_COLS]
+    fert_app = 'No_fert' if all(str(v).strip() in ('-99', '-99.0') for pair in fert for v in pair) else 'Fert'
+    return fert, fert_app
+
+def render_row(Wdir_path, row):
+    #SNX text of a row of the scenario summary table
+    crop = row['Crop']
+    cultivar = [c for c in cultivar_options[crop] if c[7:] == row['Cultivar']][0]  #'CIMT01 BH540-Kassie'
+    soil = soil_catalog.get_catalog(path.join(Wdir_path, "ET.SOL")).get(row['soil'])
+    fert, fert_app = row_fert(row)
+    return get_template(Wdir_path, crop).render(crop, row['stn_name'], row['FirstYear'], row['LastYear'],
+                                                '2021-' + row['Plt-date'],  #only month and day are used
+                                                cultivar, soil, row['iH2O'], row['iNO3'], row['plt_density'], fert, fert_app)
+
+def snx_fname(Wdir_path, row):
+    return path.join(Wdir_path, "ET" + row['Crop'] + row['sce_name'][:4] + ".SNX")
+
+def write_snx(Wdir_path, row, out_dir=None):
+    #render a row and write it with one write => SNX file name
+    fname = snx_fname(out_dir or Wdir_path, row)
+    text = render_row(Wdir_path, row)
+    with open(fname, "w") as f:
+        f.write(text)
+    return fname
@@ -0,0 +1,100 @@
+#Catalog of the soil profiles in DSSAT *.SOL files
+# - all profiles are parsed once into compact arrays (layer depth, LL, DUL) with an ID => profile index
+# - the files are parsed again only when their modification time changes
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+SoilProfile = namedtuple('SoilProfile', ['soil_id', 'site', 'texture', 'depth', 'nlayer', 'layer_depth', 'll', 'dul'])
+
+_catalogs = {}  #tuple of SOL file names => SoilCatalog
+_catalogs_lock = threading.Lock()
+
+# =============================================
+def parse_SOL(SOL_file):
+    #all profiles of a *.SOL file => {ID_SOIL: SoilProfile}
+    profiles = {}
+    with open(SOL_file, "r") as f:
+        lines = f.read().splitlines()
+    n = len(lines)
+    i = 0
+    while i < n:
+        line = lines[i]
+        if not line.startswith('*') or line.startswith('*SOILS'):
+            i += 1
+            continue
+        #*ETET000010  Awassa      L         90  ET000010
+        soil_id = line[1:11].strip()
+        site = line[13:25].strip()
+        texture = line[25:29].strip()
+        soil_depth = int(line[33:38])
+        #first layer table (@  SLB  SLMH  SLLL  SDUL ...) of the profile
+        i += 1
+        while i < n and not lines[i].startswith('*') and not lines[i].startswith('@  SLB'):
+            i += 1
+        depth_layer, ll_layer, ul_layer = [], [], []
+        if i < n and lines[i].startswith('@  SLB'):
+            i += 1
+            while i < n and lines[i].strip() and lines[i].lstrip()[0].isdigit():
+                depth_layer.append(int(lines[i][0:6]))
+                ll_layer.append(float(lines[i][13:18]))
+                ul_layer.append(float(lines[i][19:24]))
+                i += 1
+                if depth_layer[-1] == soil_depth:  #last layer = soil depth (SLDP)
+                    break
+        profiles[soil_id] = SoilProfile(soil_id, site, texture, soil_depth, len(depth_layer),
+                                        np.array(depth_layer, dtype=np.int32),
+                                        np.array(ll_layer, dtype=np.float64),
+                                        np.array(ul_layer, dtype=np.float64))
+    return profiles
+
+# =============================================
+class SoilCatalog:
+    def __init__(self, SOL_files):
+        self.SOL_files = list(SOL_files)
+        self._mtimes = None
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def _file_mtimes(self):
+        return [os.path.getmtime(f) if os.path.isfile(f) else None for f in self.SOL_files]
+
+    def profiles(self):
+        #{ID_SOIL: SoilProfile}, parsed again only if a SOL file has changed
+        mtimes = self._file_mtimes()
+        if mtimes != self._mtimes:
+            with self._lock:
+                if mtimes != self._mtimes:
+                    profiles = {}
+                    for SOL_file, mtime in zip(self.SOL_files, mtimes):
+                        if mtime is not None:
+                            profiles.update(parse_SOL(SOL_file))
+                    self._profiles = profiles
+                    self._mtimes = mtimes
+        return self._profiles
+
+    def get(self, ID_SOIL):
+        profiles = self.profiles()
+        if ID_SOIL not in profiles:
+            raise KeyError("soil profile {} not found in {}".format(ID_SOIL, ", ".join(self.SOL_files)))
+        return profiles[ID_SOIL]
+
+    def dropdown_options(self):
+        #options for the soil dropdown, e.g., 'ETET001_18(Melkassa,L,200cm)'
+        return [{'label': '{}({})'.format(p.soil_id, ','.join(v for v in (p.site, p.texture, str(p.depth) + 'cm') if v)),
+                 'value': p.soil_id} for p in self.profiles().values()]
+
+def get_catalog(SOL_file):
+    key = (SOL_file,) if isinstance(SOL_file, str) else tuple(SOL_file)
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = SoilCatalog(key)
+        return _catalogs[key]
+
+# =============================================
+def get_soil_IC(SOL_file, ID_SOIL):
+    #soil info for the initial conditions of the SNX (lists of python numbers, as written into the SNX)
+    p = get_catalog(SOL_file).get(ID_SOIL)
+    return p.layer_depth.tolist(), p.ll.tolist(), p.dul.tolist(), p.nlayer, p.texture
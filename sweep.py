@@ -0,0 +1,263 @@
+#Headless bulk scenario sweeps (no Dash): same SNX renderer, DSSAT runner, OSU reader and result cache as the app
+# - scenarios: CSV or JSON (list of rows) with the columns of the scenario summary table
+# - results  : tidy table (one row per scenario and year: yield, N applied, gross margin) in Parquet or CSV
+# - scenarios are run in chunks; each finished chunk is saved in <output>.parts => an interrupted sweep resumes from there
+# - new DSSAT runs are also appended to the results archive (results_archive, if pyarrow is installed)
+#usage: python sweep.py scenarios.csv results.parquet [--wdir path] [--workers 8] [--chunk 100] [--no-resume]
+import os
+import sys
+import glob
+import json
+import shutil
+import argparse
+import tempfile
+from os import path
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+import dssat_runner
+import result_cache
+import osu_reader
+import results_store
+import results_archive
+import sim_stats
+import snx_template
+import weather_store
+
+SCE_COLS = ["sce_name", "Crop", "Cultivar", "stn_name", "Plt-date", "FirstYear", "LastYear", "soil", "iH2O", "iNO3",
+            "plt_density"]  #required columns
+OPTIONAL_COLS = {c: '-99' for pair in result_cache.FERT_COLS for c in pair}
+OPTIONAL_COLS.update({c: '-99' for c in results_store.EB_COLS})
+OPTIONAL_COLS['TargetYr'] = '-99'
+OSU_COLS = ['PDAT', 'ADAT', 'MDAT', 'HWAM', 'NICM']
+OUT_COLS = ['sce_name', 'Crop', 'Cultivar', 'stn_name', 'YEAR', 'PDAT', 'ADAT', 'MDAT', 'HWAM', 'NICM', 'GMargin']
+CHUNK_SIZE = 100  #scenarios run (and saved) together
+
+# =============================================
+def load_scenarios(fname):
+    #scenario file => DataFrame of strings with all the columns of the scenario summary table
+    if fname.lower().endswith('.json'):
+        with open(fname, 'r') as f:
+            df = pd.DataFrame(json.load(f)).fillna('').astype(str)
+    else:
+        df = pd.read_csv(fname, dtype=str, keep_default_na=False)
+    missing = [c for c in SCE_COLS if c not in df.columns]
+    if missing:
+        raise ValueError("columns missing in {}: {}".format(fname, ", ".join(missing)))
+    for c, default in OPTIONAL_COLS.items():
+        if c not in df.columns:
+            df[c] = default
+        df.loc[df[c].str.strip().isin(['', 'nan', 'None']), c] = default  #empty cells
+    duplicated = df.sce_name[df.sce_name.duplicated()].unique()
+    if len(duplicated):
+        raise ValueError("duplicated sce_name in {}: {}".format(fname, ", ".join(duplicated)))
+    return df.reset_index(drop=True)
+
+def check_output(out_fname):
+    if out_fname.lower().endswith('.parquet'):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            try:
+                import fastparquet  # noqa: F401
+            except ImportError:
+                raise ValueError("writing Parquet needs pyarrow or fastparquet (pip install pyarrow), or use a .csv output")
+    elif not out_fname.lower().endswith('.csv'):
+        raise ValueError("output must be a .parquet or .csv file: " + out_fname)
+
+def short_name(i, prefix='w'):
+    #4-character scenario name of the i-th scenario (EXNAME = ETxx + 4 characters), e.g., DSSAT files of a chunk
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    return prefix + digits[i // 1296 % 36] + digits[i // 36 % 36] + digits[i % 36]
+
+# =============================================
+#factorial grids (planting date x density x N rate x cultivar) for response surfaces
+MAX_GRID = 36 ** 3  #scenarios with a 4-character name
+
+def parse_values(text):
+    #'4, 6,8' => ['4', '6', '8'] (values are kept as typed because they are written into the SNX as text)
+    values = [v.strip() for v in str(text).replace(';', ',').split(',') if v.strip()]
+    for v in values:
+        float(v)  #ValueError if not a number
+    return values
+
+def date_range(first_date, last_date, step_days):
+    #planting dates 'MM-DD' from first_date to last_date ('YYYY-MM-DD', same year) every step_days
+    first, last = date.fromisoformat(first_date[:10]), date.fromisoformat(last_date[:10])
+    step_days = int(step_days)
+    if step_days < 1 or last < first:
+        raise ValueError("invalid planting date range")
+    return [(first + timedelta(days=d)).strftime('%m-%d') for d in range(0, (last - first).days + 1, step_days)]
+
+def expand_grid(base, plt_dates, densities, n_rates, cultivars):
+    #one scenario per planting date x density x N rate x cultivar; other inputs from the base row
+    #the N rate is applied at planting (DAP 0), 0 => no fertilizer
+    n_grid = len(plt_dates) * len(densities) * len(n_rates) * len(cultivars)
+    if n_grid == 0 or n_grid > MAX_GRID:
+        raise ValueError("the grid has {} scenarios (1 to {} allowed)".format(n_grid, MAX_GRID))
+    rows = []
+    for cultivar in cultivars:
+        for plt_date in plt_dates:
+            for density in densities:
+                for n_rate in n_rates:
+                    row = dict(base)
+                    row.update({c: '-99' for pair in result_cache.FERT_COLS for c in pair})
+                    row.update({'sce_name': short_name(len(rows), 'f'), 'Cultivar': cultivar, 'Plt-date': plt_date,
+                                'plt_density': density, 'NRate': n_rate})
+                    if float(n_rate) > 0:
+                        row['1_Fert(DOY)'], row['1_Fert(Kg/ha)'] = '0', n_rate
+                    rows.append(row)
+    return pd.DataFrame(rows)
+
+def grid_summary(grid, df):
+    #median yield (crop failure = 0) and gross margin of each scenario of the grid, from the tidy results
+    isce = pd.Categorical(df.sce_name, categories=grid.sce_name).codes  #row of the grid of each result
+    ok = isce >= 0
+    summary = grid[['sce_name', 'Cultivar', 'Plt-date', 'plt_density', 'NRate']].reset_index(drop=True)
+    HWAM = np.where(df.HWAM.values < 0, 0, df.HWAM.values)
+    for c, values in (('HWAM', HWAM), ('GMargin', df.GMargin.values)):
+        summary[c] = sim_stats.quantiles(values[ok], isce[ok], len(grid), q=(0.5,))[:, 0]
+    return summary
+
+# =============================================
+def tidy_results(dff, sim_results):
+    #results of the scenarios in dff => one row per scenario and year
+    table = results_store.make_table(dff.sce_name.values, sim_results, OSU_COLS)
+    isce = table['SCE']
+    price = dff[results_store.EB_COLS].astype(float).values[isce]
+    df = pd.DataFrame({c: dff[c].values[isce] for c in ['sce_name', 'Crop', 'Cultivar', 'stn_name']})
+    df['YEAR'] = table['PDAT'] // 1000
+    for c in OSU_COLS:
+        df[c] = table[c]
+    gmargin = results_store.gross_margin(table['HWAM'], table['NICM'], price)
+    df['GMargin'] = np.where((price == -99).any(axis=1), np.nan, gmargin)  #no prices => no gross margin
+    return df[OUT_COLS]
+
+def run_chunk(Wdir_path, dff, cache, n_workers=None, progress=None, out_dir=None, archive=None, token=None):
+    #run the scenarios of dff (cache first) => tidy results
+    #out_dir: parent of the temporary directory of the DSSAT outputs of the chunk (default system temp directory)
+    #=> the run names (w000...) reused by each chunk never overwrite the outputs of another run
+    #archive: results_archive.ResultsArchive receiving the scenarios run by DSSAT (not the cached ones)
+    #token: dssat_governor.Token cancelling the DSSAT runs
+    rows = dff.to_dict('records')
+    keys = [result_cache.scenario_key(Wdir_path, row) for row in rows]
+    sim_results = [cache.get(key) for key in keys]
+    idx_run = [i for i in range(len(rows)) if sim_results[i] is None]
+    if progress is not None:
+        progress(len(rows) - len(idx_run))
+    if idx_run:
+        dff_run = dff.iloc[idx_run].reset_index(drop=True)
+        dff_run['sce_name'] = [short_name(i) for i in range(len(idx_run))]
+        snx_texts = [snx_template.render_row(Wdir_path, row) for row in dff_run.to_dict('records')]
+        run_dir = tempfile.mkdtemp(prefix='sweep_', dir=out_dir)
+        try:
+            fout_names = dssat_runner.run_scenarios(Wdir_path, dff_run, n_workers=n_workers, snx_texts=snx_texts,
+                                                    out_dir=run_dir, progress=None if progress is None else
+                                                    lambda n_done: progress(len(rows) - len(idx_run) + n_done), token=token)
+            for i, fout_name in zip(idx_run, fout_names):
+                sim_results[i] = osu_reader.read_osu(fout_name, OSU_COLS, missing=None)
+                cache.put(keys[i], sim_results[i])
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+        if archive is not None:
+            archive.append(dff.iloc[idx_run], [sim_results[i] for i in idx_run], [keys[i] for i in idx_run])
+    return tidy_results(dff, sim_results)
+
+# =============================================
+def parts_dir(out_fname):
+    return out_fname + '.parts'
+
+def done_scenarios(out_fname):
+    #scenarios saved by a previous (interrupted) run of the sweep
+    done = set()
+    for fname in glob.glob(path.join(parts_dir(out_fname), 'part-*.csv')):
+        done.update(pd.read_csv(fname, usecols=['sce_name'], dtype=str).sce_name.unique())
+    return done
+
+def save_part(out_fname, df):
+    os.makedirs(parts_dir(out_fname), exist_ok=True)
+    n_parts = len(glob.glob(path.join(parts_dir(out_fname), 'part-*.csv')))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=parts_dir(out_fname))
+    with os.fdopen(fd, 'w') as f:
+        df.to_csv(f, index=False)
+    os.replace(tmp, path.join(parts_dir(out_fname), 'part-{:05d}.csv'.format(n_parts)))
+
+def run_sweep(Wdir_path, scenarios, out_fname, n_workers=None, chunk_size=CHUNK_SIZE, resume=True, progress=None):
+    #run all scenarios (DataFrame from load_scenarios) and write the tidy results into out_fname (.parquet or .csv)
+    #progress(n_done, n_total) is called as the scenarios finish
+    check_output(out_fname)
+    if not resume:
+        shutil.rmtree(parts_dir(out_fname), ignore_errors=True)
+    done = done_scenarios(out_fname)
+    n_total = len(scenarios)
+    n_done = int(scenarios.sce_name.isin(done).sum())
+    if progress is not None:
+        progress(n_done, n_total)
+
+    #scenarios without weather data for all their years are reported and skipped
+    weather = weather_store.WeatherStore(Wdir_path, path.join(Wdir_path, "cache", "weather"))
+    todo = []
+    for i, row in scenarios.iterrows():
+        if row.sce_name in done:
+            continue
+        try:
+            missing_years = weather.missing_years(row.stn_name, row.FirstYear, row.LastYear)
+        except (KeyError, ValueError) as e:
+            missing_years = [str(e)]
+        if missing_years:
+            print('WARNING: scenario {} skipped, no weather data for {} in {}'.format(
+                row.sce_name, row.stn_name, ', '.join(map(str, missing_years))), file=sys.stderr)
+            continue
+        todo.append(i)
+
+    cache = result_cache.ResultCache(result_cache.CACHE_DIR or path.join(Wdir_path, "cache"))
+    archive = results_archive.ResultsArchive(results_archive.ARCHIVE_DIR or path.join(Wdir_path, "archive"))
+    out_dir = path.join(parts_dir(out_fname), 'dssat')  #outputs of the runs => nothing written into Wdir_path
+    os.makedirs(out_dir, exist_ok=True)
+    for start in range(0, len(todo), chunk_size):
+        chunk = scenarios.loc[todo[start:start + chunk_size]].reset_index(drop=True)
+        n_before = n_done
+        df = run_chunk(Wdir_path, chunk, cache, n_workers,
+                       None if progress is None else lambda n: progress(n_before + n, n_total), out_dir, archive)
+        save_part(out_fname, df)
+        n_done = n_before + len(chunk)
+
+    #all parts => one table in the order of the scenario file
+    parts = [pd.read_csv(f, dtype={'sce_name': str, 'Crop': str, 'Cultivar': str, 'stn_name': str})
+             for f in sorted(glob.glob(path.join(parts_dir(out_fname), 'part-*.csv')))]
+    df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=OUT_COLS)
+    order = {s: i for i, s in enumerate(scenarios.sce_name)}
+    df = df[df.sce_name.isin(order.keys())]
+    df = df.iloc[np.lexsort((df.PDAT.values, df.sce_name.map(order).values))].reset_index(drop=True)
+    if out_fname.lower().endswith('.parquet'):
+        df.to_parquet(out_fname, index=False)
+    else:
+        df.to_csv(out_fname, index=False)
+    shutil.rmtree(parts_dir(out_fname), ignore_errors=True)
+    return df
+
+# =============================================
+def print_progress(n_done, n_total):
+    print('\r{}/{} scenarios done'.format(n_done, n_total), end='' if n_done < n_total else '\n', file=sys.stderr, flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a sweep of SIMAGRI scenarios without the web app')
+    parser.add_argument('scenarios', help='CSV or JSON file with the columns of the scenario summary table')
+    parser.add_argument('output', help='tidy results (.parquet or .csv)')
+    parser.add_argument('--wdir', default=os.environ.get('SIMAGRI_WDIR', 'C:\\IRI\\Python_Dash\\ET_DSS_hist\\TEST\\'),
+                        help='DSSAT working directory (default: SIMAGRI_WDIR)')
+    parser.add_argument('--workers', type=int, default=None, help='DSSAT runs in parallel (default: SIMAGRI_WORKERS)')
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE, help='scenarios run and saved together')
+    parser.add_argument('--no-resume', action='store_true', help='ignore the results of an interrupted run')
+    args = parser.parse_args()
+    try:
+        scenarios = load_scenarios(args.scenarios)
+        df = run_sweep(args.wdir, scenarios, args.output, args.workers, args.chunk, not args.no_resume, print_progress)
+    except ValueError as e:
+        parser.exit(1, 'error: {}\n'.format(e))
+    print('{} rows written into {}'.format(len(df), args.output), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
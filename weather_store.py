@@ -0,0 +1,174 @@
+#Columnar store of the station weather (DSSAT *.WTH files, one file per station and year, e.g., MELK9301.WTH)
+# - all WTH files of a station are ingested once into float32 arrays (SRAD, TMAX, TMIN, RAIN) + a date index (YYYYDDD)
+#   saved as *.npy in cache_dir and memory-mapped; ingested again only if a WTH file changes
+# - fast slicing by station, year range and day-of-year window
+# - writer to emit the WTH files DSSAT needs
+import os
+import glob
+import json
+import tempfile
+import threading
+from os import path
+
+import numpy as np
+
+VARS = ('SRAD', 'TMAX', 'TMIN', 'RAIN')
+META_COLS = ('INSI', 'LAT', 'LONG', 'ELEV', 'TAV', 'AMP', 'REFHT', 'WNDHT')
+YEAR_PIVOT = 50  #2-digit years: YY >= 50 => 19YY, otherwise 20YY
+
+# =============================================
+def parse_WTH(fname):
+    #one WTH file => (header dict, dates (YYYYDDD), data (ndays x 4 float32))
+    with open(fname, "r") as f:
+        lines = f.read().splitlines()
+    header = {}
+    i = 0
+    while i < len(lines) and not lines[i].startswith('@DATE'):
+        if lines[i].startswith('@ INSI'):
+            header['header_line'] = lines[i + 1]
+            for k, v in zip(META_COLS, lines[i + 1].split()):
+                header[k] = v if k == 'INSI' else float(v)
+        i += 1
+    var_line = lines[i]
+    #numbers are right-aligned in 6-character fields ending at the end of the variable name
+    ends = {v: var_line.index(v) + len(v) for v in VARS}
+    rows = [line for line in lines[i + 1:] if line.strip()]
+    width = max(len(line) for line in rows)
+    block = np.array([line.encode() for line in rows], dtype='S%d' % width).view(np.uint8).reshape(len(rows), width)
+    date_field = np.ascontiguousarray(block[:, 0:5]).view('S5').ravel().astype(np.int32)
+    yy, doy = date_field // 1000, date_field % 1000
+    dates = (np.where(yy >= YEAR_PIVOT, 1900, 2000) + yy) * 1000 + doy
+    data = np.empty((len(rows), len(VARS)), dtype=np.float32)
+    for k, v in enumerate(VARS):
+        field = np.ascontiguousarray(block[:, ends[v] - 6:ends[v]]).view('S6').ravel()
+        data[:, k] = field.astype(np.float32)
+    return header, dates.astype(np.int32), data
+
+# =============================================
+class StationWeather:
+    def __init__(self, station, meta, dates, data):
+        self.station = station
+        self.meta = meta  #LAT/LONG/ELEV/TAV/AMP... from the WTH header
+        self.dates = dates  #YYYYDDD, sorted
+        self.data = data  #ndays x 4 (SRAD, TMAX, TMIN, RAIN)
+        self.years = np.unique(dates // 1000)
+
+    def var(self, name):
+        return self.data[:, VARS.index(name)]
+
+    def missing_years(self, first_year, last_year):
+        return sorted(set(range(int(first_year), int(last_year) + 1)) - set(self.years.tolist()))
+
+    def slice(self, first_year, last_year, doy_start=None, doy_end=None):
+        #(dates, data) of the years first_year-last_year, optionally only days doy_start-doy_end
+        #(a window with doy_start > doy_end wraps around the end of the year)
+        i0, i1 = np.searchsorted(self.dates, [int(first_year) * 1000, (int(last_year) + 1) * 1000])
+        dates, data = self.dates[i0:i1], self.data[i0:i1]
+        if doy_start is not None:
+            doy = dates % 1000
+            if doy_start <= doy_end:
+                mask = (doy >= doy_start) & (doy <= doy_end)
+            else:
+                mask = (doy >= doy_start) | (doy <= doy_end)
+            dates, data = dates[mask], data[mask]
+        return dates, data
+
+    def wth_text(self, year):
+        #WTH file of one year in the same format as the station files
+        i0, i1 = np.searchsorted(self.dates, [year * 1000, (year + 1) * 1000])
+        lines = ["*WEATHER DATA : " + self.station, "",
+                 "@ INSI      LAT     LONG  ELEV   TAV   AMP REFHT WNDHT", self.meta['header_line'],
+                 "@DATE  SRAD  TMAX  TMIN  RAIN  DEWP  WIND   PAR  EVAP  RHUM"]
+        yyddd = (self.dates[i0:i1] // 1000 % 100) * 1000 + self.dates[i0:i1] % 1000
+        for d, row in zip(yyddd.tolist(), self.data[i0:i1].tolist()):
+            lines.append('{0:05d}{1:6.1f}{2:6.1f}{3:6.1f}{4:6.1f}'.format(d, *row) + ' ' * 30)
+        return "\n".join(lines) + "\n"
+
+    def write_wth(self, out_dir, years=None):
+        #write STATYY01.WTH files into out_dir (all years by default) => list of file names
+        fnames = []
+        for year in (self.years if years is None else years):
+            fname = path.join(out_dir, '{}{:02d}01.WTH'.format(self.station, int(year) % 100))
+            with open(fname, "w") as f:
+                f.write(self.wth_text(int(year)))
+            fnames.append(fname)
+        return fnames
+
+# =============================================
+class WeatherStore:
+    def __init__(self, wth_dir, cache_dir):
+        self.wth_dir = wth_dir
+        self.cache_dir = cache_dir
+        self._stations = {}
+        self._lock = threading.Lock()
+
+    def stations(self):
+        return sorted(set(path.basename(f)[:4] for f in glob.glob(path.join(self.wth_dir, "*.WTH"))))
+
+    def _sources(self, station):
+        fnames = sorted(glob.glob(path.join(self.wth_dir, station + "????.WTH")))
+        return fnames, [[path.basename(f), os.path.getmtime(f), os.path.getsize(f)] for f in fnames]
+
+    def _ingest(self, station, fnames, sources):
+        meta, all_dates, all_data = None, [], []
+        for fname in fnames:
+            header, dates, data = parse_WTH(fname)
+            meta = meta or header
+            all_dates.append(dates)
+            all_data.append(data)
+        dates = np.concatenate(all_dates)
+        order = np.argsort(dates, kind='stable')
+        meta = dict(meta, sources=sources)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        #write to temp files and rename => other workers never read partial files
+        for name, arr in (('dates', dates[order]), ('data', np.concatenate(all_data)[order])):
+            fd, tmp = tempfile.mkstemp(suffix='.npy', dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp, path.join(self.cache_dir, '{}_{}.npy'.format(station, name)))
+        fd, tmp = tempfile.mkstemp(suffix='.json', dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path.join(self.cache_dir, station + '_meta.json'))
+
+    def get(self, station):
+        #StationWeather with memory-mapped arrays
+        fnames, sources = self._sources(station)
+        if not fnames:
+            raise KeyError("no WTH files for station {} in {}".format(station, self.wth_dir))
+        with self._lock:
+            cached = self._stations.get(station)
+            if cached is not None and cached.meta.get('sources') == sources:
+                return cached
+            meta_fname = path.join(self.cache_dir, station + '_meta.json')
+            meta = None
+            if path.isfile(meta_fname):
+                with open(meta_fname, 'r') as f:
+                    meta = json.load(f)
+            if meta is None or meta.get('sources') != sources:
+                self._ingest(station, fnames, sources)
+                with open(meta_fname, 'r') as f:
+                    meta = json.load(f)
+            dates = np.load(path.join(self.cache_dir, station + '_dates.npy'), mmap_mode='r')
+            data = np.load(path.join(self.cache_dir, station + '_data.npy'), mmap_mode='r')
+            self._stations[station] = StationWeather(station, meta, dates, data)
+            return self._stations[station]
+
+    def slice(self, station, first_year, last_year, doy_start=None, doy_end=None):
+        return self.get(station).slice(first_year, last_year, doy_start, doy_end)
+
+    def missing_years(self, station, first_year, last_year):
+        return self.get(station).missing_years(first_year, last_year)
+
+    def write_wth(self, station, out_dir, years=None):
+        return self.get(station).write_wth(out_dir, years)
+
+    def report_missing(self, first_year, last_year):
+        #load all stations and report the years without weather data => {station: [years]}
+        report = {}
+        for station in self.stations():
+            missing = self.missing_years(station, first_year, last_year)
+            if missing:
+                print('WARNING: no weather data for {} in {}'.format(station, ', '.join(map(str, missing))))
+                report[station] = missing
+        return report
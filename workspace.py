@@ -0,0 +1,91 @@
+#Per-session working directories => concurrent users never share the DSSAT outputs, SNX, DSSBatch.V47 or simulated_yield.csv
+# - Wdir_path (SIMAGRI_WDIR) is only read: executable, templates, SOL/CUL/ECO/SPE and WTH files
+# - root: SIMAGRI_WORKSPACE_ROOT (e.g., a tmpfs mount), default <system temp>/simagri_workspaces
+# - workspaces not used for SIMAGRI_WORKSPACE_TTL seconds are removed (checked at most every TTL/4)
+# - quota: a run is refused when its workspace already uses more than SIMAGRI_WORKSPACE_MB
+import os
+import time
+import shutil
+import tempfile
+import threading
+from os import path
+
+import session_store
+
+WORKSPACE_ROOT = os.environ.get('SIMAGRI_WORKSPACE_ROOT', path.join(tempfile.gettempdir(), 'simagri_workspaces'))
+WORKSPACE_TTL = float(os.environ.get('SIMAGRI_WORKSPACE_TTL', session_store.SESSION_TTL))  #seconds without use
+WORKSPACE_MB = float(os.environ.get('SIMAGRI_WORKSPACE_MB', 100))  #max. disk space used by one workspace
+
+class QuotaExceeded(Exception):
+    pass
+
+# =============================================
+def dir_size(dirname):
+    #bytes used by the files in dirname (incl. sub-directories)
+    n_bytes = 0
+    for root, dirs, files in os.walk(dirname):
+        for fname in files:
+            try:
+                n_bytes += os.lstat(path.join(root, fname)).st_size
+            except OSError:  #removed in the meantime
+                pass
+    return n_bytes
+
+# =============================================
+class WorkspaceManager:
+    def __init__(self, root=WORKSPACE_ROOT, ttl=WORKSPACE_TTL, max_mb=WORKSPACE_MB):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._last_cleanup = 0
+
+    def path(self, session_id):
+        if not session_store.valid_session_id(session_id):
+            raise KeyError("invalid session id")
+        return path.join(self.root, session_id)
+
+    def get(self, session_id):
+        #directory of the session (created if needed); its mtime is the last use
+        dirname = self.path(session_id)
+        os.makedirs(dirname, exist_ok=True)
+        os.utime(dirname)
+        now = time.time()
+        with self._lock:
+            cleanup = now - self._last_cleanup > self.ttl / 4
+            if cleanup:
+                self._last_cleanup = now
+        if cleanup:
+            self.cleanup(keep=session_id)
+        return dirname
+
+    def usage(self, session_id):
+        dirname = self.path(session_id)
+        return dir_size(dirname) if path.isdir(dirname) else 0
+
+    def check_quota(self, session_id):
+        n_bytes = self.usage(session_id)
+        if n_bytes > self.max_bytes:
+            raise QuotaExceeded('workspace uses {:.1f} MB (max. {:.0f} MB), please reload the page to start a new session'.format(
+                n_bytes / 1024 / 1024, self.max_bytes / 1024 / 1024))
+
+    def cleanup(self, keep=None):
+        #remove the workspaces not used for longer than the TTL
+        now = time.time()
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for name in names:
+            dirname = path.join(self.root, name)
+            if name == keep or not session_store.valid_session_id(name):
+                continue
+            try:
+                expired = now - os.path.getmtime(dirname) > self.ttl
+            except OSError:
+                continue
+            if expired:
+                shutil.rmtree(dirname, ignore_errors=True)
+
+    def remove(self, session_id):
+        shutil.rmtree(self.path(session_id), ignore_errors=True)
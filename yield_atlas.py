@@ -0,0 +1,332 @@
+#Precomputed yield atlas of the standard scenarios: no fertilizer, planting density of the SNX template and every
+#station x crop x cultivar x soil x initial H2O x initial NO3 x weekly planting date, simulated for 1981-2018
+# - one .npy per summary output (PDAT, ADAT, MDAT, HWAM, NICM) of shape (grid points, years), int16 (dates are days
+#   since January 1st of the simulated year) => memory-mapped by the web workers, a lookup reads 5 x 38 values
+# - status.npy: 0 = not simulated yet, 1 = done, 2 = no usable output (e.g., DSSAT failed) => simulated on request
+# - atlas.json: grid axes + provenance of each crop/station block (hashes of the templates, DSSAT executable,
+#   CUL/ECO/SPE, SOL and WTH files, as in result_cache). A block whose inputs changed is not served until rebuilt
+# - a scenario with other inputs (fertilizer, density, dates off the grid, years outside 1981-2018) is run by DSSAT
+#usage: python yield_atlas.py build [--crops MZ] [--stations MELK BAKO] [--soils ETET001_18] [--step 7] [--workers 8]
+#       python yield_atlas.py status
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from os import path
+
+import numpy as np
+import pandas as pd
+
+import dssat_runner
+import osu_reader
+import result_cache
+import run_metrics
+import snx_template
+import soil_catalog
+import sweep
+import weather_store
+
+ATLAS_DIR = os.environ.get('SIMAGRI_ATLAS_DIR')  #None => <Wdir_path>/atlas
+STATIONS = ['MELK', 'AWAS', 'BAKO', 'MAHO']
+IH2O = ['0.3', '0.5', '0.7', '1.0']
+INO3 = ['H', 'L']
+FIRST_YEAR, LAST_YEAR = 1981, 2018
+STEP_DAYS = 7  #between two planting dates of the grid
+AXES = ['crop', 'station', 'cultivar', 'soil', 'iH2O', 'iNO3', 'plt_date']  #order of the grid dimensions
+OSU_COLS = ['PDAT', 'ADAT', 'MDAT', 'HWAM', 'NICM']
+DATE_COLS = ['PDAT', 'ADAT', 'MDAT']
+MISSING = np.iinfo(np.int16).min  #-99 in the outputs
+CHUNK_SIZE = 50  #scenarios per DSSAT launch during the build (one launch per worker process at a time)
+VERSION_CHECK_S = 10  #seconds between two checks of the input files of a block by the web app (and at each atlas.json load)
+
+# =============================================
+def default_density(Wdir_path, crop):
+    #PPOP of the planting line of the SNX template (e.g., '6.6' plants/m2 for maize)
+    return snx_template.get_template(Wdir_path, crop).plt_line[14:20].strip()
+
+def make_axes(Wdir_path, crops=None, stations=None, soils=None, step_days=STEP_DAYS):
+    #values of each grid dimension; cultivars are per crop (same number for all crops)
+    crops = crops or list(snx_template.cultivar_options)
+    soils = soils or [o['value'] for o in soil_catalog.get_catalog(path.join(Wdir_path, "ET.SOL")).dropdown_options()]
+    return {'crop': crops, 'station': stations or STATIONS,
+            'cultivar': {c: [name[7:] for name in snx_template.cultivar_options[c]] for c in crops},
+            'soil': soils, 'iH2O': IH2O, 'iNO3': INO3,
+            'plt_date': sweep.date_range('2021-01-01', '2021-12-31', step_days),
+            'density': {c: default_density(Wdir_path, c) for c in crops},
+            'years': [FIRST_YEAR, LAST_YEAR]}
+
+def grid_shape(axes):
+    return tuple(len(next(iter(axes['cultivar'].values()))) if a == 'cultivar' else len(axes[a]) for a in AXES)
+
+def files_version(Wdir_path, crop, station):
+    #input files of a block => (their hashes, one hash of all)
+    files = result_cache.input_files_version(Wdir_path, crop, station)
+    return files, hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()
+
+# =============================================
+def encode_dates(values, years):
+    #YYYYDDD => days since January 1st of the simulated year (MISSING for -99)
+    values = np.asarray(values, dtype=np.int64)
+    ok = values > 0
+    day = (np.maximum(values // 1000, 1) - 1970).astype('datetime64[Y]').astype('datetime64[D]') + (values % 1000 - 1)
+    start = (np.asarray(years) - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+    return np.where(ok, (day - start).astype(np.int64), MISSING)
+
+def decode_dates(offsets, years):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    day = (np.asarray(years) - 1970).astype('datetime64[Y]').astype('datetime64[D]') + np.where(offsets == MISSING, 0, offsets)
+    year = day.astype('datetime64[Y]')
+    values = (year.astype(np.int64) + 1970) * 1000 + (day - year.astype('datetime64[D]')).astype(np.int64) + 1
+    return np.where(offsets == MISSING, -99, values)
+
+def encode_result(result, years):
+    #summary outputs of one scenario (read_osu) => {column: int16 values by year}, None if they do not fit
+    if result is None or len(result['PDAT']) != len(years):
+        return None
+    out = {}
+    for c in OSU_COLS:
+        values = encode_dates(result[c], years) if c in DATE_COLS else np.where(result[c] == -99, MISSING, result[c])
+        if (values < MISSING).any() or (values > np.iinfo(np.int16).max).any():
+            return None
+        out[c] = values.astype(np.int16)
+    return out
+
+# =============================================
+class YieldAtlas:
+    #read side (web app): memory-mapped arrays, opened again when atlas.json changes (rebuild)
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._loaded = None  #(mtime of atlas.json, meta, {column: array}, status)
+        self._checked = {}  #(Wdir_path, block) => (meta, time of the check, block built with the current input files)
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        fname = path.join(self.root, 'atlas.json')
+        try:
+            mtime = os.stat(fname).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            if self._loaded is None or self._loaded[0] != mtime:
+                with open(fname, 'r') as f:
+                    meta = json.load(f)
+                arrays = {c: np.load(path.join(self.root, c + '.npy'), mmap_mode='r') for c in OSU_COLS}
+                self._loaded = (mtime, meta, arrays, np.load(path.join(self.root, 'status.npy'), mmap_mode='r'))
+            return self._loaded[1:]
+
+    def index(self, row):
+        #row of the scenario summary table => (grid point, first year, last year), None if not a standard scenario
+        loaded = self._load()
+        if loaded is None:
+            return None
+        axes = loaded[0]['axes']
+        crop = row['Crop']
+        try:
+            first_year, last_year = int(row['FirstYear']), int(row['LastYear'])
+            if (crop not in axes['crop'] or result_cache.fert_list(row) or
+                    float(row['plt_density']) != float(axes['density'][crop]) or
+                    first_year < axes['years'][0] or last_year > axes['years'][1] or first_year > last_year):
+                return None
+            idx = (axes['crop'].index(crop), axes['station'].index(row['stn_name']),
+                   axes['cultivar'][crop].index(row['Cultivar']), axes['soil'].index(row['soil']),
+                   [float(v) for v in axes['iH2O']].index(float(row['iH2O'])), axes['iNO3'].index(row['iNO3']),
+                   axes['plt_date'].index(row['Plt-date']))
+        except (KeyError, TypeError, ValueError):  #value not in the grid (list.index), or not a number
+            return None
+        return int(np.ravel_multi_index(idx, grid_shape(axes))), first_year, last_year
+
+    def block_valid(self, Wdir_path, meta, name):
+        #block built with the current input files? (hashed again only for a new atlas.json or after VERSION_CHECK_S)
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get((Wdir_path, name))
+        if checked is not None and checked[0] is meta and now - checked[1] < VERSION_CHECK_S:
+            return checked[2]
+        crop, station = name.split('/')
+        valid = meta['blocks'].get(name, {}).get('version') == files_version(Wdir_path, crop, station)[1]
+        with self._lock:
+            self._checked[(Wdir_path, name)] = (meta, now, valid)
+        return valid
+
+    def lookup(self, Wdir_path, row):
+        #precomputed outputs of a standard scenario (same dict of arrays as osu_reader.read_osu), None otherwise
+        found = self.index(row)
+        result = None
+        if found is not None:
+            point, first_year, last_year = found
+            meta, arrays, status = self._load()
+            if status[point] == 1 and self.block_valid(Wdir_path, meta, row['Crop'] + '/' + row['stn_name']):
+                i0, i1 = first_year - meta['axes']['years'][0], last_year - meta['axes']['years'][0] + 1
+                years = np.arange(first_year, last_year + 1)
+                result = {}
+                for c in OSU_COLS:
+                    values = np.asarray(arrays[c][point, i0:i1], dtype=np.int64)
+                    result[c] = decode_dates(values, years) if c in DATE_COLS else np.where(values == MISSING, -99, values)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+# =============================================
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=path.dirname(path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_meta(root, meta):
+    tmp = path.join(root, '.atlas.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, path.join(root, 'atlas.json'))
+
+def create(Wdir_path, root, axes):
+    #empty atlas (all points to simulate) for the grid axes
+    os.makedirs(root, exist_ok=True)
+    shape = grid_shape(axes)
+    n_points, n_years = int(np.prod(shape)), axes['years'][1] - axes['years'][0] + 1
+    for c in OSU_COLS:
+        np.lib.format.open_memmap(path.join(root, c + '.npy'), mode='w+', dtype=np.int16, shape=(n_points, n_years)).flush()
+    np.lib.format.open_memmap(path.join(root, 'status.npy'), mode='w+', dtype=np.uint8, shape=(n_points,)).flush()
+    meta = {'axes': axes, 'shape': list(shape), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'wdir': Wdir_path,
+            'blocks': {}}
+    write_meta(root, meta)
+    return meta
+
+def block_rows(axes, crop, station, points):
+    #grid points of one crop/station block => rows of the scenario summary table
+    shape = grid_shape(axes)
+    idx = np.unravel_index(points, shape)
+    rows = []
+    for k in range(len(points)):
+        row = {'Crop': crop, 'stn_name': station, 'Cultivar': axes['cultivar'][crop][idx[2][k]],
+               'soil': axes['soil'][idx[3][k]], 'iH2O': axes['iH2O'][idx[4][k]], 'iNO3': axes['iNO3'][idx[5][k]],
+               'Plt-date': axes['plt_date'][idx[6][k]], 'plt_density': axes['density'][crop],
+               'FirstYear': str(axes['years'][0]), 'LastYear': str(axes['years'][1]), 'sce_name': sweep.short_name(k, 'a')}
+        row.update({c: '-99' for pair in result_cache.FERT_COLS for c in pair})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def build(Wdir_path, root, axes, n_workers=None, chunk_size=CHUNK_SIZE, progress=None):
+    #simulate the points not done yet, and all points of the blocks whose input files changed
+    #progress(block, n_done, n_total) is called after each chunk (chunk_size scenarios for each worker process)
+    meta_fname = path.join(root, 'atlas.json')
+    if path.isfile(meta_fname):
+        with open(meta_fname, 'r') as f:
+            meta = json.load(f)
+        if meta['axes'] != axes:
+            raise ValueError("the atlas in {} has another grid; remove it or use --dir to build a new one".format(root))
+    else:
+        meta = create(Wdir_path, root, axes)
+    meta.update({'dssat_exe': dssat_runner.get_exe(Wdir_path), 'commit': git_commit(),
+                 'python': platform.python_version(), 'host': platform.node()})
+    arrays = {c: np.load(path.join(root, c + '.npy'), mmap_mode='r+') for c in OSU_COLS}
+    status = np.load(path.join(root, 'status.npy'), mmap_mode='r+')
+    shape = grid_shape(axes)
+    block_size = int(np.prod(shape[2:]))
+    years = np.arange(axes['years'][0], axes['years'][1] + 1)
+    weather = weather_store.WeatherStore(Wdir_path, path.join(Wdir_path, "cache", "weather"))
+    out_dir = tempfile.mkdtemp(prefix='atlas_')  #DSSAT outputs => nothing written into Wdir_path
+    try:
+        for b, (crop, station) in enumerate((c, s) for c in axes['crop'] for s in axes['station']):
+            name = crop + '/' + station
+            try:
+                missing_years = weather.missing_years(station, *axes['years'])
+            except (KeyError, ValueError) as e:
+                missing_years = [str(e)]
+            if missing_years:
+                run_metrics.get_logger().warning('atlas block skipped', extra={'fields': {
+                    'event': 'atlas_block_skipped', 'block': name, 'missing_years': missing_years}})
+                continue
+            files, version = files_version(Wdir_path, crop, station)
+            start = b * block_size
+            if meta['blocks'].get(name, {}).get('version') != version:  #new block, or its inputs changed => all again
+                status[start:start + block_size] = 0
+                meta['blocks'][name] = {'version': version, 'files': files, 'started': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                write_meta(root, meta)
+            todo = start + np.flatnonzero(status[start:start + block_size] == 0)
+            n_points = chunk_size * max(n_workers or dssat_runner.N_WORKERS, 1)  #batch mode: one sub-batch per worker
+            for i in range(0, len(todo), n_points):
+                points = todo[i:i + n_points]
+                dff = block_rows(axes, crop, station, points)
+                snx_texts = [snx_template.render_row(Wdir_path, row) for row in dff.to_dict('records')]
+                fout_names = dssat_runner.run_scenarios(Wdir_path, dff, n_workers=n_workers, batch=True,
+                                                        snx_texts=snx_texts, out_dir=out_dir)
+                for point, fout_name in zip(points, fout_names):
+                    result = osu_reader.read_osu(fout_name, OSU_COLS, missing=None) if path.isfile(fout_name) else None
+                    encoded = encode_result(result, years)
+                    if encoded is not None:
+                        for c in OSU_COLS:
+                            arrays[c][point] = encoded[c]
+                    status[point] = 1 if encoded is not None else 2
+                for array in list(arrays.values()) + [status]:
+                    array.flush()
+                if progress is not None:
+                    progress(name, block_size - int((status[start:start + block_size] == 0).sum()), block_size)
+            block = meta['blocks'][name]
+            block.update({'done': int((status[start:start + block_size] == 1).sum()),
+                          'failed': int((status[start:start + block_size] == 2).sum()),
+                          'finished': time.strftime('%Y-%m-%dT%H:%M:%S')})
+            write_meta(root, meta)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return meta
+
+def report(Wdir_path, root):
+    #blocks of the atlas: points done/failed and whether their input files changed since they were built
+    with open(path.join(root, 'atlas.json'), 'r') as f:
+        meta = json.load(f)
+    print('grid {} = {} points, years {}-{}, created {}'.format(
+        ' x '.join('{}={}'.format(a, n) for a, n in zip(AXES, meta['shape'])), int(np.prod(meta['shape'])),
+        meta['axes']['years'][0], meta['axes']['years'][1], meta['created']))
+    for name, block in sorted(meta['blocks'].items()):
+        crop, station = name.split('/')
+        stale = block['version'] != files_version(Wdir_path, crop, station)[1]
+        print('{:<10}{:>8} done{:>6} failed  {}{}'.format(name, block.get('done', 0), block.get('failed', 0),
+                                                          block.get('finished', 'not finished'),
+                                                          '  STALE (input files changed, build again)' if stale else ''))
+
+# =============================================
+def main():
+    parser = argparse.ArgumentParser(description='Build the atlas of precomputed yields of the standard scenarios')
+    parser.add_argument('command', choices=['build', 'status'])
+    parser.add_argument('--wdir', default=os.environ.get('SIMAGRI_WDIR', 'C:\\IRI\\Python_Dash\\ET_DSS_hist\\TEST\\'),
+                        help='DSSAT working directory (default: SIMAGRI_WDIR)')
+    parser.add_argument('--dir', default=None, help='atlas directory (default: SIMAGRI_ATLAS_DIR or atlas in the wdir)')
+    parser.add_argument('--crops', nargs='+', default=None, help='default: all crops')
+    parser.add_argument('--stations', nargs='+', default=None, help='default: ' + ' '.join(STATIONS))
+    parser.add_argument('--soils', nargs='+', default=None, help='default: all soils of ET.SOL')
+    parser.add_argument('--step', type=int, default=STEP_DAYS, help='days between the planting dates')
+    parser.add_argument('--workers', type=int, default=None, help='DSSAT runs in parallel (default: SIMAGRI_WORKERS)')
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE, help='scenarios per DSSAT launch of each worker')
+    args = parser.parse_args()
+    root = args.dir or ATLAS_DIR or path.join(args.wdir, 'atlas')
+    try:
+        if args.command == 'status':
+            report(args.wdir, root)
+            return
+        axes = make_axes(args.wdir, args.crops, args.stations, args.soils, args.step)
+        build(args.wdir, root, axes, args.workers, args.chunk,
+              lambda name, n_done, n_total: print('\r{} {}/{} points'.format(name, n_done, n_total),
+                                                  end='' if n_done < n_total else '\n', file=sys.stderr, flush=True))
+        report(args.wdir, root)
+    except (OSError, ValueError) as e:
+        parser.exit(1, 'error: {}\n'.format(e))
+
+if __name__ == "__main__":
+    main()